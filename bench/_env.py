@@ -0,0 +1,16 @@
+"""
+Shared setup for the benchmarks; import it before telegram_agents.
+
+Puts the repo root on sys.path, sets a dummy GROQ_API_KEY, turns off the Groq
+rate limits (FakeGroq has none) and points DB_PATH at a fresh temp directory, TMP.
+"""
+import os
+import sys
+import tempfile
+
+TMP = tempfile.mkdtemp(prefix="bench-")
+os.environ.setdefault("GROQ_API_KEY", "bench")
+os.environ.setdefault("GROQ_RPM", "0")
+os.environ.setdefault("GROQ_TPM", "0")
+os.environ["DB_PATH"] = os.path.join(TMP, "memory.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,139 @@
+"""
+Micro-benchmark: DB cost of one master_agent turn, before/after MemoryDB.
+
+before = the original helpers (new sqlite3.connect per call, run on the loop)
+after  = telegram_agents.db (WAL + batched writer + reader pool)
+
+Two passes: one chat alone (the DB cost of a single turn, nothing to batch with)
+and --chats chats at once. In the concurrent pass "before" runs each turn to
+completion on the loop, so its per-turn latency hides the wait of every other
+chat (that wait shows up as max loop block instead); "after" overlaps the turns,
+so its per-turn latency includes queueing behind the other chats' writes and
+reads: higher p50/p95 per turn, in exchange for a far shorter wall time and an
+unblocked loop.
+
+    python bench/bench_db.py [--chats 20] [--turns 25]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import time
+
+from _env import TMP
+
+import telegram_agents as ta  # noqa: E402
+
+LEGACY_DB = os.path.join(TMP, "before.db")
+
+
+# --- نسخة مطابقة للدوال القديمة (اتصال جديد في كل استدعاء) ---
+def legacy_exec(sql_list):
+    conn = sqlite3.connect(LEGACY_DB)
+    c = conn.cursor()
+    rows = None
+    for sql, args in sql_list:
+        c.execute(sql, args)
+        rows = c.fetchall()
+    conn.commit()
+    conn.close()
+    return rows
+
+
+def legacy_save(table, col, chat_id, value, keep, extra=()):
+    cols = "chat_id," + col + "".join("," + e for e, _ in extra)
+    vals = (chat_id, value) + tuple(v for _, v in extra)
+    legacy_exec([
+        (f"INSERT INTO {table} ({cols}) VALUES ({','.join('?' * len(vals))})", vals),
+        (f"""DELETE FROM {table} WHERE chat_id=? AND id NOT IN
+             (SELECT id FROM {table} WHERE chat_id=? ORDER BY ts DESC LIMIT {keep})""",
+         (chat_id, chat_id)),
+    ])
+
+
+def legacy_turn(chat_id, text):
+    legacy_save("messages", "role", chat_id, "المستخدم", 60, (("content", text),))
+    legacy_exec([("SELECT COUNT(*) FROM messages WHERE chat_id=?", (chat_id,))])
+    legacy_exec([("SELECT summary FROM summaries WHERE chat_id=? ORDER BY ts DESC LIMIT 3", (chat_id,))])
+    for w in text.split()[:5]:
+        legacy_exec([("SELECT title,content FROM knowledge WHERE chat_id=? AND (title LIKE ? OR content LIKE ?) LIMIT 2",
+                      (chat_id, f"%{w}%", f"%{w}%"))])
+    legacy_exec([("SELECT lesson FROM lessons WHERE chat_id=? ORDER BY ts DESC LIMIT 5", (chat_id,))])
+    legacy_exec([("SELECT role,content FROM messages WHERE chat_id=? ORDER BY ts DESC LIMIT 10", (chat_id,))])
+    legacy_save("messages", "role", chat_id, "الفريق", 60, (("content", "تمت"),))
+    legacy_save("lessons", "lesson", chat_id, "نفّذنا", 20)
+
+
+async def new_turn(chat_id, text):
+    await ta.save_msg(chat_id, "المستخدم", text)
+    await ta.build_context(chat_id, text)
+    await asyncio.gather(ta.save_msg(chat_id, "الفريق", "تمت"),
+                         ta.save_lesson(chat_id, "نفّذنا"))
+
+
+async def loop_lag(stop: asyncio.Event, out: list):
+    """يقيس أقصى تأخير لحلقة asyncio (= مدة الحجب)"""
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(0.001)
+        out.append(time.perf_counter() - t - 0.001)
+
+
+async def run(label, turn, chats, turns):
+    lat, lag, stop = [], [], asyncio.Event()
+    lag_task = asyncio.create_task(loop_lag(stop, lag))
+    text = "اكتب سكريبت python يقرأ ملف csv ويحسب المتوسط"
+
+    async def chat(cid):
+        for _ in range(turns):
+            t = time.perf_counter()
+            await turn(cid, text)
+            lat.append(time.perf_counter() - t)
+            await asyncio.sleep(0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(chat(cid) for cid in range(chats)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await lag_task
+    lat.sort()
+    print(f"{label:7s} turns={len(lat):5d}  wall={wall:6.2f}s  "
+          f"turn p50={statistics.median(lat)*1e3:7.2f}ms  p95={lat[int(len(lat)*.95)]*1e3:7.2f}ms  "
+          f"max loop block={max(lag)*1e3:7.2f}ms")
+
+
+async def amain(args):
+    async def legacy(cid, text):
+        legacy_turn(cid, text)
+
+    for chats, turns in ((1, args.chats * args.turns // 2), (args.chats, args.turns)):
+        print(f"chats={chats} (concurrent)" if chats > 1 else "chats=1 (single turn, no contention)")
+        await run("before", legacy, chats, turns)
+        await run("after", new_turn, chats, turns)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--turns", type=int, default=25)
+    args = p.parse_args()
+
+    # نفس المخطط لقاعدة "before" لكن بوضع journal الافتراضي كما كان
+    ta.db = ta.MemoryDB(LEGACY_DB)
+    ta.init_db()
+    ta.db.close()
+    conn = sqlite3.connect(LEGACY_DB)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+    ta.db = ta.MemoryDB(os.environ["DB_PATH"])
+    ta.init_db()
+    try:
+        asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+
+
+if __name__ == "__main__":
+    main()
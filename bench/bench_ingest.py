@@ -0,0 +1,91 @@
+"""
+Document ingestion: first upload, identical re-upload and a re-upload with a
+few edited lines, for a generated multi-megabyte text file.
+
+Reports wall time, chunks stored vs seen, the longest asyncio loop stall while
+ingesting, and peak RSS (the file itself is read from a spooled temp file).
+
+    python bench/bench_ingest.py [--mb 8] [--edits 5]
+"""
+import argparse
+import asyncio
+import random
+import resource
+import tempfile
+import time
+
+import _env  # noqa: F401
+
+import telegram_agents as ta  # noqa: E402
+
+WORDS = ("قاعدة البيانات الفهرسة تحسين الأداء الذاكرة التخزين المؤقت الاستعلام "
+         "database index query cache latency throughput replica shard").split()
+
+
+def make_doc(mb):
+    lines, size = [], 0
+    while size < mb * 1e6:
+        line = " ".join(random.choice(WORDS) for _ in range(random.randint(8, 40))) + "."
+        if random.random() < 0.15:
+            line = ""
+        lines.append(line)
+        size += len(line.encode()) + 1
+    return lines
+
+
+def edit(lines, n):
+    lines = list(lines)
+    for _ in range(n):
+        i = random.randrange(len(lines))
+        lines[i] += " (نسخة معدلة)"
+    return lines
+
+
+async def ingest(label, chat_id, lines):
+    f = tempfile.SpooledTemporaryFile(ta.DOC_SPOOL_BYTES)
+    for line in lines:
+        f.write(line.encode() + b"\n")
+    lag, stop = [], asyncio.Event()
+
+    async def probe():
+        while not stop.is_set():
+            t = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag.append(time.perf_counter() - t - 0.005)
+
+    probe_task = asyncio.create_task(probe())
+    t = time.perf_counter()
+    new, total, removed = await ta.ingest_document(chat_id, "doc.txt", f, "text")
+    wall = time.perf_counter() - t
+    stop.set()
+    await probe_task
+    f.close()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{label:10s} wall={wall:6.2f}s  stored={new:6d}/{total:6d} chunks  removed={removed:4d}  "
+          f"max loop stall={max(lag)*1e3:5.0f}ms  peak rss={rss:6.0f}MB")
+
+
+async def amain(args):
+    lines = make_doc(args.mb)
+    print(f"document: {sum(len(x.encode()) + 1 for x in lines) / 1e6:.1f}MB, {len(lines)} lines")
+    await ingest("first", 1, lines)
+    await ingest("identical", 1, lines)
+    await ingest("edited", 1, edit(lines, args.edits))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--mb", type=float, default=8)
+    p.add_argument("--edits", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args()
+    random.seed(args.seed)
+    ta.init_db()
+    try:
+        asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Voice/photo handling: download_as_bytearray + full-size photo (old) vs
+MediaPipeline (new) against FakeTelegram / FakeGroq.
+
+The traffic mixes fresh files, forwards (same file_unique_id) and re-uploads
+(new file_unique_id, identical bytes). Photos come in Telegram's usual size
+ladder (320 … 2560 px), except an --oversized share that arrives as the 2560 px
+original only, so the pipeline has to downscale it before sending. Reports
+latency, bytes pulled from Telegram, bytes sent to Groq, model calls, and the
+bytes saved by downscaling (exits non-zero if nothing was downscaled).
+
+    python bench/bench_media.py [--messages 100] [--forwarded 0.3] [--reuploaded 0.1]
+                                [--oversized 0.3]
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+import _env  # noqa: F401
+
+from telegram import Bot  # noqa: E402
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq, FakeTelegram  # noqa: E402
+
+SIDES = (320, 800, 1280, 2560)
+
+
+def photo_ladder():
+    """ملفات الصورة بكل الأحجام التي يرسلها تيليجرام (JPEG؛ بايتات عشوائية بدون Pillow)"""
+    if ta.Image is None:
+        return [os.urandom(side * side // 8) for side in SIDES]
+    base = ta.Image.effect_noise((SIDES[-1], SIDES[-1] * 3 // 4), 30).convert("RGB")
+    data = []
+    for side in SIDES:
+        out = io.BytesIO()
+        base.resize((side, side * 3 // 4)).save(out, "JPEG", quality=90)
+        data.append(out.getvalue())
+    return data
+
+
+def make_workload(tg, n, forwarded, reuploaded, oversized):
+    """[(kind, media)] — media = voice أو قائمة PhotoSize"""
+    made, out = [], []
+    for i in range(n):
+        r = random.random()
+        if made and r < forwarded:
+            out.append(random.choice(made))
+            continue
+        kind = random.choice(("voice", "photo"))
+        if made and r < forwarded + reuploaded:
+            # نفس المحتوى بمعرّف جديد (رفع الملف مرة أخرى)
+            src_kind, src = random.choice(made)
+            kind = src_kind
+            blobs, sides = src.blobs, src.sides
+        elif kind == "voice":
+            blobs, sides = [os.urandom(60000)], ()
+        elif random.random() < oversized:
+            # الأصل فقط بدون سلّم الأحجام: لا توجد نسخة 1280 فيجب التصغير قبل الإرسال
+            blobs, sides = photo_ladder()[-1:], SIDES[-1:]
+        else:
+            blobs, sides = photo_ladder(), SIDES
+        if kind == "voice":
+            fid = tg.add_file(blobs[0])
+            item = SimpleNamespace(file_id=fid, file_unique_id=f"u{fid}", file_size=len(blobs[0]))
+        else:
+            item = [SimpleNamespace(file_id=(fid := tg.add_file(blob)), file_unique_id=f"u{fid}",
+                                    width=side, height=side * 3 // 4, file_size=len(blob))
+                    for blob, side in zip(blobs, sides)]
+        holder = SimpleNamespace(media=item, blobs=blobs, sides=sides)
+        made.append((kind, holder))
+        out.append((kind, holder))
+    return out
+
+
+async def legacy(bot, kind, item):
+    # المسار القديم في handle_update
+    if kind == "voice":
+        file = await bot.get_file(item.file_id)
+        audio = await file.download_as_bytearray()
+        return await ta.transcribe_voice(bytes(audio))
+    file = await bot.get_file(item[-1].file_id)
+    img = await file.download_as_bytearray()
+    return await ta.analyze_image(bytes(img), "صف هذه الصورة بالتفصيل")
+
+
+async def pipeline(bot, kind, item):
+    if kind == "voice":
+        return await ta.media.transcribe(bot, item)
+    return await ta.media.analyze(bot, item, "صف هذه الصورة بالتفصيل")
+
+
+async def run(label, handle, bot, tg, groq, workload):
+    tg.bytes_out, groq.bytes_in, groq.calls = 0, 0, {}
+    lat = []
+    t0 = time.perf_counter()
+    for kind, holder in workload:   # بالترتيب حتى تسبق الرسالة الأصلية نسخها المعاد توجيهها
+        t = time.perf_counter()
+        await handle(bot, kind, holder.media)
+        lat.append(time.perf_counter() - t)
+    wall = time.perf_counter() - t0
+    lat.sort()
+    print(f"{label:7s} wall={wall:6.2f}s  p50={statistics.median(lat)*1e3:7.1f}ms  "
+          f"p95={lat[int(len(lat)*.95)]*1e3:7.1f}ms  from telegram={tg.bytes_out / 1e6:6.2f}MB  "
+          f"to groq={groq.bytes_in / 1e6:6.2f}MB  model calls={sum(groq.calls.values())}")
+
+
+async def amain(args):
+    tg = await FakeTelegram().start()
+    groq = await FakeGroq(latency=args.groq_latency).start()
+    ta.models = ta.ModelClient("bench", base_url=groq.url)
+    ta.models.limiter.limits = {}   # حدود المعدل ليست ما نقيسه هنا
+    ta.llm_cache = ta.LLMCache()
+    bot = Bot("bench", base_url=f"{tg.url}/bot", base_file_url=f"{tg.url}/file/bot")
+    await bot.initialize()
+
+    workload = make_workload(tg, args.messages, args.forwarded, args.reuploaded, args.oversized)
+    print(f"messages={args.messages} forwarded={args.forwarded} reuploaded={args.reuploaded} "
+          f"oversized={args.oversized} pillow={'yes' if ta.Image else 'no'}")
+    await run("before", legacy, bot, tg, groq, workload)
+    await run("after", pipeline, bot, tg, groq, workload)
+    print(f"media: {ta.media.stats()}")
+    downscaled = ta.media.saved > 0
+
+    await bot.shutdown()
+    await ta.media.aclose()
+    await ta.models.aclose()
+    await groq.stop()
+    await tg.stop()
+    return downscaled
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=100)
+    p.add_argument("--forwarded", type=float, default=0.3)
+    p.add_argument("--reuploaded", type=float, default=0.1)
+    p.add_argument("--oversized", type=float, default=0.3, help="share of photos sent as the original only")
+    p.add_argument("--groq-latency", type=float, default=0.3)
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args()
+    random.seed(args.seed)
+    ta.init_db()
+    try:
+        downscaled = asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+    if ta.Image is not None and args.oversized and not downscaled:
+        sys.exit("FAIL: no photo was downscaled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Model tiering: every call site on the large model (before) vs the MODEL_ROUTES
+table (after: keywords / summary / executor / quick on the fast model), then
+the fallback paths with the fast model failing and slowed down.
+
+FakeGroq gets a per-model profile (time to first token, tokens/s); cost uses
+Groq's public per-million-token prices and FakeGroq's token counts.
+
+    python bench/bench_models.py [--chats 12] [--turns 6] [--concurrency 6]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import _env  # noqa: F401
+os.environ["LLM_CACHE"] = "0"            # كل تشغيل يدفع ثمن استدعاءاته كاملة
+os.environ.setdefault("SUMMARY_EVERY", "6")
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq, FakeSearch, RecordingBot  # noqa: E402
+
+FAST, LARGE = ta.MODEL_TIERS["fast"], ta.MODEL_TIERS["large"]
+PROFILES = {LARGE: (0.35, 280), FAST: (0.12, 750)}       # (ثوانٍ حتى أول توكن، توكن/ثانية)
+PRICES = {LARGE: (0.59, 0.79), FAST: (0.05, 0.08)}       # $ لكل مليون توكن (إدخال، إخراج)
+
+TURNS = [
+    "ما الفرق بين العملية والخيط في أنظمة التشغيل؟",
+    "ما هي آخر أخبار إصدار بايثون الجديد",
+    "اكتب سكريبت بايثون يحسب الأعداد الأولية حتى مئة",
+    "اشرح لي مفهوم الـ closure باختصار",
+    "كم سعر الذهب اليوم",
+    "أريد دالة بايثون تعكس نصاً وتطبعه",
+]
+
+
+def responder(model, messages):
+    prompt = messages[-1]["content"]
+    if isinstance(prompt, str) and "اكتب كوداً" in prompt:
+        return "هذا هو الحل:\n```python\nprint(sum(range(1, 101)))\n```"
+    return "هذا رد تجريبي من النموذج " * 12
+
+
+def cost(groq):
+    return sum(p * PRICES.get(m, PRICES[LARGE])[0] + c * PRICES.get(m, PRICES[LARGE])[1]
+               for m, (p, c) in groq.tokens.items()) / 1e6
+
+
+async def run(label, groq, table, args, chat_base):
+    ta.model_table = table
+    ta.router = ta.Router()
+    ta.models.health.clear()
+    groq.calls, groq.tokens = {}, {}
+    bot, sem = RecordingBot(), asyncio.Semaphore(args.concurrency)
+    lat = {t: [] for t in ta.TIERS}
+
+    async def user(chat_id):
+        for i in range(args.turns):
+            text = TURNS[(chat_id + i) % len(TURNS)]
+            async with sem:
+                t = time.perf_counter()
+                await ta.master_agent(bot, chat_id, text)
+                lat[ta.router.route(chat_id, text).tier].append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user(chat_base + c) for c in range(args.chats)))
+    while ta.summarizer.active:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - t0
+    turns = [x for xs in lat.values() for x in xs]
+    print(f"{label:14s} wall={wall:6.2f}s  mean turn={statistics.mean(turns):5.2f}s  "
+          f"cost=${cost(groq):.4f}  summaries={ta.summarizer.summarized}  fallbacks={table.fallbacks}")
+    print("    " + "  ".join(f"{t}: {statistics.mean(xs):5.2f}s (n={len(xs)})" for t, xs in lat.items() if xs))
+    print("    calls: " + ", ".join(f"{m}={n}" for m, n in sorted(groq.calls.items())))
+    ta.summarizer.summarized = 0
+
+
+async def amain(args):
+    groq = await FakeGroq(profiles=PROFILES, responder=responder).start()
+    ta.models = ta.ModelClient("bench", base_url=groq.url)
+    ta.search_service = ta.SearchService(backend=FakeSearch(0.2))
+    await ta.sandbox.start()
+
+    single = ta.ModelTable(routes={site: ("large",) for site in ta.MODEL_ROUTES})
+    await run("before (large)", groq, single, args, 1000)
+    await run("after (tiers)", groq, ta.ModelTable(), args, 2000)
+
+    groq.failing.add(FAST)
+    await run("fast failing", groq, ta.ModelTable(cooldown=args.cooldown), args, 3000)
+    groq.failing.clear()
+
+    groq.profiles[FAST] = (args.slow, 750)
+    await run("fast slowed", groq, ta.ModelTable(timeout=args.slow / 2), args, 4000)
+    print("\n" + ta.model_table.stats())
+
+    await ta.sandbox.close()
+    await ta.models.aclose()
+    await groq.stop()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=12)
+    p.add_argument("--turns", type=int, default=6)
+    p.add_argument("--concurrency", type=int, default=6)
+    p.add_argument("--cooldown", type=float, default=30)
+    p.add_argument("--slow", type=float, default=8, help="fast model latency in the last run (s)")
+    args = p.parse_args()
+    ta.init_db()
+    try:
+        asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Insert cost vs table size: per-insert retention (old) vs indexed schema + periodic
+compaction (new).
+
+before = schema v2 (no chat_id index), save_msg deletes the overflow with
+         DELETE ... NOT IN (SELECT ... LIMIT 60) inside every write batch
+after  = schema v3 ((chat_id, id) indexes), save_msg only marks the chat and
+         db.compact() trims the marked chats afterwards
+
+Each size is pre-filled with --rows messages per chat, then --inserts messages
+go to random chats (--legacy-inserts for "before": each one scans the whole table).
+
+    python bench/bench_retention.py [--sizes 1000,10000,20000] [--rows 60]
+                                    [--inserts 2000] [--legacy-inserts 100]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+from _env import TMP
+
+import telegram_agents as ta  # noqa: E402
+
+KEEP = ta.RETENTION["messages"]
+
+
+def prepare(path, version, chats, rows):
+    conn = ta.MemoryDB(path).connect()
+    ta.migrate(conn, version)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO messages (chat_id,role,content) VALUES (?,?,?)",
+                     ((cid, "المستخدم", "رسالة تجريبية للقياس") for _ in range(rows)
+                      for cid in range(chats)))
+    conn.execute("COMMIT")
+    conn.close()
+
+
+async def legacy_save_msg(chat_id, role, content):
+    # نسخة مطابقة لـ save_msg قبل التغيير (الحذف داخل دفعة الكتابة)
+    def op(conn):
+        conn.execute("INSERT INTO messages (chat_id,role,content) VALUES (?,?,?)",
+                     (chat_id, role, content))
+        pending = conn.execute("""SELECT COUNT(*) FROM messages WHERE chat_id=? AND id >
+                                    COALESCE((SELECT last_msg_id FROM summary_state WHERE chat_id=?), 0)""",
+                               (chat_id, chat_id)).fetchone()[0]
+        conn.execute("""DELETE FROM messages WHERE chat_id=? AND id NOT IN
+                        (SELECT id FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT ?)""",
+                     (chat_id, chat_id, KEEP))
+        return pending
+    return await ta.db.write(op)
+
+
+async def run(label, save, chats, inserts, concurrency=8):
+    lat, sem = [], asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            t = time.perf_counter()
+            await save(random.randrange(chats), "المستخدم", "رسالة جديدة")
+            lat.append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(inserts)))
+    wall = time.perf_counter() - t0
+    t = time.perf_counter()
+    deleted = await ta.db.compact() if label == "after" else 0
+    compact = time.perf_counter() - t
+    lat.sort()
+    print(f"  {label:6s} inserts/s={inserts / wall:8.0f}  p50={statistics.median(lat)*1e3:7.2f}ms  "
+          f"p95={lat[int(len(lat)*.95)]*1e3:7.2f}ms  compaction={compact*1e3:7.1f}ms "
+          f"({deleted} rows, {compact / inserts * 1e6:5.1f}µs/insert)")
+
+
+def bench(label, version, save, chats, inserts, args):
+    path = os.path.join(TMP, f"{label}-{chats}.db")
+    prepare(path, version, chats, args.rows)
+    ta.context_cache = ta.ContextCache()
+    ta.db = ta.MemoryDB(path)
+    ta.db.start()
+    try:
+        asyncio.run(run(label, save, chats, inserts))
+    finally:
+        ta.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--sizes", default="1000,10000,20000")
+    p.add_argument("--rows", type=int, default=KEEP)
+    p.add_argument("--inserts", type=int, default=2000)
+    p.add_argument("--legacy-inserts", type=int, default=100)
+    args = p.parse_args()
+    for chats in map(int, args.sizes.split(",")):
+        random.seed(chats)
+        print(f"chats={chats} rows={chats * args.rows}")
+        bench("before", 2, legacy_save_msg, chats, args.legacy_inserts, args)
+        bench("after", len(ta.MIGRATIONS), ta.save_msg, chats, args.inserts, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Routing: the old keyword/length rule (legacy) vs the local router (rules +
+naive Bayes) on a held-out labelled set of realistic messages.
+
+1. classification: accuracy, confusion and cost per decision
+2. end to end: every message through master_agent (FakeGroq, fake search,
+   RecordingBot, real sandbox), reporting model calls and latency per tier
+
+    python bench/bench_router.py [--groq-latency 0.3] [--tok-rate 400] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import _env  # noqa: F401
+os.environ["LLM_CACHE"] = "0"            # حتى لا يستفيد الوضع الثاني من كاش الأول
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq, FakeSearch, RecordingBot  # noqa: E402
+
+# ليست ضمن بيانات التدريب في telegram_agents._ROUTE_SEED
+HELD_OUT = {
+    "quick": [
+        "ما هي البرمجة الكائنية وما فوائدها في المشاريع الكبيرة",
+        "كيف يعمل بروتوكول HTTPS بالتفصيل وما دور الشهادات فيه",
+        "ما الفرق بين الذاكرة العشوائية والذاكرة الدائمة في الحاسوب",
+        "اشرح لي معنى الـ recursion مع مثال بسيط من الحياة",
+        "لماذا يفضل المبرمجون استخدام git في المشاريع الجماعية",
+        "ما هو الفرق بين الذكاء الاصطناعي وتعلم الآلة والتعلم العميق",
+        "هل من الأفضل أن أبدأ بتعلم بايثون أم جافاسكربت كمبتدئ",
+        "ما أفضل طريقة لتعلم الخوارزميات وهياكل البيانات",
+        "what is the difference between a process and a thread",
+        "اشرح لي مفهوم الـ API وكيف تتواصل التطبيقات مع بعضها",
+        "ما معنى مصطلح الحوسبة السحابية",
+        "مرحبا، كيف حالك اليوم؟",
+    ],
+    "search": [
+        "ما هي آخر التحديثات في إصدار بايثون 3.13 الجديد",
+        "كم سعر كرت الشاشة RTX 4090 في السعودية",
+        "من فاز بجائزة تورنغ هذه السنة",
+        "ابحث لي عن أفضل مكتبة لمعالجة اللغة العربية",
+        "ما هي أحدث أخبار شركة OpenAI",
+        "ما هو سعر صرف اليورو مقابل الجنيه اليوم",
+        "هل صدر إصدار جديد من نظام أندرويد هذا الشهر",
+        "ما هي الوظائف الأكثر طلباً في سوق البرمجة حالياً",
+        "latest news about the rust programming language",
+        "من هو الرئيس التنفيذي الحالي لشركة مايكروسوفت",
+    ],
+    "team": [
+        "اكتب سكريبت بايثون يعيد تسمية كل الصور في مجلد حسب التاريخ",
+        "أريد برنامج يحسب الأعداد الأولية حتى ألف ويطبعها",
+        "عندي خطأ KeyError في الكود عند قراءة القاموس كيف أصلحه",
+        "حوّل قائمة الأسماء هذه إلى ملف csv مرتب أبجدياً",
+        "اكتب دالة تتحقق إن كان النص متناظراً palindrome",
+        "استخرج كل الروابط من صفحة html باستخدام بايثون",
+        "اعمل لي سكريبت يراقب استهلاك المعالج ويطبعه كل ثانية",
+        "احسب عدد الكلمات في هذا النص باستخدام كود",
+        "write a python function that merges two sorted lists",
+        "أنشئ قاعدة بيانات sqlite فيها جدول للطلاب وأضف ثلاثة صفوف",
+    ],
+}
+
+
+def responder(model, messages):
+    prompt = messages[-1]["content"]
+    if isinstance(prompt, str) and "اكتب كوداً" in prompt:
+        return "هذا هو الحل:\n```python\nprint(sum(range(1, 101)))\n```"
+    return "هذا رد تجريبي من النموذج " * 6
+
+
+def classify(mode):
+    router = ta.Router(mode=mode)
+    confusion = {t: dict.fromkeys(ta.TIERS, 0) for t in ta.TIERS}
+    t = time.perf_counter()
+    for i, (label, texts) in enumerate(HELD_OUT.items()):
+        for j, text in enumerate(texts):
+            # كل رسالة في محادثة مستقلة (بدون كاش ولا متابعة)
+            confusion[label][router.route(i * 1000 + j, text).tier] += 1
+    per = (time.perf_counter() - t) / sum(map(len, HELD_OUT.values())) * 1e6
+    total = sum(sum(row.values()) for row in confusion.values())
+    right = sum(confusion[t][t] for t in ta.TIERS)
+    print(f"{mode:6s} accuracy={right / total:5.0%}  {per:6.1f}µs/decision")
+    for label, row in confusion.items():
+        print(f"    {label:6s} → " + "  ".join(f"{t}={n:2d}" for t, n in row.items()))
+
+
+async def end_to_end(mode, groq, concurrency):
+    ta.router = ta.Router(mode=mode)
+    groq.calls = {}
+    bot, sem, lat = RecordingBot(), asyncio.Semaphore(concurrency), []
+    items = [(i * 1000 + j, text) for i, texts in enumerate(HELD_OUT.values())
+             for j, text in enumerate(texts)]
+
+    async def one(chat_id, text):
+        async with sem:
+            t = time.perf_counter()
+            await ta.master_agent(bot, chat_id + (0 if mode == "legacy" else 500), text)
+            lat.append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(c, t) for c, t in items))
+    wall = time.perf_counter() - t0
+    print(f"{mode:6s} wall={wall:6.2f}s  mean turn={sum(lat) / len(lat):5.2f}s  "
+          f"model calls={sum(groq.calls.values())}")
+    print("    " + ta.router.stats().replace("\n", "\n    "))
+
+
+async def amain(args):
+    groq = await FakeGroq(latency=args.groq_latency, tok_rate=args.tok_rate, responder=responder).start()
+    ta.models = ta.ModelClient("bench", base_url=groq.url)
+    ta.search_service = ta.SearchService(backend=FakeSearch(0.2))
+    await ta.sandbox.start()
+    for mode in ("legacy", "local"):
+        await end_to_end(mode, groq, args.concurrency)
+    await ta.sandbox.close()
+    await ta.models.aclose()
+    await groq.stop()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--groq-latency", type=float, default=0.3)
+    p.add_argument("--tok-rate", type=float, default=400)
+    p.add_argument("--concurrency", type=int, default=8)
+    args = p.parse_args()
+    print("classification (held-out set):")
+    for mode in ("legacy", "local"):
+        classify(mode)
+    print("\nend to end:")
+    ta.init_db()
+    try:
+        asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+
+
+if __name__ == "__main__":
+    main()
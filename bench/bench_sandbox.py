@@ -0,0 +1,66 @@
+"""
+Latency of one execute_code run: cold interpreter per run (old) vs SandboxPool.
+
+before = temp file + subprocess.run([sys.executable, path]) in asyncio.to_thread
+after  = telegram_agents.execute_code (pre-started worker + rlimits)
+
+    python bench/bench_sandbox.py [--runs 40] [--gap 0.2]
+
+--gap is the idle time between runs (a chat turn is seconds apart), which is
+what lets the pool re-warm in the background.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import _env  # noqa: F401
+
+import telegram_agents as ta  # noqa: E402
+
+CODE = "import math\nprint(sum(math.sqrt(i) for i in range(10000)))\n"
+
+
+async def cold_run(code):
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False, encoding="utf-8") as f:
+        f.write(code)
+    try:
+        await asyncio.to_thread(lambda: subprocess.run(
+            [sys.executable, f.name], capture_output=True, text=True, timeout=30))
+    finally:
+        os.unlink(f.name)
+
+
+async def run(label, fn, runs, gap):
+    lat = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        await fn(CODE)
+        lat.append(time.perf_counter() - t)
+        await asyncio.sleep(gap)
+    lat.sort()
+    print(f"{label:7s} runs={runs:4d}  p50={statistics.median(lat)*1e3:7.1f}ms  "
+          f"p95={lat[int(len(lat)*.95)]*1e3:7.1f}ms")
+
+
+async def amain(args):
+    await ta.sandbox.start()
+    await run("before", cold_run, args.runs, args.gap)
+    await run("after", ta.execute_code, args.runs, args.gap)
+    print("pool:", ta.sandbox.stats())
+    await ta.sandbox.close()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=40)
+    p.add_argument("--gap", type=float, default=0.2)
+    asyncio.run(amain(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
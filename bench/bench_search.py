@@ -0,0 +1,87 @@
+"""
+Benchmark: web_search with a stubbed slow backend, before/after SearchService.
+
+before = a fresh backend call for every request (the old DDGS().text per call)
+after  = telegram_agents.SearchService (normalized keys + TTL cache + coalescing)
+
+The workload mimics several chats asking for the same keywords with small
+spelling variations (spacing, case, Arabic diacritics) at about the same time.
+
+    python bench/bench_search.py [--requests 200] [--distinct 15] [--latency 0.8]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import threading
+import time
+
+import _env  # noqa: F401
+
+import telegram_agents as ta  # noqa: E402
+
+TOPICS = ["بايثون قراءة ملف csv", "python asyncio tutorial", "سعر الذهب اليوم",
+          "sqlite wal mode", "تعلم الآلة للمبتدئين", "docker compose example",
+          "الذكاء الاصطناعي", "telegram bot api", "regex arabic text", "numpy matmul"]
+
+
+class StubBackend:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, query: str, n: int) -> list:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return [{"title": f"{query} #{i}", "body": "نتيجة تجريبية"} for i in range(n)]
+
+
+def variants(q: str) -> list:
+    return [q, f"  {q} ", q.upper(), q.replace("ا", "أ", 1), q.replace(" ", "  ")]
+
+
+async def run(label, search, backend, queries):
+    lat = []
+
+    async def one(q, delay):
+        await asyncio.sleep(delay)
+        t = time.perf_counter()
+        await search(q)
+        lat.append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(q, d) for q, d in queries))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    print(f"{label:6s} backend calls={backend.calls:4d}  wall={wall:6.2f}s  "
+          f"p50={statistics.median(lat)*1e3:7.1f}ms  p95={lat[int(len(lat)*.95)]*1e3:7.1f}ms")
+
+
+async def amain(args):
+    rnd = random.Random(1)
+    topics = (TOPICS * (args.distinct // len(TOPICS) + 1))[:args.distinct]
+    topics = [f"{t} {i}" if i >= len(TOPICS) else t for i, t in enumerate(topics)]
+    queries = [(rnd.choice(variants(rnd.choice(topics))), rnd.uniform(0, 3))
+               for _ in range(args.requests)]
+
+    before = StubBackend(args.latency)
+    await run("before", lambda q: asyncio.to_thread(before, q, 4), before, queries)
+
+    after = StubBackend(args.latency)
+    service = ta.SearchService(backend=after)
+    await run("after", lambda q: service.search(q, 4), after, queries)
+    print(f"after: hits={service.hits} coalesced={service.coalesced} misses={service.misses}")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--distinct", type=int, default=15)
+    p.add_argument("--latency", type=float, default=0.8)
+    asyncio.run(amain(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
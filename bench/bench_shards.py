@@ -0,0 +1,129 @@
+"""
+Throughput vs number of worker processes (WORKERS=1 is the single-process bot).
+
+The real bot runs as a subprocess (`bench_shards.py --bot` = telegram_agents.main()
+with a fake search backend; in WORKERS mode the workers re-exec the same command)
+against FakeTelegram + FakeGroq served from this process. --chats users each queue
+--turns text messages at once; a turn is done when master_agent has stored its
+"الفريق" row. With --kill, one worker is SIGKILLed halfway through the last run to
+check that the supervisor restarts it and redelivers its unfinished updates.
+
+    python bench/bench_shards.py [--workers 1,2,4] [--chats 60] [--turns 3]
+                                 [--groq-latency 0.05] [--kill]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+TEXTS = ["ما الفرق بين العملية والخيط في أنظمة التشغيل؟", "ما هي آخر أخبار إصدار بايثون الجديد",
+         "اكتب سكريبت بايثون يحسب الأعداد الأولية حتى مئة", "اشرح لي مفهوم الـ closure باختصار",
+         "كم سعر الذهب اليوم", "مرحبا"]
+
+
+def bot():
+    import telegram_agents as ta
+    from fakes import FakeSearch
+    ta.search_service = ta.SearchService(backend=FakeSearch(0.05))
+    asyncio.run(ta.main())
+
+
+def responder(model, messages):
+    prompt = messages[-1]["content"]
+    if isinstance(prompt, str) and "اكتب كوداً" in prompt:
+        return "هذا هو الحل:\n```python\nprint(sum(range(1, 101)))\n```"
+    return "هذا رد تجريبي من النموذج " * 12
+
+
+def children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def finished(db_path):
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE role='الفريق'").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        return 0
+
+
+async def run(workers, args, tg, groq, kill=False):
+    from fakes import make_message
+    tmp = tempfile.mkdtemp(prefix=f"bench-shards-{workers}-")
+    db_path = os.path.join(tmp, "memory.db")
+    env = {**os.environ, "TELEGRAM_TOKEN": "bench", "GROQ_API_KEY": "bench",
+           "TELEGRAM_API_URL": tg.url, "GROQ_BASE_URL": groq.url, "DB_PATH": db_path,
+           "WORKERS": str(workers), "GROQ_RPM": "0", "GROQ_TPM": "0", "LLM_CACHE": "0",
+           "TG_GLOBAL_RATE": "100000", "TG_CHAT_RATE": "100000", "TG_CHAT_BURST": "1000",
+           "CHAT_QUEUE_SIZE": str(args.turns), "TRACE_SLOW_SEC": "1000"}
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "--bot", env=env,
+                                                stdout=asyncio.subprocess.DEVNULL if not args.verbose else None)
+    while tg.calls.get("getUpdates", 0) < 2:   # التهيئة + أول طلب جلب طويل
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1.0 if workers > 1 else 0.2)   # تشغيل العمّال
+
+    total = args.chats * args.turns
+    t0 = time.perf_counter()
+    for turn in range(args.turns):
+        for c in range(args.chats):
+            tg.push(make_message(10_000 + c, text=TEXTS[(c + turn) % len(TEXTS)]))
+    killed = None
+    while (done := await asyncio.to_thread(finished, db_path)) < total:
+        if kill and killed is None and done >= total // 2 and (pids := children(proc.pid)):
+            killed = pids[0]
+            os.kill(killed, signal.SIGKILL)
+        if time.perf_counter() - t0 > args.timeout:
+            break
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - t0
+    proc.terminate()
+    await proc.wait()
+    note = f"  (killed worker pid {killed}; all turns completed: {done >= total})" if kill else ""
+    print(f"workers={workers}  turns={done}/{total}  wall={wall:6.2f}s  → {done / wall:6.1f} turns/s{note}")
+    return done / wall
+
+
+async def amain(args):
+    from fakes import FakeGroq, FakeTelegram
+    tg = await FakeTelegram().start()
+    groq = await FakeGroq(latency=args.groq_latency, responder=responder).start()
+    counts = [int(n) for n in args.workers.split(",")]
+    base = None
+    for i, n in enumerate(counts):
+        tg.calls.clear()
+        tps = await run(n, args, tg, groq, kill=args.kill and i == len(counts) - 1)
+        base = base or tps
+        print(f"    speedup ×{tps / base:.2f}  (cpus={os.cpu_count()})")
+    await groq.stop()
+    await tg.stop()
+
+
+def main():
+    if "--bot" in sys.argv:
+        return bot()
+    p = argparse.ArgumentParser()
+    p.add_argument("--workers", default="1,2,4")
+    p.add_argument("--chats", type=int, default=60)
+    p.add_argument("--turns", type=int, default=3)
+    p.add_argument("--groq-latency", type=float, default=0.05)
+    p.add_argument("--timeout", type=float, default=300)
+    p.add_argument("--kill", action="store_true")
+    p.add_argument("--verbose", action="store_true", help="show the bot's output")
+    asyncio.run(amain(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+End-to-end check of webhook mode: a local fake Telegram sender POSTs updates to
+WebhookServer, which feeds the real ChatDispatcher / master_agent pipeline
+(Groq replaced by FakeGroq, the Bot API by RecordingBot).
+
+Checks: every unique update gets exactly one reply, redeliveries are dropped,
+bad secret -> 401, malformed body -> 400, a full queue -> 503 (Telegram retries),
+and last_update_id is persisted.
+
+    python bench/e2e_webhook.py [--chats 20] [--per-chat 5] [--connections 40]
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+import _env  # noqa: F401
+
+import httpx  # noqa: E402
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq, FakeSearch, RecordingBot, make_update  # noqa: E402
+
+SECRET = "e2e-secret"
+
+
+async def telegram_sender(url, updates, connections):
+    """Delivers like Telegram: parallel connections, retry on non-2xx, some duplicates."""
+    statuses = {}
+    queue = asyncio.Queue()
+    for u in updates:
+        queue.put_nowait(u)
+    for u in random.sample(updates, len(updates) // 10):   # redeliveries
+        queue.put_nowait(u)
+
+    async def conn(client):
+        while not queue.empty():
+            u = queue.get_nowait()
+            r = await client.post(url, json=u, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+            if r.status_code >= 500:
+                await asyncio.sleep(0.05)
+                queue.put_nowait(u)
+
+    async with httpx.AsyncClient(limits=httpx.Limits(max_connections=connections)) as client:
+        await asyncio.gather(*(conn(client) for _ in range(connections)))
+        bad_secret = await client.post(url, json=updates[0],
+                                       headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        bad_body = await client.post(url, content=b"{not json",
+                                     headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+    return statuses, bad_secret.status_code, bad_body.status_code
+
+
+async def amain(args):
+    groq = await FakeGroq(latency=0.05).start()
+    ta.models = ta.ModelClient("bench", base_url=groq.url)
+    # لا اتصال بالشبكة: أي دور يوجَّه إلى search يستخدم بحثاً وهمياً
+    ta.search_service = ta.SearchService(backend=FakeSearch(0.05))
+    bot = RecordingBot()
+    # طابور صغير لإظهار الـ backpressure (503 ثم إعادة إرسال)
+    server = await ta.WebhookServer(secret=SECRET, host="127.0.0.1", port=0, queue_size=8).start()
+    server.PUT_TIMEOUT = 0.05
+    dispatcher = ta.ChatDispatcher(bot, max_pending=16)
+    consumer = asyncio.create_task(ta.run_webhook(bot, dispatcher, server, register=False))
+
+    updates = [make_update(1000 + i, 1 + i % args.chats, f"مرحبا {i}")
+               for i in range(args.chats * args.per_chat)]
+    t0 = time.perf_counter()
+    statuses, bad_secret, bad_body = await telegram_sender(
+        f"http://127.0.0.1:{server.port}{server.path}", updates, args.connections)
+
+    expected = len(updates)
+    while len(bot.sent) < expected and time.perf_counter() - t0 < 60:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - t0
+    await asyncio.sleep(0.3)   # أي رد مكرر سيظهر هنا
+    last = await ta.get_state("last_update_id")
+
+    print(f"updates={expected} replies={len(bot.sent)} wall={wall:.2f}s "
+          f"http={statuses} bad_secret={bad_secret} bad_body={bad_body} "
+          f"accepted={server.accepted} busy={server.busy} last_update_id={last}")
+    ok = (len(bot.sent) == expected and bad_secret == 401 and bad_body == 400
+          and int(last) == updates[-1]["update_id"])
+    print("OK" if ok else "FAIL")
+
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+    await ta.models.aclose()
+    await groq.stop()
+    return ok
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--per-chat", type=int, default=5)
+    p.add_argument("--connections", type=int, default=40)
+    args = p.parse_args()
+    ta.init_db()
+    try:
+        ok = asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
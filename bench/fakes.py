@@ -0,0 +1,288 @@
+"""
+Local stand-ins for the external services telegram_agents.py talks to.
+
+Everything runs on asyncio in the benchmark process; no network access needed.
+"""
+import asyncio
+import itertools
+import json
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+
+class HTTPServer:
+    """Minimal HTTP/1.1 server with keep-alive (Content-Length bodies only)."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host, self.port = host, port
+        self.connections = 0
+        self.requests = 0
+        self.bytes_in = 0
+        self._server = None
+        self._writers = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._conn, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        for writer in list(self._writers):
+            writer.close()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes, writer):
+        """Override: write a response with respond() / respond_chunked()."""
+        raise NotImplementedError
+
+    async def _conn(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode().split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b""):
+                    k, v = h.decode().split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                self.bytes_in += len(body)
+                await self.handle(method, path, headers, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status: int, payload, ctype: str = "application/json", headers=None):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        extra = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+        writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: {ctype}\r\n"
+                     f"Content-Length: {len(data)}\r\n{extra}\r\n".encode() + data)
+        await writer.drain()
+
+    @staticmethod
+    async def respond_chunked(writer, chunks, ctype: str = "text/event-stream"):
+        writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {ctype}\r\n"
+                     "Transfer-Encoding: chunked\r\n\r\n".encode())
+        async for chunk in chunks:
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+class FakeGroq(HTTPServer):
+    """
+    OpenAI-compatible Groq stand-in.
+
+    latency    = seconds before the first token
+    tok_rate   = generated tokens per second (0 = instant)
+    responder  = fn(model, messages) -> reply text
+    profiles   = {model: (latency, tok_rate)} overriding the two above per model
+    failing    = models that answer 503 (mutable set)
+    tokens     = {model: [prompt, completion]} (prompt ≈ chars / 4)
+    """
+
+    def __init__(self, latency: float = 0.2, tok_rate: float = 0.0, responder=None,
+                 profiles: dict | None = None, **kw):
+        super().__init__(**kw)
+        self.latency = latency
+        self.tok_rate = tok_rate
+        self.responder = responder or (lambda model, messages: "هذا رد تجريبي من النموذج " * 8)
+        self.profiles = profiles or {}
+        self.failing = set()
+        self.calls = {}
+        self.tokens = {}
+
+    async def handle(self, method, path, headers, body, writer):
+        if path.endswith("/audio/transcriptions"):
+            self.calls["whisper"] = self.calls.get("whisper", 0) + 1
+            await asyncio.sleep(self.latency)
+            return await self.respond(writer, 200, {"text": "نص صوتي تجريبي"})
+        req = json.loads(body or b"{}")
+        model = req.get("model", "")
+        self.calls[model] = self.calls.get(model, 0) + 1
+        latency, tok_rate = self.profiles.get(model, (self.latency, self.tok_rate))
+        if model in self.failing:
+            await asyncio.sleep(latency)
+            return await self.respond(writer, 503, {"error": {"message": "unavailable"}})
+        messages = req.get("messages", [])
+        text = self.responder(model, messages)
+        tokens = text.split(" ")
+        used = self.tokens.setdefault(model, [0, 0])
+        used[0] += sum(len(m["content"]) if isinstance(m["content"], str) else 1000
+                       for m in messages) // 4
+        used[1] += len(tokens)
+        await asyncio.sleep(latency)
+        if req.get("stream"):
+            return await self.respond_chunked(writer, self._sse(model, tokens, tok_rate))
+        if tok_rate:
+            await asyncio.sleep(len(tokens) / tok_rate)
+        await self.respond(writer, 200, {
+            "id": "fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": len(tokens), "total_tokens": 10 + len(tokens)},
+        })
+
+    async def _sse(self, model, tokens, tok_rate):
+        for i, tok in enumerate(tokens):
+            if tok_rate:
+                await asyncio.sleep(1 / tok_rate)
+            chunk = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": tok + (" " if i < len(tokens) - 1 else "")},
+                                  "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+
+class RecordingBot:
+    """Bot stand-in: records send/edit calls instead of hitting the Bot API."""
+
+    def __init__(self):
+        self.sent = []    # (chat_id, text)
+        self.edits = 0
+        self._ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kw):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=next(self._ids))
+
+    async def edit_message_text(self, text, chat_id, message_id, **kw):
+        self.edits += 1
+        return True
+
+
+class FakeSearch:
+    """SearchService backend stand-in: sleeps `latency` seconds (runs in a thread), returns n fake results."""
+
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, query: str, n: int) -> list:
+        self.calls += 1
+        time.sleep(self.latency)
+        return [{"title": f"{query} #{i}", "body": "نتيجة بحث تجريبية " * 10} for i in range(n)]
+
+
+def make_message(chat_id: int, message_id: int = 1, **fields) -> dict:
+    """Bot API JSON for a private-chat message; fields = text / voice / photo / document / caption."""
+    return {"message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"}, **fields}
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Bot API JSON for a private text message."""
+    return {"update_id": update_id, "message": make_message(chat_id, update_id, text=text)}
+
+
+class FakeTelegram(HTTPServer):
+    """
+    Bot API stand-in: getMe, getUpdates (long poll), sendMessage, editMessageText,
+    getFile + file download, setWebhook/deleteWebhook.
+
+    push(message) queues an incoming update; add_file(data) registers a downloadable file.
+    """
+
+    def __init__(self, latency: float = 0.0, **kw):
+        super().__init__(**kw)
+        self.latency = latency
+        self.updates = []
+        self.files = {}
+        self.calls = {}
+        self.bytes_out = 0         # bytes of downloaded files
+        self.outbox = []          # (chat_id, method, text)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._new = asyncio.Event()
+
+    def push(self, message: dict) -> int:
+        update_id = next(self._update_ids)
+        message["message_id"] = next(self._message_ids)
+        self.updates.append({"update_id": update_id, "message": message})
+        self._new.set()
+        return update_id
+
+    def add_file(self, data: bytes) -> str:
+        file_id = f"file{next(self._file_ids)}"
+        self.files[file_id] = data
+        return file_id
+
+    @staticmethod
+    def _params(headers, body) -> dict:
+        ctype = headers.get("content-type", "")
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        for k, v in params.items():
+            try:
+                params[k] = json.loads(v)
+            except ValueError:
+                pass
+        return params
+
+    async def handle(self, method, path, headers, body, writer):
+        if path.startswith("/file/"):
+            data = self.files.get(path.rsplit("/", 1)[1])
+            self.bytes_out += len(data or b"")
+            return await self.respond(writer, 200 if data else 404, data or b"",
+                                      "application/octet-stream")
+        api = path.rsplit("/", 1)[1]
+        params = self._params(headers, body)
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if self.latency and api != "getUpdates":
+            await asyncio.sleep(self.latency)
+        result = await getattr(self, f"_api_{api}", self._api_default)(params)
+        await self.respond(writer, 200, {"ok": True, "result": result})
+
+    async def _api_default(self, params):
+        return True
+
+    async def _api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    async def _api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        if offset < 0:
+            return self.updates[offset:]
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and params.get("timeout"):
+            self._new.clear()
+            try:
+                await asyncio.wait_for(self._new.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit") or 100)]
+
+    def _message(self, params, api):
+        chat_id = int(params["chat_id"])
+        self.outbox.append((chat_id, api, params.get("text", "")))
+        return {"message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()), "text": params.get("text", ""),
+                "chat": {"id": chat_id, "type": "private"}}
+
+    async def _api_sendMessage(self, params):
+        return self._message(params, "sendMessage")
+
+    async def _api_editMessageText(self, params):
+        return self._message(params, "editMessageText")
+
+    async def _api_getFile(self, params):
+        file_id = params["file_id"]
+        return {"file_id": file_id, "file_unique_id": file_id,
+                "file_size": len(self.files.get(file_id, b"")), "file_path": file_id}
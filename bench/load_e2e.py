@@ -0,0 +1,175 @@
+"""
+Offline end-to-end load benchmark: the real main() polling loop, ChatDispatcher
+and master_agent against local stand-ins (FakeTelegram Bot API, FakeGroq, a
+fake search backend). No tokens or network needed.
+
+N simulated users each send --turns messages one after another (waiting for the
+bot to finish the previous one), with a mix of text, team (coding) requests,
+voice, photo and document uploads. Reports messages/sec, end-to-end latency
+percentiles per kind, DB time and the slowest pipeline stages.
+
+    python bench/load_e2e.py [--chats 50] [--turns 4] [--groq-latency 0.3]
+                             [--tok-rate 400] [--search-latency 0.2]
+
+Telegram/Groq budgets are the bot's real ones; override them through the usual
+env vars (e.g. TG_GLOBAL_RATE=1000) to measure the pipeline without them.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import _env  # noqa: F401
+os.environ.setdefault("TELEGRAM_TOKEN", "bench")   # main() يرفض التشغيل بدونه
+TMP = tempfile.mkdtemp(prefix="bench-e2e-")
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq, FakeSearch, FakeTelegram, make_message  # noqa: E402
+
+KINDS = {  # نوع الرسالة: الوزن
+    "text": 55, "team": 15, "voice": 10, "photo": 10, "document": 10,
+}
+TEXTS = ["مرحبا", "ما هي عاصمة فرنسا؟", "اشرح لي الـ GIL باختصار", "شكراً",
+         "ما الفرق بين list و tuple؟"]
+TEAM = ["اكتب سكريبت python يحسب مجموع الأعداد من 1 إلى 100",
+        "اكتب كود يقرأ ملف csv ويحسب المتوسط", "حل مشكلة error في برنامج بايثون"]
+
+
+def responder(model, messages):
+    prompt = messages[-1]["content"]
+    if isinstance(prompt, str) and "اكتب كوداً" in prompt:
+        return "هذا هو الحل:\n```python\nprint(sum(range(1, 101)))\n```"
+    return "هذا رد تجريبي من النموذج " * 6
+
+
+def percentiles(xs):
+    xs = sorted(xs)
+    if not xs:
+        return "-"
+    pick = lambda q: xs[min(len(xs) - 1, int(len(xs) * q))] * 1e3  # noqa: E731
+    return (f"p50={statistics.median(xs)*1e3:7.0f}ms  p95={pick(.95):7.0f}ms  "
+            f"p99={pick(.99):7.0f}ms  n={len(xs)}")
+
+
+def build(tg, kind, chat_id):
+    if kind == "text":
+        return make_message(chat_id, text=random.choice(TEXTS))
+    if kind == "team":
+        return make_message(chat_id, text=random.choice(TEAM))
+    if kind == "voice":
+        fid = tg.add_file(os.urandom(8000))
+        return make_message(chat_id, voice={"file_id": fid, "file_unique_id": fid, "duration": 3})
+    if kind == "photo":
+        fid = tg.add_file(os.urandom(30000))
+        return make_message(chat_id, photo=[{"file_id": fid, "file_unique_id": fid,
+                                             "width": 320, "height": 240}])
+    fid = tg.add_file(("مستند تجريبي عن قواعد البيانات والفهرسة. " * 200).encode()
+                      + os.urandom(4).hex().encode())
+    return make_message(chat_id, document={"file_id": fid, "file_unique_id": fid,
+                                           "file_name": f"doc-{fid}.txt", "mime_type": "text/plain"})
+
+
+async def amain(args):
+    tg = await FakeTelegram().start()
+    groq = await FakeGroq(latency=args.groq_latency, tok_rate=args.tok_rate,
+                          responder=responder).start()
+    ta.TELEGRAM_API_URL = tg.url
+    ta.models = ta.ModelClient("bench", base_url=groq.url)
+    ta.search_service = ta.SearchService(backend=FakeSearch(args.search_latency))
+
+    # اكتمال كل تحديث = انتهاء handle_update له
+    done: dict[int, asyncio.Future] = {}
+    handle_update = ta.handle_update
+
+    async def traced_handle(bot, update):
+        try:
+            await handle_update(bot, update)
+        finally:
+            fut = done.get(update.update_id)
+            if fut and not fut.done():
+                fut.set_result(time.perf_counter())
+    ta.handle_update = traced_handle
+
+    # زمن انتظار قاعدة البيانات كما يراه المستدعي
+    db_time = {"read": [], "write": []}
+
+    def timed(kind, fn):
+        async def inner(*a, **kw):
+            t = time.perf_counter()
+            try:
+                return await fn(*a, **kw)
+            finally:
+                db_time[kind].append(time.perf_counter() - t)
+        return inner
+    ta.db.read, ta.db.write = timed("read", ta.db.read), timed("write", ta.db.write)
+
+    bot_task = asyncio.create_task(ta.main())
+    await asyncio.sleep(0.5)   # init_db + أول get_updates
+
+    latency = {k: [] for k in KINDS}
+    lost = 0
+
+    async def user(chat_id):
+        nonlocal lost
+        for _ in range(args.turns):
+            kind = random.choices(list(KINDS), weights=list(KINDS.values()))[0]
+            loop = asyncio.get_running_loop()
+            t = time.perf_counter()
+            update_id = tg.push(build(tg, kind, chat_id))
+            fut = done[update_id] = loop.create_future()
+            try:
+                latency[kind].append(await asyncio.wait_for(fut, args.timeout) - t)
+            except asyncio.TimeoutError:
+                lost += 1
+            await asyncio.sleep(random.uniform(0, args.think))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i) for i in range(args.chats)))
+    wall = time.perf_counter() - t0
+
+    bot_task.cancel()
+    await asyncio.gather(bot_task, return_exceptions=True)
+
+    total = sum(len(v) for v in latency.values())
+    print(f"chats={args.chats} turns={args.turns} completed={total} lost={lost} wall={wall:.1f}s "
+          f"→ {total / wall:.1f} msg/s")
+    print(f"{'all':9s} {percentiles([x for v in latency.values() for x in v])}")
+    for kind, xs in latency.items():
+        print(f"{kind:9s} {percentiles(xs)}")
+    for kind, xs in db_time.items():
+        print(f"db {kind:6s} ops={len(xs):6d} total={sum(xs):6.2f}s  {percentiles(xs)}")
+    print(f"bot api calls: {dict(sorted(tg.calls.items()))}")
+    print(f"groq calls:    {groq.calls}")
+    print(f"router:        {ta.router.stats()}")
+    print("slowest stages:\n" + ta.tracer.summary())
+
+    await ta.sandbox.close()
+    await ta.media.aclose()
+    await ta.models.aclose()
+    await groq.stop()
+    await tg.stop()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--turns", type=int, default=4)
+    p.add_argument("--think", type=float, default=0.5, help="max pause between a user's messages (s)")
+    p.add_argument("--groq-latency", type=float, default=0.3)
+    p.add_argument("--tok-rate", type=float, default=400, help="fake Groq tokens/s (0 = instant)")
+    p.add_argument("--search-latency", type=float, default=0.2)
+    p.add_argument("--timeout", type=float, default=120)
+    p.add_argument("--seed", type=int, default=1)
+    args = p.parse_args()
+    random.seed(args.seed)
+    try:
+        asyncio.run(amain(args))
+    finally:
+        ta.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Load test: sync Groq client in asyncio.to_thread (old) vs ModelClient (AsyncGroq
+over a pooled httpx client) against a local fake Groq server.
+
+Alongside the LLM calls a probe keeps submitting tiny asyncio.to_thread jobs
+(what web_search / execute_code use) and records how long they queue.
+
+    python bench/load_groq.py [--requests 300] [--inflight 64] [--latency 0.3]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import _env  # noqa: F401
+
+from groq import Groq  # noqa: E402
+
+import telegram_agents as ta  # noqa: E402
+from fakes import FakeGroq  # noqa: E402
+
+MESSAGES = [{"role": "system", "content": "bench"}, {"role": "user", "content": "hello"}]
+
+
+async def probe(stop: asyncio.Event, delays: list):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.to_thread(lambda: None)
+        delays.append(time.perf_counter() - t)
+        await asyncio.sleep(0.01)
+
+
+async def run(label, call, requests, inflight, server):
+    server.connections = 0
+    sem, lat, delays, stop = asyncio.Semaphore(inflight), [], [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(stop, delays))
+
+    async def one():
+        async with sem:
+            t = time.perf_counter()
+            await call()
+            lat.append(time.perf_counter() - t)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await probe_task
+    lat.sort()
+    print(f"{label:6s} req/s={requests / wall:7.1f}  p50={statistics.median(lat)*1e3:7.1f}ms  "
+          f"p95={lat[int(len(lat)*.95)]*1e3:7.1f}ms  to_thread probe max={max(delays)*1e3:7.1f}ms  "
+          f"tcp connections={server.connections}")
+
+
+async def amain(args):
+    server = await FakeGroq(latency=args.latency).start()
+    sync_client = Groq(api_key="bench", base_url=server.url)
+    ta.models = ta.ModelClient("bench", base_url=server.url, concurrency=args.inflight)
+
+    async def old():
+        await asyncio.to_thread(lambda: sync_client.chat.completions.create(
+            model="llama-3.3-70b-versatile", messages=MESSAGES, max_tokens=50))
+
+    async def new():
+        await ta.models.chat("llama-3.3-70b-versatile", MESSAGES, 50)
+
+    await run("thread", old, args.requests, args.inflight, server)
+    await run("async", new, args.requests, args.inflight, server)
+    await ta.models.aclose()
+    await server.stop()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--requests", type=int, default=300)
+    p.add_argument("--inflight", type=int, default=64)
+    p.add_argument("--latency", type=float, default=0.3)
+    asyncio.run(amain(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
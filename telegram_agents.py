@@ -4,25 +4,238 @@ import os
 import json
 import re
 import base64
+import csv
+import io
+import itertools
 import sqlite3
 import hashlib
+import heapq
+import hmac
+import threading
+import time
+import zlib
+import functools
+import shutil
+import socket
 import subprocess
 import tempfile
 import sys
-from groq import Groq
-from telegram import Bot
-from telegram.error import TelegramError
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import Context, ContextVar
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from collections import OrderedDict, deque
+from queue import Empty, SimpleQueue
+import numpy as np
+import httpx
+from groq import (NOT_GIVEN, APIConnectionError, AsyncGroq,
+                  InternalServerError, RateLimitError)
+from telegram import Bot, Update
+from telegram.error import RetryAfter, TelegramError
 from ddgs import DDGS
+try:
+    from PIL import Image  # اختياري: تصغير الصور وإعادة ترميزها قبل نموذج الرؤية
+except ImportError:
+    Image = None
 
 # ============ 1. الإعدادات ============
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-GROQ_API_KEY   = os.getenv("GROQ_API_KEY")
+TELEGRAM_TOKEN   = os.getenv("TELEGRAM_TOKEN")
+GROQ_API_KEY     = os.getenv("GROQ_API_KEY")
+# عنوان Bot API (خادم محلي https://github.com/tdlib/telegram-bot-api أو بديل للاختبار)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
 
-if not TELEGRAM_TOKEN or not GROQ_API_KEY:
-    raise EnvironmentError("❌ أضف TELEGRAM_TOKEN و GROQ_API_KEY في Railway Variables")
+DB_PATH = os.getenv("DB_PATH", "/app/memory.db")
 
-client  = Groq(api_key=GROQ_API_KEY)
-DB_PATH = "/app/memory.db"
+# Groq: اتصالات HTTP مشتركة (keep-alive) + حد أقصى للطلبات المتزامنة
+GROQ_BASE_URL         = os.getenv("GROQ_BASE_URL") or None
+GROQ_MAX_CONNECTIONS  = int(os.getenv("GROQ_MAX_CONNECTIONS", "20"))
+GROQ_MAX_KEEPALIVE    = int(os.getenv("GROQ_MAX_KEEPALIVE", str(GROQ_MAX_CONNECTIONS)))
+GROQ_KEEPALIVE_EXPIRY = float(os.getenv("GROQ_KEEPALIVE_EXPIRY", "30"))
+GROQ_CONCURRENCY      = int(os.getenv("GROQ_CONCURRENCY", "16"))
+GROQ_TIMEOUT          = float(os.getenv("GROQ_TIMEOUT", "60"))
+
+# تيليجرام: ميزانية إرسال عامة (رسالة/ثانية) ولكل محادثة (رسالة/دقيقة؛ المجموعات أبطأ)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE   = float(os.getenv("TG_CHAT_RATE", "60"))
+TG_GROUP_RATE  = float(os.getenv("TG_GROUP_RATE", "20"))
+TG_CHAT_BURST  = float(os.getenv("TG_CHAT_BURST", "8"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# حدود Groq لكل نموذج: (طلبات/دقيقة، توكنات/دقيقة)، 0 = بدون حد
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "12000"))
+GROQ_TPM_FAST = int(os.getenv("GROQ_TPM_FAST", "6000" if GROQ_TPM else "0"))
+GROQ_LIMITS = {
+    "llama-3.3-70b-versatile":        (GROQ_RPM, GROQ_TPM),
+    "llama-3.1-8b-instant":           (GROQ_RPM, GROQ_TPM_FAST),
+    "llama-4-scout-17b-16e-instruct": (GROQ_RPM, 30000),
+    "whisper-large-v3":               (20, 0),
+}
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "4"))
+
+# مستويات النماذج، ولكل موضع استدعاء مستوياته بالترتيب: الأول مفضّل والبقية احتياط
+# عند الخطأ أو البطء (MODEL_ROUTE_<SITE>=fast,large يغيّر الترتيب)
+MODEL_TIERS = {
+    "fast":  os.getenv("MODEL_FAST", "llama-3.1-8b-instant"),
+    "large": os.getenv("MODEL_LARGE", "llama-3.3-70b-versatile"),
+}
+MODEL_ROUTES = {site: tuple(t.strip() for t in os.getenv(f"MODEL_ROUTE_{site.upper()}", tiers).split(","))
+                for site, tiers in {
+    "keywords":   "fast,large",
+    "summary":    "fast,large",
+    "executor":   "fast,large",
+    "quick":      "fast,large",
+    "search":     "large,fast",
+    "researcher": "large,fast",
+    "programmer": "large",          # جودة الكود لا تُخفّض
+}.items()}
+# نموذج متوسط زمن استجابته (EWMA) أو انتظاره المتوقع في طابور الحدود فوق MODEL_SLOW_SEC يتأخر
+# خلف الاحتياط؛ بعد الخطأ يتأخر MODEL_COOLDOWN ثانية؛ وأول رد من غير الأخير مقيد بـ MODEL_TIMEOUT
+MODEL_SLOW_SEC = float(os.getenv("MODEL_SLOW_SEC", "6"))
+MODEL_COOLDOWN = float(os.getenv("MODEL_COOLDOWN", "30"))
+MODEL_TIMEOUT  = float(os.getenv("MODEL_TIMEOUT", "20"))
+
+# أولويات الطلبات: الرد على المستخدم قبل المهام الخلفية
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND  = 1
+
+# كاش ردود النماذج (اختياري لكل استدعاء): ذاكرة LRU + جدول SQLite، ومدة صلاحية لكل موضع استدعاء
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_ITEMS   = int(os.getenv("LLM_CACHE_ITEMS", "512"))
+LLM_CACHE_TTL = {  # بالثواني، 0 = بدون كاش
+    "keywords": int(os.getenv("LLM_CACHE_TTL_KEYWORDS", "86400")),
+    "quick":    int(os.getenv("LLM_CACHE_TTL_QUICK", "600")),
+    "summary":  int(os.getenv("LLM_CACHE_TTL_SUMMARY", "3600")),
+}
+
+# الوسائط: أقصى حجم للتنزيل (حد getFile في Bot API = 20MB)، مدة كاش التفريغ/التحليل
+# (بمفتاح file_unique_id أو hash المحتوى)، وأقصى بُعد للصورة المرسلة لنموذج الرؤية
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_MB", "20")) * 1024 * 1024
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", str(30 * 86400)))
+IMAGE_MAX_SIDE  = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_QUALITY   = int(os.getenv("IMAGE_QUALITY", "85"))
+
+# البحث: مدة صلاحية النتائج في الكاش + عدد الاستعلامات المحفوظة
+SEARCH_CACHE_TTL   = int(os.getenv("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_ITEMS = int(os.getenv("SEARCH_CACHE_ITEMS", "256"))
+
+# قاعدة البيانات: عدد threads القراءة + أقصى عدد عمليات كتابة في transaction واحدة
+DB_READERS     = int(os.getenv("DB_READERS", "4"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+
+# الاحتفاظ: أقصى عدد صفوف لكل محادثة في كل جدول (0 = بدون حد). الحذف لا يتم مع كل إدراج
+# بل في مهمة ضغط دورية كل COMPACT_INTERVAL ثانية، COMPACT_BATCH محادثة في كل transaction
+RETENTION = {
+    "messages": int(os.getenv("RETENTION_MESSAGES", "60")),
+    "lessons":  int(os.getenv("RETENTION_LESSONS", "20")),
+}
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "60"))
+COMPACT_BATCH    = int(os.getenv("COMPACT_BATCH", "200"))
+
+# RAG: تقسيم المستندات + فهرس متجهات محلي لكل محادثة
+VECTOR_DIR       = os.getenv("VECTOR_DIR", os.path.join(os.path.dirname(DB_PATH), "vectors"))
+EMBED_DIM        = int(os.getenv("EMBED_DIM", "2048"))
+CHUNK_CHARS      = int(os.getenv("CHUNK_CHARS", "800"))
+CHUNK_OVERLAP    = int(os.getenv("CHUNK_OVERLAP", "150"))
+RAG_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "600"))
+
+# المستندات: قراءة متدفقة (ملف مؤقت على القرص بعد DOC_SPOOL_BYTES)، DOC_BATCH جزء لكل كتابة،
+# وإضافة المتجهات كل DOC_VECTOR_BATCH جزء؛ JSON يُحلل كاملاً حتى DOC_JSON_MAX وإلا يُعامل كنص؛
+# السطر الأطول من DOC_LINE_MAX حرف (JSON مضغوط، نص بلا أسطر) يُقرأ على أجزاء
+DOC_MAX_BYTES    = int(os.getenv("DOC_MAX_MB", "20")) * 1024 * 1024
+DOC_SPOOL_BYTES  = int(os.getenv("DOC_SPOOL_KB", "1024")) * 1024
+DOC_JSON_MAX     = int(os.getenv("DOC_JSON_MAX_KB", "4096")) * 1024
+DOC_BATCH        = int(os.getenv("DOC_BATCH", "64"))
+DOC_VECTOR_BATCH = int(os.getenv("DOC_VECTOR_BATCH", "1024"))
+DOC_LINE_MAX     = int(os.getenv("DOC_LINE_MAX_KB", "64")) * 1024
+DOC_FORMATS = {  # الامتداد → طريقة القراءة
+    ".txt": "text", ".md": "text", ".markdown": "text", ".rst": "text", ".log": "text",
+    ".csv": "csv", ".tsv": "csv", ".json": "json", ".jsonl": "jsonl", ".ndjson": "jsonl",
+    **dict.fromkeys((".py", ".js", ".ts", ".jsx", ".tsx", ".java", ".kt", ".c", ".h", ".cpp",
+                     ".hpp", ".cs", ".go", ".rs", ".rb", ".php", ".swift", ".sh", ".sql",
+                     ".html", ".css", ".xml", ".yaml", ".yml", ".toml", ".ini", ".lua", ".r"), "text"),
+}
+
+# السياق: ميزانية توكنات لكل قسم؛ الأقسام تُملأ بهذا الترتيب والفائض ينتقل للقسم التالي
+CONTEXT_BUDGETS = {
+    "knowledge": RAG_TOKEN_BUDGET,
+    "recent":    int(os.getenv("CONTEXT_RECENT_TOKENS", "500")),
+    "summaries": int(os.getenv("CONTEXT_SUMMARY_TOKENS", "300")),
+    "lessons":   int(os.getenv("CONTEXT_LESSON_TOKENS", "100")),
+}
+# النسخة المختصرة من نفس السياق (للمبرمج: ملخص الباحث يحمل الباقي)
+CONTEXT_COMPACT_TOKENS = int(os.getenv("CONTEXT_COMPACT_TOKENS", "400"))
+
+# البث التدريجي: أقل مدة بين تعديلين لنفس الرسالة + حد طول الرسالة الواحدة
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_MSG_LIMIT     = 4000
+
+# كاش أقسام السياق في الذاكرة (عدد المحادثات قبل الإخلاء LRU)
+CONTEXT_CACHE_CHATS = int(os.getenv("CONTEXT_CACHE_CHATS", "256"))
+
+# التلخيص في الخلفية: ملخص لكل SUMMARY_EVERY رسالة بعد آخر ملخص، وكل SUMMARY_ROLLUP ملخصات
+# من نفس المستوى تُدمج في ملخص أعلى (حتى SUMMARY_LEVELS مستويات)، بعدد محدود من المهام المتزامنة
+SUMMARY_EVERY   = int(os.getenv("SUMMARY_EVERY", "20"))
+SUMMARY_ROLLUP  = int(os.getenv("SUMMARY_ROLLUP", "4"))
+SUMMARY_LEVELS  = int(os.getenv("SUMMARY_LEVELS", "3"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "1"))
+
+# الموجّه: local = قواعد + naive Bayes محلي، legacy = القاعدة القديمة، team = الفريق دائماً.
+# ثقة النموذج الأقل من ROUTER_MIN_CONFIDENCE تذهب لمسار البحث؛ القرار يُحفظ لكل محادثة
+# ROUTER_CACHE_TTL ثانية، ورسالة قصيرة خلال ROUTER_FOLLOWUP_SEC بعد طلب للفريق تتبعه
+ROUTER_MODE           = os.getenv("ROUTER", "local")
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.6"))
+ROUTER_CACHE_TTL      = float(os.getenv("ROUTER_CACHE_TTL", "600"))
+ROUTER_CACHE_ITEMS    = int(os.getenv("ROUTER_CACHE_ITEMS", "4096"))
+ROUTER_FOLLOWUP_SEC   = float(os.getenv("ROUTER_FOLLOWUP_SEC", "300"))
+ROUTER_TRAIN_FILE     = os.getenv("ROUTER_TRAIN_FILE") or None
+
+# تنفيذ الكود: عمليات Python جاهزة مسبقاً + حدود الموارد لكل تشغيل (0 = بدون حد)
+SANDBOX_POOL_SIZE    = int(os.getenv("SANDBOX_POOL_SIZE", "2"))
+SANDBOX_MAX_JOBS     = int(os.getenv("SANDBOX_MAX_JOBS", "4"))
+SANDBOX_TIMEOUT      = float(os.getenv("SANDBOX_TIMEOUT", "30"))
+SANDBOX_CPU_SEC      = int(os.getenv("SANDBOX_CPU_SEC", "20"))
+SANDBOX_MEM_MB       = int(os.getenv("SANDBOX_MEM_MB", "1024"))
+SANDBOX_MAX_FILES    = int(os.getenv("SANDBOX_MAX_FILES", "64"))
+SANDBOX_FILE_MB      = int(os.getenv("SANDBOX_FILE_MB", "16"))
+
+# ناتج التنفيذ: يُقرأ تدريجياً؛ تُقتل العملية بعد EXEC_OUTPUT_LIMIT بايت ويُعرض أوله وآخره فقط
+EXEC_OUTPUT_LIMIT  = int(os.getenv("EXEC_OUTPUT_LIMIT", str(1024 * 1024)))
+EXEC_HEAD_BYTES    = int(os.getenv("EXEC_HEAD_BYTES", "800"))
+EXEC_TAIL_BYTES    = int(os.getenv("EXEC_TAIL_BYTES", "1000"))
+EXEC_SHELL_TIMEOUT = float(os.getenv("EXEC_SHELL_TIMEOUT", "20"))
+
+# التوازي: حد أقصى لعدد المحادثات التي تُعالج في نفس الوقت + حجم طابور كل محادثة
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", "8"))
+CHAT_QUEUE_SIZE      = int(os.getenv("CHAT_QUEUE_SIZE", "5"))
+# حد التحديثات المنتظرة في كل الطوابير: بعده يتوقف الجلب/الاستقبال حتى تفرغ
+DISPATCH_MAX_PENDING = int(os.getenv("DISPATCH_MAX_PENDING", "200"))
+
+# تعدد العمليات: WORKERS > 1 = عملية استقبال واحدة (polling/webhook) + WORKERS عملية معالجة.
+# كل محادثة لعامل ثابت (hash متسق لـ chat_id) عبر socketpair محلي؛ العامل الذي يتوقف يُعاد تشغيله
+# (تأخير متزايد حتى WORKER_RESTART_MAX) وتُعاد له تحديثاته غير المكتملة حتى WORKER_MAX_DELIVERIES مرة.
+# ميزانيات تيليجرام وGroq العامة تُقسم بين العمّال، وحدود كل محادثة تبقى كما هي
+WORKERS               = int(os.getenv("WORKERS", "1"))
+WORKER_VNODES         = int(os.getenv("WORKER_VNODES", "64"))
+WORKER_MAX_DELIVERIES = int(os.getenv("WORKER_MAX_DELIVERIES", "2"))
+WORKER_RESTART_MAX    = float(os.getenv("WORKER_RESTART_MAX", "30"))
+
+# القياس: منفذ Prometheus محلي (0 = معطّل) + طباعة المراحل الأبطأ من TRACE_SLOW_SEC
+METRICS_HOST   = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT   = int(os.getenv("METRICS_PORT", "0"))
+TRACE_SLOW_SEC = float(os.getenv("TRACE_SLOW_SEC", "10"))
+
+# استقبال التحديثات: polling (get_updates) أو webhook (خادم HTTP محلي يستقبل من تيليجرام)
+UPDATE_MODE     = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL     = os.getenv("WEBHOOK_URL", "")  # الرابط العام المسجل لدى تيليجرام
+WEBHOOK_PATH    = urlsplit(WEBHOOK_URL).path or "/telegram"
+WEBHOOK_LISTEN  = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT    = int(os.getenv("PORT", "8080"))
+WEBHOOK_SECRET  = (os.getenv("WEBHOOK_SECRET")
+                   or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()[:48])
+WEBHOOK_QUEUE   = int(os.getenv("WEBHOOK_QUEUE", "256"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 # ================================================================
 # 2. الوكلاء الثلاثة
@@ -45,9 +258,219 @@ AGENTS = {
 # ================================================================
 # 3. قاعدة البيانات (ذاكرة دائمة + RAG + ملخصات)
 # ================================================================
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# --- تطبيع النص العربي (للفهرسة والبحث) ---
+_AR_DIACRITICS = re.compile(r"[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")
+_AR_LETTERS    = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+                                "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي"})
+_AR_PREFIX     = re.compile(r"\b(?:وال|بال|كال|فال|لل|ال)(?=\w{2,})")
+
+def normalize_arabic(text: str) -> str:
+    """يزيل التشكيل والتطويل ويوحد أشكال الحروف ويحذف أداة التعريف"""
+    if not text:
+        return ""
+    text = _AR_DIACRITICS.sub("", text).translate(_AR_LETTERS).lower()
+    return _AR_PREFIX.sub("", text)
+
+def _fts_query(chat_id: int, query: str, max_terms: int = 12) -> str:
+    """يبني تعبير MATCH: عمود المحادثة AND (كلمة1 OR كلمة2 ...)"""
+    terms = []
+    for tok in re.findall(r"\w+", normalize_arabic(query)):
+        if len(tok) < 2 or tok in terms:
+            continue
+        terms.append(tok)
+        if len(terms) >= max_terms:
+            break
+    if not terms:
+        return ""
+    words = " OR ".join(f'"{t}"*' if len(t) >= 3 else f'"{t}"' for t in terms)
+    return f"chat:{_fts_chat(chat_id)} AND ({words})"
+
+def _fts_chat(chat_id: int) -> str:
+    # رمز واحد لكل محادثة (المعرفات السالبة للمجموعات تحتوي "-")
+    return "c" + str(chat_id).replace("-", "n")
+
+class MemoryDB:
+    """
+    طبقة اتصال مشتركة بقاعدة البيانات بدل فتح اتصال جديد في كل دالة:
+    - وضع WAL: القراءة لا تنتظر الكتابة
+    - كاتب واحد (thread) يجمع الإدراجات في transaction واحدة
+    - حذف الاحتفاظ خارج مسار الإدراج: compact() دورياً على المحادثات المعلّمة فقط
+    - القراءة تتم في thread pool باتصال دائم لكل thread فلا تحجب حلقة asyncio
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS, batch: int = DB_WRITE_BATCH):
+        self.path    = path
+        self.batch   = batch
+        self._local  = threading.local()
+        self._pool   = ThreadPoolExecutor(readers, thread_name_prefix="db-read")
+        self._writes: SimpleQueue = SimpleQueue()
+        self._writer: threading.Thread | None = None
+        self._dirty: dict[str, set] = {}   # يُقرأ ويُكتب من thread الكاتب فقط
+        self.compacted = 0
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # تستخدمها triggers فهرس FTS
+        conn.create_function("ar_norm", 1, normalize_arabic, deterministic=True)
+        return conn
+
+    def start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+            self._writer.start()
+
+    def close(self):
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        self._pool.shutdown(wait=True)
+
+    # --- القراءة ---
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+        return conn
+
+    async def read(self, fn, *args):
+        """ينفذ fn(conn, *args) في thread قراءة ويعيد النتيجة"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, lambda: fn(self._reader(), *args))
+
+    # --- الكتابة ---
+    async def write(self, fn, *args, compact: tuple | None = None):
+        """
+        يرسل fn(conn, *args) للكاتب وينتظر نتيجتها.
+        compact = (table, chat_id) → تُعلَّم المحادثة لمهمة الضغط القادمة بدل الحذف هنا
+        """
+        loop = asyncio.get_running_loop()
+        fut  = loop.create_future()
+        self._writes.put((fn, args, compact, loop, fut))
+        return await fut
+
+    def _write_loop(self):
+        conn = self.connect()
+        conn.isolation_level = None  # نتحكم بالـ transactions يدوياً
+        while True:
+            job = self._writes.get()
+            if job is None:
+                break
+            jobs, stop = [job], False
+            while len(jobs) < self.batch:
+                try:
+                    job = self._writes.get_nowait()
+                except Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            try:
+                self._run_batch(conn, jobs)
+            except Exception as e:
+                # مثل SQLITE_BUSY بعد انتهاء المهلة: تفشل هذه الدفعة فقط ويستمر الكاتب
+                print(f"DB batch error: {e}")
+                if conn.in_transaction:
+                    try:
+                        conn.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                for _, _, _, loop, fut in jobs:
+                    loop.call_soon_threadsafe(_resolve_future, fut, None, e)
+            if stop:
+                break
+        conn.close()
+
+    def _run_batch(self, conn: sqlite3.Connection, jobs: list):
+        results = []
+        dirty   = []
+        # IMMEDIATE: قفل الكتابة يُطلب من البداية فينتظر busy_timeout عند وجود كاتب آخر
+        # (عمليات WORKERS) بدل فشل ترقية قراءة إلى كتابة بـ SQLITE_BUSY
+        conn.execute("BEGIN IMMEDIATE")
+        for fn, args, mark, loop, fut in jobs:
+            # savepoint لكل عملية: فشل واحدة (مثل IntegrityError) لا يلغي الدفعة
+            conn.execute("SAVEPOINT job")
+            try:
+                res = fn(conn, *args)
+                conn.execute("RELEASE job")
+                results.append((loop, fut, res, None))
+                if mark:
+                    dirty.append(mark)
+            except Exception as e:
+                conn.execute("ROLLBACK TO job")
+                conn.execute("RELEASE job")
+                results.append((loop, fut, None, e))
+        try:
+            conn.execute("COMMIT")
+            for table, chat_id in dirty:
+                self._dirty.setdefault(table, set()).add(chat_id)
+        except Exception as e:
+            print(f"DB batch error: {e}")
+            conn.execute("ROLLBACK")
+            results = [(loop, fut, None, e) for loop, fut, _, _ in results]
+        for loop, fut, res, err in results:
+            loop.call_soon_threadsafe(_resolve_future, fut, res, err)
+
+    # --- الضغط (الاحتفاظ) ---
+    def _take_dirty(self, conn: sqlite3.Connection, limits: dict, full: bool, owns=None) -> dict:
+        """يعمل في thread الكاتب: يسلّم المحادثات المعلّمة (أو كل المحادثات المتجاوزة للحد)"""
+        dirty, self._dirty = self._dirty, {}
+        if full:
+            for table, keep in limits.items():
+                if keep:
+                    dirty.setdefault(table, set()).update(r[0] for r in conn.execute(
+                        f"SELECT chat_id FROM {table} GROUP BY chat_id HAVING COUNT(*) > ?", (keep,))
+                        if owns is None or owns(r[0]))
+        return {t: sorted(ids) for t, ids in dirty.items() if limits.get(t)}
+
+    @staticmethod
+    def _trim(conn: sqlite3.Connection, table: str, keep: int, chat_ids: list) -> int:
+        # فهرس (chat_id, id): إيجاد حد الاحتفاظ والحذف نطاق واحد على الفهرس لكل محادثة
+        deleted = 0
+        for chat_id in chat_ids:
+            deleted += conn.execute(f"""DELETE FROM {table} WHERE chat_id=? AND id <
+                                        (SELECT id FROM {table} WHERE chat_id=?
+                                         ORDER BY id DESC LIMIT 1 OFFSET ?)""",
+                                    (chat_id, chat_id, keep - 1)).rowcount
+        return deleted
+
+    async def compact(self, limits: dict | None = None, full: bool = False,
+                      batch: int = COMPACT_BATCH, owns=None, purge: bool = True) -> int:
+        """
+        يحذف الصفوف الزائدة عن حد الاحتفاظ للمحادثات التي كُتب فيها منذ آخر ضغط
+        (full = كل المحادثات، عند بدء التشغيل) + مدخلات llm_cache المنتهية (purge).
+        كل batch محادثات في job كتابة مستقل فلا تنتظر الكتابات العادية طويلاً.
+        owns(chat_id) يحصر الفحص الكامل في محادثات هذا العامل (وضع WORKERS)
+        """
+        limits = RETENTION if limits is None else limits
+        dirty = await self.write(self._take_dirty, limits, full, owns)
+        deleted = 0
+        for table, chat_ids in dirty.items():
+            for i in range(0, len(chat_ids), batch):
+                deleted += await self.write(self._trim, table, limits[table], chat_ids[i:i + batch])
+        def expire(conn):
+            return conn.execute("DELETE FROM llm_cache WHERE expires<?", (time.time(),)).rowcount
+        if purge:
+            deleted += await self.write(expire)
+        self.compacted += deleted
+        return deleted
+
+def _resolve_future(fut: asyncio.Future, res, err):
+    if fut.done():
+        return
+    if err is not None:
+        fut.set_exception(err)
+    else:
+        fut.set_result(res)
+
+db = MemoryDB(DB_PATH)
+
+# --- المخطط: migrations مرقّمة، رقم آخر واحدة مطبقة في PRAGMA user_version ---
+# كل خطوة تعمل مرة واحدة داخل transaction؛ الخطوات الأولى idempotent لقواعد ما قبل الترقيم
+def _m1_base(c: sqlite3.Cursor):
     c.execute("""CREATE TABLE IF NOT EXISTS messages
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   chat_id INTEGER, role TEXT, content TEXT,
@@ -65,284 +488,2431 @@ def init_db():
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   chat_id INTEGER, lesson TEXT,
                   ts DATETIME DEFAULT CURRENT_TIMESTAMP)""")
-    conn.commit()
+    c.execute("""CREATE TABLE IF NOT EXISTS bot_state
+                 (key TEXT PRIMARY KEY, value TEXT)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS llm_cache
+                 (key TEXT PRIMARY KEY, value TEXT, expires REAL)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS knowledge_chunks
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  chat_id INTEGER, knowledge_id INTEGER, seq INTEGER, content TEXT)""")
+    # فهرس نصي كامل للمعرفة (نسخة مطبّعة) + triggers للمزامنة مع الإدراج والحذف
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts
+                 USING fts5(chat, title, content, tokenize='unicode61 remove_diacritics 2')""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS knowledge_fts_ai AFTER INSERT ON knowledge BEGIN
+                   INSERT INTO knowledge_fts (rowid, chat, title, content)
+                   VALUES (new.id, 'c' || replace(new.chat_id, '-', 'n'),
+                           ar_norm(new.title), ar_norm(new.content));
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS knowledge_fts_ad AFTER DELETE ON knowledge BEGIN
+                   DELETE FROM knowledge_fts WHERE rowid = old.id;
+                 END""")
+    if not c.execute("SELECT 1 FROM knowledge_fts LIMIT 1").fetchone():
+        c.execute("""INSERT INTO knowledge_fts (rowid, chat, title, content)
+                     SELECT id, 'c' || replace(chat_id, '-', 'n'), ar_norm(title), ar_norm(content)
+                     FROM knowledge""")
+
+def _m2_summary_levels(c: sqlite3.Cursor):
+    # level: 0 = ملخص رسائل، 1+ = دمج ملخصات؛ upto_id = آخر رسالة يغطيها
+    if "level" not in {row[1] for row in c.execute("PRAGMA table_info(summaries)")}:
+        c.execute("ALTER TABLE summaries ADD COLUMN level INTEGER DEFAULT 0")
+        c.execute("ALTER TABLE summaries ADD COLUMN upto_id INTEGER")
+    # آخر رسالة تم تلخيصها لكل محادثة (watermark)
+    c.execute("""CREATE TABLE IF NOT EXISTS summary_state
+                 (chat_id INTEGER PRIMARY KEY, last_msg_id INTEGER)""")
+
+def _m3_indexes(c: sqlite3.Cursor):
+    # كل الاستعلامات الساخنة تبحث بـ chat_id وترتب بـ id (آخر N / ما بعد الـ watermark)
+    for tbl in ("messages", "summaries", "knowledge", "lessons"):
+        c.execute(f"CREATE INDEX IF NOT EXISTS {tbl}_chat_id ON {tbl} (chat_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS knowledge_chunks_chat ON knowledge_chunks (chat_id, knowledge_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS llm_cache_expires ON llm_cache (expires)")
+
+def _m4_chunk_dedup(c: sqlite3.Cursor):
+    # hash لكل جزء (فريد داخل المحادثة): إعادة رفع مستند معدّل تخزن الأجزاء المتغيرة فقط
+    if "hash" not in {row[1] for row in c.execute("PRAGMA table_info(knowledge_chunks)")}:
+        c.execute("ALTER TABLE knowledge_chunks ADD COLUMN hash TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS knowledge_chunks_hash ON knowledge_chunks (chat_id, hash)")
+    # البحث النصي على مستوى الأجزاء بدل المستند كاملاً (المستند لم يعد يُخزن كنص واحد)
+    c.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
+                 USING fts5(chat, title, content, tokenize='unicode61 remove_diacritics 2')""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS chunks_fts_ai AFTER INSERT ON knowledge_chunks BEGIN
+                   INSERT INTO chunks_fts (rowid, chat, title, content)
+                   VALUES (new.id, 'c' || replace(new.chat_id, '-', 'n'),
+                           ar_norm((SELECT title FROM knowledge WHERE id = new.knowledge_id)),
+                           ar_norm(new.content));
+                 END""")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS chunks_fts_ad AFTER DELETE ON knowledge_chunks BEGIN
+                   DELETE FROM chunks_fts WHERE rowid = old.id;
+                 END""")
+    c.execute("""INSERT INTO chunks_fts (rowid, chat, title, content)
+                 SELECT c.id, 'c' || replace(c.chat_id, '-', 'n'), ar_norm(k.title), ar_norm(c.content)
+                 FROM knowledge_chunks c JOIN knowledge k ON k.id = c.knowledge_id""")
+    c.execute("DROP TRIGGER IF EXISTS knowledge_fts_ai")
+    c.execute("DROP TRIGGER IF EXISTS knowledge_fts_ad")
+    c.execute("DROP TABLE IF EXISTS knowledge_fts")
+
+def _m5_knowledge_links(c: sqlite3.Cursor):
+    # مستند ↔ جزء: الجزء يُخزن مرة واحدة في المحادثة (hash) وقد تستخدمه عدة مستندات، فلا يُحذف
+    # إلا بعد أن يتركه آخرها؛ knowledge_chunks.knowledge_id يبقى المستند الذي يُعرض عنوانه مع الجزء
+    c.execute("""CREATE TABLE IF NOT EXISTS knowledge_links
+                 (chat_id INTEGER, knowledge_id INTEGER, chunk_id INTEGER, seq INTEGER,
+                  PRIMARY KEY (knowledge_id, chunk_id)) WITHOUT ROWID""")
+    c.execute("CREATE INDEX IF NOT EXISTS knowledge_links_chunk ON knowledge_links (chunk_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS knowledge_links_chat ON knowledge_links (chat_id)")
+    c.execute("""INSERT OR IGNORE INTO knowledge_links (chat_id, knowledge_id, chunk_id, seq)
+                 SELECT chat_id, knowledge_id, id, seq FROM knowledge_chunks""")
+    # نقل الجزء لمستند آخر يحدّث عنوانه في FTS
+    c.execute("""CREATE TRIGGER IF NOT EXISTS chunks_fts_au AFTER UPDATE OF knowledge_id ON knowledge_chunks BEGIN
+                   DELETE FROM chunks_fts WHERE rowid = old.id;
+                   INSERT INTO chunks_fts (rowid, chat, title, content)
+                   VALUES (new.id, 'c' || replace(new.chat_id, '-', 'n'),
+                           ar_norm((SELECT title FROM knowledge WHERE id = new.knowledge_id)),
+                           ar_norm(new.content));
+                 END""")
+
+def _m6_update_queue(c: sqlite3.Cursor):
+    # polling: تحديثات استُلمت من تيليجرام (وأُكّد استلامها) ولم تنتهِ معالجتها بعد، تُعاد بعد إعادة التشغيل
+    c.execute("CREATE TABLE IF NOT EXISTS update_queue (update_id INTEGER PRIMARY KEY, data TEXT)")
+
+MIGRATIONS = [_m1_base, _m2_summary_levels, _m3_indexes, _m4_chunk_dedup, _m5_knowledge_links,
+              _m6_update_queue]
+
+def migrate(conn: sqlite3.Connection, target: int | None = None) -> int:
+    """يطبق الخطوات الناقصة حتى target (افتراضياً الأخيرة) ويعيد رقم النسخة"""
+    target = len(MIGRATIONS) if target is None else target
+    conn.isolation_level = None
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for n in range(version + 1, target + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            MIGRATIONS[n - 1](conn.cursor())
+            conn.execute(f"PRAGMA user_version = {n}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"🗄️ migration {n}: {MIGRATIONS[n - 1].__name__}")
+        version = n
+    return version
+
+def init_db():
+    conn = db.connect()
+    migrate(conn)
     conn.close()
+    db.start()
+
+async def compaction_loop(interval: float = COMPACT_INTERVAL, owns=None, purge: bool = True):
+    """
+    ضغط دوري: أول مرة لكل المحادثات (قد تكون من تشغيل سابق)، ثم المعلّمة فقط.
+    في وضع WORKERS كل عامل يضغط محادثاته (owns)، وعامل واحد فقط ينظف llm_cache المشترك
+    """
+    full = True
+    while True:
+        try:
+            deleted = await db.compact(full=full, owns=owns, purge=purge)
+            full = False
+            if deleted:
+                print(f"🧹 compaction: حُذف {deleted} صف")
+        except Exception as e:
+            print(f"Compaction error: {e}")
+        await asyncio.sleep(interval)
 
 # --- رسائل ---
-def save_msg(chat_id, role, content):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO messages (chat_id,role,content) VALUES (?,?,?)",
-              (chat_id, role, content))
-    c.execute("""DELETE FROM messages WHERE chat_id=? AND id NOT IN
-                 (SELECT id FROM messages WHERE chat_id=? ORDER BY ts DESC LIMIT 60)""",
-              (chat_id, chat_id))
-    conn.commit()
-    c.execute("SELECT COUNT(*) FROM messages WHERE chat_id=?", (chat_id,))
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def get_recent_msgs(chat_id, limit=10):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT role,content FROM messages WHERE chat_id=? ORDER BY ts DESC LIMIT ?",
-              (chat_id, limit))
-    rows = list(reversed(c.fetchall()))
-    conn.close()
-    return "\n".join(f"{r[0]}: {r[1]}" for r in rows)
+async def save_msg(chat_id, role, content):
+    """يعيد عدد رسائل المحادثة التي لم تُلخص بعد (بعد الـ watermark)"""
+    def op(conn):
+        conn.execute("INSERT INTO messages (chat_id,role,content) VALUES (?,?,?)",
+                     (chat_id, role, content))
+        return conn.execute("""SELECT COUNT(*) FROM messages WHERE chat_id=? AND id >
+                                 COALESCE((SELECT last_msg_id FROM summary_state WHERE chat_id=?), 0)""",
+                            (chat_id, chat_id)).fetchone()[0]
+    pending = await db.write(op, compact=("messages", chat_id))
+    context_cache.add_message(chat_id, role, content)
+    # الزائد عن حد الاحتفاظ سيُحذف في الضغط القادم فلا يُحسب
+    keep = RETENTION.get("messages")
+    return min(pending, keep) if keep else pending
 
 # --- ملخصات ---
-def save_summary(chat_id, summary):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO summaries (chat_id,summary) VALUES (?,?)", (chat_id, summary))
-    c.execute("""DELETE FROM summaries WHERE chat_id=? AND id NOT IN
-                 (SELECT id FROM summaries WHERE chat_id=? ORDER BY ts DESC LIMIT 10)""",
-              (chat_id, chat_id))
-    conn.commit()
-    conn.close()
+# الملخصات المتبقية (غير المدموجة) لكل محادثة مرتبة زمنياً حسب آخر رسالة تغطيها
+_SUMMARY_ORDER = "ORDER BY COALESCE(upto_id, 0) DESC, id DESC"
 
-def get_summaries(chat_id, limit=3):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT summary FROM summaries WHERE chat_id=? ORDER BY ts DESC LIMIT ?",
-              (chat_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return "\n---\n".join(r[0] for r in reversed(rows))
+async def save_summary(chat_id, summary, level=0, upto_id=None, replaces=()):
+    """
+    level 0 + upto_id يحرّك الـ watermark في نفس الـ transaction.
+    replaces = ملخصات الطبقة الأدنى التي دُمجت في هذا الملخص (تُحذف).
+    """
+    def op(conn):
+        conn.execute("INSERT INTO summaries (chat_id,summary,level,upto_id) VALUES (?,?,?,?)",
+                     (chat_id, summary, level, upto_id))
+        if replaces:
+            conn.execute(f"DELETE FROM summaries WHERE id IN ({','.join('?' * len(replaces))})",
+                         tuple(replaces))
+        if level == 0 and upto_id is not None:
+            conn.execute("""INSERT INTO summary_state (chat_id,last_msg_id) VALUES (?,?)
+                            ON CONFLICT(chat_id) DO UPDATE
+                            SET last_msg_id = MAX(last_msg_id, excluded.last_msg_id)""",
+                         (chat_id, upto_id))
+    await db.write(op)
+    if not replaces:
+        context_cache.add_summary(chat_id, summary)
+
+async def get_summary_frontier(chat_id):
+    """(id, level, upto_id, summary) الأقدم أولاً"""
+    def op(conn):
+        return conn.execute(f"SELECT id, level, upto_id, summary FROM summaries WHERE chat_id=? "
+                            f"{_SUMMARY_ORDER}", (chat_id,)).fetchall()
+    return list(reversed(await db.read(op)))
+
+async def get_unsummarized(chat_id, limit):
+    """أقدم limit رسائل بعد الـ watermark: [(id, role, content)]"""
+    def op(conn):
+        return conn.execute("""SELECT id, role, content FROM messages WHERE chat_id=? AND id >
+                                 COALESCE((SELECT last_msg_id FROM summary_state WHERE chat_id=?), 0)
+                               ORDER BY id LIMIT ?""", (chat_id, chat_id, limit)).fetchall()
+    return await db.read(op)
 
 # --- RAG ---
-def save_knowledge(chat_id, title, content):
-    h = hashlib.md5(content.encode()).hexdigest()
-    conn = sqlite3.connect(DB_PATH)
+async def search_knowledge(chat_id, query, limit=3):
+    """بحث FTS5 في الأجزاء مرتب بـ BM25 (العنوان أثقل وزناً من المحتوى)"""
+    match = _fts_query(chat_id, query)
+    if not match:
+        return []
+    def op(conn):
+        return conn.execute("""SELECT k.title, c.content
+                               FROM chunks_fts f
+                               JOIN knowledge_chunks c ON c.id = f.rowid
+                               JOIN knowledge k ON k.id = c.knowledge_id
+                               WHERE chunks_fts MATCH ?
+                               ORDER BY bm25(chunks_fts, 0.0, 4.0, 1.0)
+                               LIMIT ?""",
+                            (match, limit)).fetchall()
+    return await db.read(op)
+
+async def list_knowledge(chat_id):
+    def op(conn):
+        return conn.execute("SELECT id,title FROM knowledge WHERE chat_id=? ORDER BY id DESC",
+                            (chat_id,)).fetchall()
+    return await db.read(op)
+
+# --- دروس ---
+async def save_lesson(chat_id, lesson):
+    def op(conn):
+        conn.execute("INSERT INTO lessons (chat_id,lesson) VALUES (?,?)", (chat_id, lesson))
+    await db.write(op, compact=("lessons", chat_id))
+    context_cache.add_lesson(chat_id, lesson)
+
+# --- حالة البوت (مثل آخر update_id) ---
+async def get_state(key, default=None):
+    def op(conn):
+        return conn.execute("SELECT value FROM bot_state WHERE key=?", (key,)).fetchone()
+    row = await db.read(op)
+    return row[0] if row else default
+
+async def set_state(key, value):
+    def op(conn):
+        conn.execute("INSERT OR REPLACE INTO bot_state (key,value) VALUES (?,?)", (key, str(value)))
+    await db.write(op)
+
+async def clear_all(chat_id):
+    def op(conn):
+        for tbl in ("messages","summaries","summary_state","knowledge","knowledge_chunks","knowledge_links",
+                    "lessons"):
+            conn.execute(f"DELETE FROM {tbl} WHERE chat_id=?", (chat_id,))
+    await db.write(op)
+    context_cache.reset(chat_id)
+    await vector_store.drop(chat_id)
+
+async def get_stats(chat_id):
+    def op(conn):
+        return tuple(conn.execute(f"SELECT COUNT(*) FROM {tbl} WHERE chat_id=?",
+                                  (chat_id,)).fetchone()[0]
+                     for tbl in ("messages", "summaries", "knowledge"))
+    return await db.read(op)
+
+# ================================================================
+# 3.1 فهرس المتجهات (RAG مقسّم، محلي على CPU)
+# ================================================================
+_SENTENCE_END = re.compile(r"(?<=[.!?؟\n])\s+")
+_CONTROL      = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+
+def document_format(file_name: str | None, mime: str | None) -> str | None:
+    """text / csv / json / jsonl حسب الامتداد ثم نوع MIME، أو None إن لم يكن المستند نصياً"""
+    fmt = DOC_FORMATS.get(os.path.splitext(file_name or "")[1].lower())
+    if fmt:
+        return fmt
+    mime = mime or ""
+    if mime in ("text/csv", "text/tab-separated-values"):
+        return "csv"
+    if mime == "application/json":
+        return "json"
+    return "text" if mime.startswith("text/") else None
+
+def _flatten_json(obj, path: str = ""):
+    """سطر "المسار: القيمة" لكل قيمة مفردة"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _flatten_json(v, f"{path}.{k}" if path else str(k))
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            yield from _flatten_json(v, f"{path}[{i}]")
+    else:
+        value = json.dumps(obj, ensure_ascii=False)
+        yield f"{path}: {value}" if path else value
+
+def _bounded_lines(text, limit: int = DOC_LINE_MAX):
+    """
+    أسطر ملف نصي بطول ≤ limit: السطر الأطول يُقرأ على دفعات ويُقطع عند آخر نهاية جملة
+    (أو مسافة) في نصفه الثاني، فيتبع القطع المحتوى ولا يتأثر بإضافة نص قبله
+    """
+    rest = ""
+    while part := text.readline(limit):
+        line = rest + part
+        while len(line) > limit:
+            head = line[limit // 2:limit]
+            ends = [m.start() for m in _SENTENCE_END.finditer(head)]
+            at   = ends[-1] if ends else head.rfind(" ")
+            cut  = limit // 2 + at + 1 if at >= 0 else limit
+            yield line[:cut]
+            line = line[cut:]
+        if line.endswith("\n"):
+            yield line
+            rest = ""
+        else:
+            rest = line
+    if rest:
+        yield rest
+
+def iter_document_lines(f, fmt: str):
+    """
+    أسطر نصية من ملف ثنائي مفتوح، تُقرأ وتُفك تدريجياً فلا تتبع الذاكرة حجم الملف ولا طول السطر.
+    csv: كل صف "العمود: القيمة | ..."؛ json/jsonl: أسطر "المسار: القيمة".
+    """
+    size = f.seek(0, io.SEEK_END)
+    f.seek(0)
+    # BOM يُتجاهل والبايتات غير الصالحة تُستبدل
+    text  = io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace", newline=None)
+    lines = _bounded_lines(text)
     try:
-        conn.execute("INSERT INTO knowledge (chat_id,title,content,hash) VALUES (?,?,?,?)",
-                     (chat_id, title, content[:3000], h))
-        conn.commit()
-        result = True
-    except sqlite3.IntegrityError:
-        result = False
-    conn.close()
+        if fmt == "csv":
+            head = next(lines, "")
+            delimiter = "\t" if head.count("\t") > head.count(",") else ","
+            header = next(csv.reader([head], delimiter=delimiter), [])
+            for row in csv.reader(lines, delimiter=delimiter):
+                cols = header + [""] * (len(row) - len(header))
+                yield " | ".join(f"{h}: {v}" if h else v for h, v in zip(cols, row) if v)
+            return
+        if fmt == "jsonl":
+            for line in lines:
+                try:
+                    yield " | ".join(_flatten_json(json.loads(line)))
+                except ValueError:
+                    yield line
+            return
+        if fmt == "json" and size <= DOC_JSON_MAX:
+            try:
+                yield from _flatten_json(json.load(text))
+                return
+            except ValueError:
+                text.seek(0)
+        yield from lines
+    finally:
+        text.detach()
+
+def _pieces(line: str, size: int):
+    """سطر أطول من size يُقسم عند حدود الجمل ثم بالطول"""
+    if len(line) <= size:
+        yield line
+        return
+    for sent in _SENTENCE_END.split(line):
+        while len(sent) > size:
+            yield sent[:size]
+            sent = sent[size:]
+        if sent:
+            yield sent
+
+def chunk_stream(lines, size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """
+    يجمع الأسطر في أجزاء ≤ size ويعيد (hash, نص الجزء مع تداخل من نهاية السابق).
+    الحدود يحددها المحتوى: بعد size/2 يُغلق الجزء عند سطر فارغ أو عنوان أو سطر يحقق شرط crc32،
+    فتعديل في موضع ما يغيّر الأجزاء المجاورة فقط ويبقى hash الباقي كما هو.
+    """
+    buf, n, tail = [], 0, ""
+
+    def flush():
+        nonlocal buf, n, tail
+        body = "\n".join(buf).strip()
+        buf, n = [], 0
+        if not body:
+            return None
+        text = f"{tail} {body}" if tail else body
+        if overlap:
+            t    = body[-overlap:]
+            tail = t[t.find(" ") + 1:] if " " in t else t
+        # الـ hash على النص بدون التداخل وبمسافات موحدة
+        return hashlib.sha1(" ".join(body.split()).encode()).hexdigest(), text
+
+    for raw in lines:
+        line  = _CONTROL.sub("", raw).rstrip()
+        blank = not line.strip()
+        if buf and n >= size // 2 and line.startswith("#") and (chunk := flush()):
+            yield chunk
+        for piece in () if blank else _pieces(line, size):
+            if buf and n + len(piece) + 1 > size and (chunk := flush()):
+                yield chunk
+            buf.append(piece)
+            n += len(piece) + 1
+        if n >= size // 2 and (blank or zlib.crc32(line.encode()) & 7 == 0) and (chunk := flush()):
+            yield chunk
+    if chunk := flush():
+        yield chunk
+
+def embed_texts(texts: list[str], dim: int = EMBED_DIM) -> np.ndarray:
+    """
+    تضمين TF مُجزّأ (hashing trick) لكلمات مطبّعة + أزواج كلمات.
+    النتيجة مطبّعة L2؛ وزن IDF يُطبق لاحقاً على جهة الاستعلام فقط.
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        toks  = re.findall(r"\w+", normalize_arabic(text))
+        feats = toks + [f"{a} {b}" for a, b in zip(toks, toks[1:])]
+        for f in feats:
+            h = zlib.crc32(f.encode())
+            out[row, h % dim] += 1.0 if h & 0x80000000 else -1.0
+        nz = out[row] != 0
+        out[row, nz] = np.sign(out[row, nz]) * (1.0 + np.log(np.abs(out[row, nz])))
+        norm = np.linalg.norm(out[row])
+        if norm:
+            out[row] /= norm
+    return out
+
+class ChatVectorIndex:
+    """
+    فهرس محادثة واحدة على القرص:
+    c<id>.rows.npy (صفوف (id, متجه float16)، memory-mapped) + c<id>.df.npy (تكرار الميزات لـ IDF)
+    الملف بسعة محجوزة مسبقاً: الصفوف الجديدة تُكتب في مكانها، وما بعد آخر صف قيمة id فيه -1 (و0 = جزء محذوف).
+    id والمتجه في نفس الصف، فاستبدال الملف عند التكبير ذرّي ولا يمكن أن يقابل متجهٌ id غيره
+    """
+
+    def __init__(self, root: str, chat_id: int, dim: int):
+        self.base  = os.path.join(root, _fts_chat(chat_id))
+        self.dim   = dim
+        self.dtype = np.dtype([("id", np.int64), ("vec", np.float16, (dim,))])
+        # (vectors, ids, df) تُستبدل معاً حتى لا يرى البحث حالة نصف محدثة
+        self.data  = (np.zeros((0, dim), np.float16), np.zeros(0, np.int64), np.zeros(dim, np.float32))
+        self.texts: dict[int, tuple[str, str]] = {}
+        self._rows = None   # الملف بكامل السعة، memory-mapped للكتابة
+
+    def load(self):
+        if os.path.exists(self.base + ".rows.npy"):
+            self._rows = np.load(self.base + ".rows.npy", mmap_mode="r+")
+            ids  = self._rows["id"]
+            free = np.flatnonzero(ids < 0)
+            n    = int(free[0]) if len(free) else len(ids)
+            self.data = (self._rows["vec"][:n], ids[:n], np.load(self.base + ".df.npy"))
+        elif os.path.exists(self.base + ".vec.npy"):
+            # الصيغة السابقة (vec.npy + ids.npy منفصلين) تُنقل للصيغة الحالية مرة واحدة
+            vecs = np.load(self.base + ".vec.npy", mmap_mode="r")
+            ids  = np.load(self.base + ".ids.npy", mmap_mode="r")
+            n    = min(len(vecs), int(np.argmax(ids < 0)) if (ids < 0).any() else len(ids))
+            self.data = (vecs[:n], ids[:n], np.load(self.base + ".df.npy"))
+            self._grow(max(n, 256))
+            self._remove("vec", "ids")
+
+    def _grow(self, capacity: int, block: int = 4096) -> int:
+        """
+        ينسخ الصفوف الحية (بدون المحذوفة) إلى ملف بسعة capacity يحل محل الحالي باستبدال واحد،
+        ويعيد عددها؛ مضاعفة السعة تجعل كلفة النسخ ثابتة لكل صف في المتوسط.
+        df يُعاد حسابه من الصفوف المنسوخة فيصحح أي انحراف سابق
+        """
+        vecs, ids, _ = self.data
+        os.makedirs(os.path.dirname(self.base), exist_ok=True)
+        tmp  = f"{self.base}.rows.tmp"
+        rows = np.lib.format.open_memmap(tmp, mode="w+", dtype=self.dtype, shape=(capacity,))
+        df   = np.zeros(self.dim, np.float32)
+        n = 0
+        for start in range(0, len(ids), block):
+            live = np.asarray(ids[start:start + block]) > 0
+            part = np.asarray(vecs[start:start + block])[live]
+            rows["vec"][n:n + len(part)] = part
+            rows["id"][n:n + len(part)] = np.asarray(ids[start:start + block])[live]
+            df += (part != 0).sum(axis=0, dtype=np.float32)
+            n  += len(part)
+        rows["id"][n:] = -1
+        rows.flush()
+        self._save_df(df)
+        os.replace(tmp, f"{self.base}.rows.npy")
+        self._rows = rows
+        self.data  = (rows["vec"][:n], rows["id"][:n], df)
+        return n
+
+    def _save_df(self, df: np.ndarray):
+        tmp = f"{self.base}.df.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, df)
+        os.replace(tmp, f"{self.base}.df.npy")
+
+    def append(self, ids: np.ndarray, vecs: np.ndarray):
+        n, k = len(self.data[1]), len(ids)
+        if self._rows is None or n + k > len(self._rows):
+            live = int(np.count_nonzero(self.data[1] > 0))
+            n    = self._grow(max(2 * live, live + k, 256))
+        # المتجه أولاً ثم id: صف كُتب نصفه قبل انهيار يبقى id فيه -1 فلا يُرى
+        self._rows["vec"][n:n + k] = vecs
+        self._rows.flush()
+        self._rows["id"][n:n + k] = ids
+        self._rows.flush()
+        df = self.data[2] + (vecs != 0).sum(axis=0, dtype=np.float32)
+        self._save_df(df)
+        self.data = (self._rows["vec"][:n + k], self._rows["id"][:n + k], df)
+
+    def discard(self, ids):
+        """
+        يحذف أجزاء من الفهرس في مكانها: المتجه يُصفّر (درجته 0 فلا يظهر في البحث) و id = 0.
+        المساحة تُستعاد عند النسخ التالي في _grow
+        """
+        vecs, all_ids, df = self.data
+        rows = np.flatnonzero(np.isin(all_ids, np.fromiter(ids, np.int64)))
+        if not len(rows):
+            return
+        df = df - (np.asarray(vecs[rows]) != 0).sum(axis=0, dtype=np.float32)
+        self._rows["id"][rows] = 0
+        self._rows["vec"][rows] = 0
+        self._rows.flush()
+        self._save_df(df)
+        self.data = (vecs, all_ids, df)
+
+    def _remove(self, *names):
+        for name in names:
+            try:
+                os.unlink(f"{self.base}.{name}.npy")
+            except FileNotFoundError:
+                pass
+
+    def remove(self):
+        self._remove("rows", "df", "vec", "ids")
+
+    def search(self, queries: np.ndarray, k: int, block: int = 4096) -> list[tuple[float, int]]:
+        """تشابه جيب التمام لعدة استعلامات دفعة واحدة؛ درجة الجزء = أعلى درجة بين الاستعلامات"""
+        vectors, ids, df = self.data
+        n = len(ids)
+        if not n:
+            return []
+        q = queries * (np.log((n + 1) / (df + 1)) + 1.0)
+        q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-9)
+        scores = np.empty(n, np.float32)
+        for start in range(0, n, block):
+            part = np.asarray(vectors[start:start + block], dtype=np.float32)
+            scores[start:start + block] = (q @ part.T).max(axis=0)
+        k   = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(ids[i])) for i in top if scores[i] > 0]
+
+class VectorStore:
+    """يدير فهارس المحادثات: تحميل كسول + LRU في الذاكرة + قفل لكل محادثة"""
+
+    def __init__(self, root: str, dim: int = EMBED_DIM, max_loaded: int = 64):
+        self.root       = root
+        self.dim        = dim
+        self.max_loaded = max_loaded
+        self._indexes: OrderedDict[int, ChatVectorIndex] = OrderedDict()
+        self._locks:   dict[int, asyncio.Lock] = {}
+
+    def _lock(self, chat_id: int) -> asyncio.Lock:
+        return self._locks.setdefault(chat_id, asyncio.Lock())
+
+    async def _load(self, chat_id: int) -> ChatVectorIndex:
+        idx = self._indexes.get(chat_id)
+        if idx is not None:
+            self._indexes.move_to_end(chat_id)
+            return idx
+        idx = ChatVectorIndex(self.root, chat_id, self.dim)
+        await asyncio.to_thread(idx.load)
+        def op(conn):
+            return conn.execute("""SELECT c.id, k.title, c.content
+                                   FROM knowledge_chunks c JOIN knowledge k ON k.id = c.knowledge_id
+                                   WHERE c.chat_id=?""", (chat_id,)).fetchall()
+        idx.texts = {cid: (title, text) for cid, title, text in await db.read(op)}
+        self._indexes[chat_id] = idx
+        while len(self._indexes) > self.max_loaded:
+            self._indexes.popitem(last=False)
+        return idx
+
+    async def append(self, chat_id: int, title: str, rows: list[tuple[int, str]]):
+        """يضيف أجزاء محفوظة في knowledge_chunks [(id, نص)] إلى فهرس المحادثة"""
+        if not rows:
+            return
+        vecs = await asyncio.to_thread(embed_texts, [text for _, text in rows], self.dim)
+        async with self._lock(chat_id):
+            idx = await self._load(chat_id)
+            await asyncio.to_thread(idx.append, np.array([cid for cid, _ in rows]), vecs)
+            idx.texts.update({cid: (title, text) for cid, text in rows})
+
+    async def discard(self, chat_id: int, ids: list[int]):
+        """يحذف أجزاء حُذفت من knowledge_chunks من فهرس المحادثة"""
+        if not ids:
+            return
+        async with self._lock(chat_id):
+            idx = await self._load(chat_id)
+            await asyncio.to_thread(idx.discard, ids)
+            for cid in ids:
+                idx.texts.pop(cid, None)
+
+    def retitle(self, chat_id: int, titles: dict[int, str]):
+        """أجزاء انتقلت لمستند آخر: عنوانها في الفهرس المحمّل (غير المحمّل يقرأه من الجداول)"""
+        idx = self._indexes.get(chat_id)
+        if idx is not None:
+            for cid, title in titles.items():
+                if cid in idx.texts:
+                    idx.texts[cid] = (title, idx.texts[cid][1])
+
+    async def search(self, chat_id: int, queries: list[str], k: int = 8) -> list[tuple[float, str, str]]:
+        async with self._lock(chat_id):
+            idx = await self._load(chat_id)
+        if not len(idx.data[1]):
+            return []
+        q    = await asyncio.to_thread(embed_texts, queries, self.dim)
+        hits = await asyncio.to_thread(idx.search, q, k)
+        return [(score, *idx.texts[cid]) for score, cid in hits if cid in idx.texts]
+
+    async def drop(self, chat_id: int):
+        async with self._lock(chat_id):
+            self._indexes.pop(chat_id, None)
+            await asyncio.to_thread(ChatVectorIndex(self.root, chat_id, self.dim).remove)
+
+vector_store = VectorStore(VECTOR_DIR)
+
+async def retrieve_passages(chat_id: int, queries: list[str],
+                            budget: int = RAG_TOKEN_BUDGET) -> list[tuple[str, str]]:
+    """أفضل الأجزاء صلةً بالاستعلامات ضمن ميزانية توكنات ثابتة"""
+    hits = await vector_store.search(chat_id, [q for q in queries if q], k=12)
+    out, used = [], 0
+    for _, title, text in hits:
+        cost = estimate_tokens(text)
+        if used + cost > budget:
+            continue
+        out.append((title, text))
+        used += cost
+    return out
+
+async def ingest_chunks(chat_id: int, knowledge_id: int, title: str, chunks) -> tuple[int, int]:
+    """
+    يستهلك مولّد chunk_stream على دفعات من DOC_BATCH داخل thread (القراءة وفك الترميز والتقسيم
+    خارج حلقة asyncio)، يحفظ الأجزاء الجديدة فقط (hash موجود مسبقاً = ربط المستند بالجزء الموجود)
+    ويضيف متجهاتها. يعيد (عدد الأجزاء الجديدة، عدد الأجزاء الكلي).
+    """
+    def take():
+        return list(itertools.islice(chunks, DOC_BATCH))
+    def op(conn, batch, seq):
+        rows = []
+        for i, (h, text) in enumerate(batch, seq):
+            cur = conn.execute("""INSERT OR IGNORE INTO knowledge_chunks
+                                  (chat_id,knowledge_id,seq,content,hash) VALUES (?,?,?,?,?)""",
+                               (chat_id, knowledge_id, i, text, h))
+            if cur.rowcount:
+                cid = cur.lastrowid
+                rows.append((cid, text))
+            else:
+                cid = conn.execute("SELECT id FROM knowledge_chunks WHERE chat_id=? AND hash=?",
+                                   (chat_id, h)).fetchone()[0]
+            # رابط من النسخة السابقة لنفس المستند يعود seq فيه موجباً فيبقى (انظر ingest_document)
+            conn.execute("""INSERT INTO knowledge_links (chat_id,knowledge_id,chunk_id,seq) VALUES (?,?,?,?)
+                            ON CONFLICT (knowledge_id, chunk_id) DO UPDATE SET seq = excluded.seq""",
+                         (chat_id, knowledge_id, cid, i))
+        return rows
+    new = total = 0
+    pending = []
+    while batch := await asyncio.to_thread(take):
+        rows = await db.write(op, batch, total)
+        total += len(batch)
+        new   += len(rows)
+        pending += rows
+        if len(pending) >= DOC_VECTOR_BATCH:
+            await vector_store.append(chat_id, title, pending)
+            pending = []
+    await vector_store.append(chat_id, title, pending)
+    return new, total
+
+async def ingest_document(chat_id: int, title: str, source, fmt: str) -> tuple[int, int, int]:
+    """
+    مستند من ملف ثنائي مفتوح (انظر iter_document_lines). رفع عنوان موجود = نسخة جديدة منه:
+    الأجزاء غير المتغيرة تبقى، الجديدة تُضاف، وروابط ما لم يعد في الملف تُحذف؛ الجزء نفسه يُحذف من
+    الجداول وFTS وفهرس المتجهات فقط إن لم يعد أي مستند آخر يستخدمه.
+    يعيد (أجزاء جديدة، أجزاء النسخة، أجزاء لم تعد فيها)؛ ملف فارغ لا يغيّر النسخة الموجودة.
+    """
+    def start(conn):
+        rows = [r[0] for r in conn.execute("SELECT id FROM knowledge WHERE chat_id=? AND title=? ORDER BY id DESC",
+                                           (chat_id, title))]
+        if not rows:
+            return conn.execute("INSERT INTO knowledge (chat_id,title) VALUES (?,?)",
+                                (chat_id, title)).lastrowid
+        kid, older = rows[0], rows[1:]
+        if older:   # نسخ مكررة بنفس العنوان من قبل: تُدمج في صف واحد
+            marks = ",".join("?" * len(older))
+            conn.execute(f"UPDATE OR IGNORE knowledge_links SET knowledge_id=? WHERE knowledge_id IN ({marks})",
+                         (kid, *older))
+            conn.execute(f"DELETE FROM knowledge_links WHERE knowledge_id IN ({marks})", older)
+            conn.execute(f"UPDATE knowledge_chunks SET knowledge_id=? WHERE knowledge_id IN ({marks})",
+                         (kid, *older))
+            conn.execute(f"DELETE FROM knowledge WHERE id IN ({marks})", older)
+        # seq سالب = رابط من النسخة السابقة لم يظهر بعد في الجديدة (ingest_chunks يعيده موجباً)
+        conn.execute("UPDATE knowledge SET content=NULL, ts=CURRENT_TIMESTAMP WHERE id=?", (kid,))
+        conn.execute("UPDATE knowledge_links SET seq = -1 - seq WHERE knowledge_id=? AND seq >= 0", (kid,))
+        return kid
+    def finish(conn, total):
+        if not total:
+            conn.execute("UPDATE knowledge_links SET seq = -1 - seq WHERE knowledge_id=? AND seq < 0", (kid,))
+            conn.execute("""DELETE FROM knowledge WHERE id=? AND NOT EXISTS
+                              (SELECT 1 FROM knowledge_links WHERE knowledge_id=?)""", (kid, kid))
+            return 0, [], {}
+        stale = [r[0] for r in conn.execute("SELECT chunk_id FROM knowledge_links WHERE knowledge_id=? AND seq < 0",
+                                            (kid,))]
+        conn.execute("DELETE FROM knowledge_links WHERE knowledge_id=? AND seq < 0", (kid,))
+        orphans, moved = [], []
+        for cid in stale:
+            # جزء تركه هذا المستند: يُحذف إن لم يستخدمه غيره، وإلا ينتقل لأحدها (العنوان المعروض + FTS)
+            owner = conn.execute("""SELECT l.knowledge_id, k.title FROM knowledge_links l
+                                    JOIN knowledge k ON k.id = l.knowledge_id
+                                    WHERE l.chunk_id=? ORDER BY l.knowledge_id LIMIT 1""", (cid,)).fetchone()
+            if owner is None:
+                orphans.append(cid)
+            elif conn.execute("SELECT knowledge_id FROM knowledge_chunks WHERE id=?", (cid,)).fetchone()[0] == kid:
+                moved.append((cid, *owner))
+        conn.executemany("DELETE FROM knowledge_chunks WHERE id=?", [(cid,) for cid in orphans])
+        conn.executemany("UPDATE knowledge_chunks SET knowledge_id=? WHERE id=?",
+                         [(owner, cid) for cid, owner, _ in moved])
+        return len(stale), orphans, {cid: title for cid, _, title in moved}
+    with tracer.span("ingest_document"):
+        kid = await db.write(start)
+        total = 0
+        try:
+            new, total = await ingest_chunks(chat_id, kid, title,
+                                             chunk_stream(iter_document_lines(source, fmt)))
+        finally:
+            removed, orphans, moved = await db.write(finish, total)
+        vector_store.retitle(chat_id, moved)
+        await vector_store.discard(chat_id, orphans)
+    return new, total, removed
+
+async def backfill_vectors(owns=None):
+    """
+    يقسّم ويفهرس المستندات القديمة المحفوظة كنص كامل قبل تقسيم الأجزاء.
+    owns(chat_id) يحصرها في محادثات هذا العامل (وضع WORKERS)
+    """
+    def op(conn):
+        return conn.execute("""SELECT id, chat_id, title, content FROM knowledge k
+                               WHERE content IS NOT NULL AND NOT EXISTS
+                                 (SELECT 1 FROM knowledge_links l WHERE l.knowledge_id = k.id)""").fetchall()
+    for kid, chat_id, title, content in await db.read(op):
+        if owns is None or owns(chat_id):
+            await ingest_chunks(chat_id, kid, title, chunk_stream(content.splitlines()))
+
+# ================================================================
+# 3.2 كاش السياق لكل محادثة (يُحدّث تدريجياً من دوال الكتابة)
+# ================================================================
+class ChatContext:
+    """أقسام السياق الجاهزة لمحادثة واحدة، بنفس الحدود والترتيب المستخدم في الاستعلامات"""
+
+    def __init__(self, summaries=(), lessons=(), recent=()):
+        self.summaries = deque(summaries, maxlen=SUMMARY_LEVELS * SUMMARY_ROLLUP)  # الأقدم أولاً
+        self.lessons   = deque(lessons,   maxlen=5)   # الأحدث أولاً
+        self.recent    = deque(recent,    maxlen=10)  # الأقدم أولاً
+
+class ContextCache:
+    """
+    LRU فوق المحادثات. save_msg / save_summary / save_lesson / clear_all تحدّث
+    المدخل الموجود مباشرة، فبناء السياق لا يحتاج SQLite في الحالة الشائعة.
+    """
+
+    def __init__(self, max_chats: int = CONTEXT_CACHE_CHATS):
+        self.max_chats = max_chats
+        self._entries: OrderedDict[int, ChatContext] = OrderedDict()
+        self._gen:     dict[int, int] = {}  # يزيد مع كل كتابة لكشف التحميل المتزامن
+        self.hits = self.misses = 0
+
+    async def get(self, chat_id: int) -> ChatContext:
+        entry = self._entries.get(chat_id)
+        if entry is not None:
+            self._entries.move_to_end(chat_id)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        gen = self._gen.get(chat_id, 0)
+        def op(conn):
+            summaries = conn.execute(f"SELECT summary FROM summaries WHERE chat_id=? {_SUMMARY_ORDER} LIMIT ?",
+                                     (chat_id, SUMMARY_LEVELS * SUMMARY_ROLLUP)).fetchall()
+            lessons   = conn.execute("SELECT lesson FROM lessons WHERE chat_id=? ORDER BY id DESC LIMIT 5",
+                                     (chat_id,)).fetchall()
+            recent    = conn.execute("SELECT role,content FROM messages WHERE chat_id=? ORDER BY id DESC LIMIT 10",
+                                     (chat_id,)).fetchall()
+            return summaries, lessons, recent
+        summaries, lessons, recent = await db.read(op)
+        entry = ChatContext(reversed([r[0] for r in summaries]),
+                            [r[0] for r in lessons],
+                            reversed([f"{r[0]}: {r[1]}" for r in recent]))
+        # لو حدثت كتابة أثناء القراءة فالنتيجة قد تكون قديمة: نستخدمها لهذه المرة فقط
+        if self._gen.get(chat_id, 0) == gen:
+            self._put(chat_id, entry)
+        return entry
+
+    def _put(self, chat_id: int, entry: ChatContext):
+        self._entries[chat_id] = entry
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_chats:
+            old, _ = self._entries.popitem(last=False)
+            self._gen.pop(old, None)
+
+    def _touch(self, chat_id: int) -> ChatContext | None:
+        self._gen[chat_id] = self._gen.get(chat_id, 0) + 1
+        return self._entries.get(chat_id)
+
+    def add_message(self, chat_id: int, role: str, content: str):
+        entry = self._touch(chat_id)
+        if entry is not None:
+            entry.recent.append(f"{role}: {content}")
+
+    def add_summary(self, chat_id: int, summary: str):
+        entry = self._touch(chat_id)
+        if entry is not None:
+            entry.summaries.append(summary)
+
+    def set_summaries(self, chat_id: int, summaries: list[str]):
+        """بعد دمج ملخصات: القائمة الكاملة بدل الإضافة"""
+        entry = self._touch(chat_id)
+        if entry is not None:
+            entry.summaries.clear()
+            entry.summaries.extend(summaries)
+
+    def add_lesson(self, chat_id: int, lesson: str):
+        entry = self._touch(chat_id)
+        if entry is not None:
+            entry.lessons.appendleft(lesson)
+
+    def reset(self, chat_id: int):
+        self._touch(chat_id)
+        self._put(chat_id, ChatContext())
+
+context_cache = ContextCache()
+# ================================================================
+# 4. أدوات مساعدة
+# ================================================================
+# --- مهام الخلفية: مرجع قوي حتى لا يجمعها الـ GC قبل انتهائها، واستثناءاتها تُطبع ولا تضيع ---
+_background: set[asyncio.Task] = set()
+
+def background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+def _background_done(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        print(f"Background task error ({task.get_coro().__qualname__}): {exc!r}")
+
+# --- القياس: spans لكل مرحلة + histograms (p50/p95/p99) + صيغة Prometheus ---
+# المحادثة الحالية تنتقل تلقائياً لكل المهام الفرعية (contextvars)
+trace_chat: ContextVar[int | None] = ContextVar("trace_chat", default=None)
+# عدّاد استدعاءات النموذج للرسالة الحالية (master_agent يضبطه، ModelClient يزيده)
+turn_llm_calls: ContextVar[list | None] = ContextVar("turn_llm_calls", default=None)
+
+class Histogram:
+    """buckets ثابتة كما في Prometheus؛ الـ quantiles بالاستيفاء الخطي داخل الـ bucket"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+    __slots__ = ("counts", "sum", "count", "errors", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum    = 0.0
+        self.count  = 0
+        self.errors = 0
+        self.max    = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum   += value
+        self.count += 1
+        self.max    = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank, seen, lower = q * self.count, 0, 0.0
+        for upper, n in zip(self.BUCKETS, self.counts):
+            if n and seen + n >= rank:
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return self.max
+
+class Span:
+    __slots__ = ("tracer", "stage", "chat_id", "start")
+
+    def __init__(self, tracer: "Tracer", stage: str):
+        self.tracer, self.stage = tracer, stage
+        self.chat_id = trace_chat.get()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.record(self.stage, time.perf_counter() - self.start, self.chat_id,
+                           error=exc_type is not None and exc_type is not asyncio.CancelledError)
+        return False
+
+class Tracer:
+    """
+    يجمع مدد المراحل:
+    - histogram لكل مرحلة (بدون chat_id كـ label حتى لا تنفجر السلاسل في Prometheus)
+    - آخر spans لكل محادثة لمعرفة أين ذهب الوقت عند شكوى مستخدم
+    - المراحل الأبطأ من TRACE_SLOW_SEC تُطبع في السجل
+    """
+
+    def __init__(self, per_chat: int = 30, max_chats: int = 256, slow: float = TRACE_SLOW_SEC):
+        self.hist: dict[str, Histogram] = {}
+        self.recent: OrderedDict[int, deque] = OrderedDict()
+        self.per_chat  = per_chat
+        self.max_chats = max_chats
+        self.slow      = slow
+        self.gauges: dict[str, callable] = {}
+
+    def span(self, stage: str) -> Span:
+        return Span(self, stage)
+
+    def record(self, stage: str, seconds: float, chat_id: int | None = None, error: bool = False):
+        hist = self.hist.get(stage)
+        if hist is None:
+            hist = self.hist[stage] = Histogram()
+        hist.observe(seconds)
+        hist.errors += error
+        if chat_id is not None:
+            spans = self.recent.get(chat_id)
+            if spans is None:
+                spans = self.recent[chat_id] = deque(maxlen=self.per_chat)
+                if len(self.recent) > self.max_chats:
+                    self.recent.popitem(last=False)
+            else:
+                self.recent.move_to_end(chat_id)
+            spans.append((time.time(), stage, seconds, error))
+        if self.slow and seconds >= self.slow:
+            print(f"⏱️ slow span chat={chat_id} stage={stage} {seconds:.2f}s")
+
+    def gauge(self, name: str, fn):
+        """قيمة لحظية تُقرأ عند طلب /metrics (مثل عمق الطوابير)"""
+        self.gauges[name] = fn
+
+    def prometheus(self) -> str:
+        lines = ["# HELP agent_stage_seconds Latency of bot pipeline stages.",
+                 "# TYPE agent_stage_seconds histogram"]
+        for stage, h in sorted(self.hist.items()):
+            cum = 0
+            for upper, n in zip(h.BUCKETS, h.counts):
+                cum += n
+                le = "+Inf" if upper == float("inf") else f"{upper:g}"
+                lines.append(f'agent_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cum}')
+            lines.append(f'agent_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+            lines.append(f'agent_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        lines += ["# HELP agent_stage_errors_total Stage calls that raised.",
+                  "# TYPE agent_stage_errors_total counter"]
+        lines += [f'agent_stage_errors_total{{stage="{stage}"}} {h.errors}'
+                  for stage, h in sorted(self.hist.items())]
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines += [f"# TYPE {name} gauge", f"{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self, chat_id: int | None = None, top: int = 8) -> str:
+        """أبطأ المراحل (حسب p95) + آخر spans لهذه المحادثة"""
+        rows = sorted(self.hist.items(), key=lambda kv: -kv[1].quantile(0.95))[:top]
+        text = "\n".join(f"• {stage}: p50 {h.quantile(.5):.2f}s | p95 {h.quantile(.95):.2f}s | "
+                         f"p99 {h.quantile(.99):.2f}s (n={h.count})" for stage, h in rows)
+        spans = list(self.recent.get(chat_id, ()))[-10:]
+        if spans:
+            text += "\n\nآخر المراحل في هذه المحادثة:\n" + "\n".join(
+                f"• {stage} {seconds:.2f}s{' ❌' if error else ''}"
+                for _, stage, seconds, error in spans)
+        return text or "• لا قياسات بعد"
+
+tracer = Tracer()
+
+def traced(stage: str):
+    """يلف دالة async في span باسم المرحلة"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            with tracer.span(stage):
+                return await fn(*args, **kwargs)
+        return inner
+    return wrap
+
+async def serve_metrics(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """GET /metrics بصيغة Prometheus النصية (خادم محلي صغير)"""
+    async def conn(reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = line.decode("latin-1").split(" ")[1] if line.count(b" ") >= 2 else ""
+            if path.split("?", 1)[0] == "/metrics":
+                status, body = 200, tracer.prometheus().encode()
+            else:
+                status, body = 404, b""
+            writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                         "Content-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(conn, host, port)
+    print(f"📈 metrics على http://{host}:{server.sockets[0].getsockname()[1]}/metrics")
+    return server
+
+def estimate_tokens(text: str) -> int:
+    """تقدير سريع للتوكنات: ~4 بايت UTF-8 لكل توكن (العربية ≈ حرفان لكل توكن)"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+class TokenBucket:
+    """يمتلئ بمعدل per_minute في الدقيقة حتى السعة (افتراضياً = الحد في الدقيقة)؛ 0 = بدون حد"""
+
+    def __init__(self, per_minute: float, capacity: float | None = None):
+        self.capacity = float(per_minute if capacity is None else capacity)
+        self.rate     = per_minute / 60.0
+        self.tokens   = self.capacity
+        self.updated  = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity:
+            self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, n: float) -> float:
+        if not self.capacity:
+            return 0.0
+        n = min(n, self.capacity)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n: float):
+        if self.capacity:
+            self.tokens -= min(n, self.capacity)
+
+class TelegramSender:
+    """
+    كل الرسائل والتعديلات الصادرة تمر من هنا:
+    - ميزانية عامة للبوت + ميزانية لكل محادثة (token buckets)
+    - RetryAfter من تيليجرام يوقف المحادثة للمدة المطلوبة ثم يعيد المحاولة
+    - التعديلات الوسيطة (droppable) تُتخطى بدل الانتظار إن لم تتوفر ميزانية
+    """
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 group_rate: float = TG_GROUP_RATE, burst: float = TG_CHAT_BURST,
+                 max_chats: int = 1024):
+        self.global_bucket = TokenBucket(global_rate * 60, capacity=global_rate)
+        self.chat_rate     = chat_rate
+        self.group_rate    = group_rate
+        self.burst         = burst
+        self.max_chats     = max_chats
+        self._chats: OrderedDict[int, list] = OrderedDict()   # chat_id → [bucket, blocked_until]
+        self.sent = self.dropped = self.retried = 0
+
+    def _chat(self, chat_id: int) -> list:
+        state = self._chats.get(chat_id)
+        if state is None:
+            rate  = self.group_rate if chat_id < 0 else self.chat_rate
+            state = self._chats[chat_id] = [TokenBucket(rate, capacity=self.burst), 0.0]
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return state
+
+    def _wait(self, chat_id: int) -> float:
+        bucket, blocked_until = self._chat(chat_id)
+        now = time.monotonic()
+        self.global_bucket.refill(now)
+        bucket.refill(now)
+        return max(blocked_until - now, self.global_bucket.wait_time(1), bucket.wait_time(1))
+
+    async def call(self, chat_id: int, fn, droppable: bool = False):
+        """ينفذ fn() (طلب Bot API) ضمن الميزانية؛ يعيد None إن تم تخطيه"""
+        for attempt in range(TG_MAX_RETRIES + 1):
+            while (wait := self._wait(chat_id)) > 0:
+                if droppable:
+                    self.dropped += 1
+                    return None
+                await asyncio.sleep(wait)
+            self.global_bucket.take(1)
+            self._chat(chat_id)[0].take(1)
+            try:
+                result = await fn()
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._chat(chat_id)[1] = time.monotonic() + delay
+                self.retried += 1
+                if droppable or attempt == TG_MAX_RETRIES:
+                    raise
+                print(f"Telegram flood control [{chat_id}]: retry in {delay}s")
+
+sender = TelegramSender()
+
+async def safe_send(bot: Bot, chat_id: int, text: str):
+    if not text:
+        return
+    try:
+        for i in range(0, len(text), 4000):
+            await sender.call(chat_id, lambda part=text[i:i+4000]:
+                              bot.send_message(chat_id=chat_id, text=part))
+    except Exception as e:
+        print(f"Send error: {e}")
+
+class ProgressMessage:
+    """
+    رسالة حالة واحدة لكل طلب تُعدّل بدل إرسال سطر جديد لكل خطوة:
+    🔍 الباحث يحلل ويبحث... ✅
+    💻 المبرمج يكتب الكود...
+    """
+
+    def __init__(self, bot: Bot, chat_id: int):
+        self.bot, self.chat_id = bot, chat_id
+        self.steps: list[str] = []
+        self.message_id = None
+        self._lock = asyncio.Lock()
+
+    async def step(self, text: str):
+        """يعلّم الخطوة السابقة كمنتهية ويضيف خطوة جديدة"""
+        if self.steps and not self.steps[-1].endswith("✅"):
+            self.steps[-1] += " ✅"
+        self.steps.append(text)
+        await self._render()
+
+    async def set(self, text: str):
+        """يستبدل نص الرسالة بالكامل (مثلاً بالنتيجة النهائية)"""
+        self.steps = [text]
+        await self._render()
+
+    async def done(self):
+        if self.steps and not self.steps[-1].endswith("✅"):
+            self.steps[-1] += " ✅"
+            await self._render()
+
+    async def _render(self):
+        text = "\n".join(self.steps)[:4000]
+        async with self._lock:
+            try:
+                if self.message_id is None:
+                    msg = await sender.call(self.chat_id, lambda: self.bot.send_message(
+                        chat_id=self.chat_id, text=text))
+                    self.message_id = msg.message_id
+                else:
+                    await sender.call(self.chat_id, lambda: self.bot.edit_message_text(
+                        text=text, chat_id=self.chat_id, message_id=self.message_id))
+            except Exception as e:
+                print(f"Progress error: {e}")
+
+# --- جدولة حدود Groq (token bucket لكل نموذج + أولويات) ---
+class ModelLimiter:
+    """حالة نموذج واحد: دلوا الطلبات والتوكنات + طابور انتظار مرتب بالأولوية"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens   = TokenBucket(tpm)
+        self.waiters: list = []           # heap: (priority, seq, tokens, future, enqueued)
+        self.blocked_until = 0.0          # بعد 429 يتوقف الإرسال حتى هذا الوقت
+        self.timer: asyncio.TimerHandle | None = None
+        self.avg_wait = 0.0
+        self.max_wait = 0.0
+        self.throttled = 0
+
+class GroqScheduler:
+    """
+    كل طلب لـ Groq يحجز مكانه هنا أولاً:
+    - token bucket لكل نموذج (طلبات/دقيقة و توكنات/دقيقة حسب GROQ_LIMITS)
+    - الطلبات التفاعلية تتقدم على المهام الخلفية (التلخيص)
+    - عند 429 يتوقف النموذج حتى retry-after ويُعاد الطلب بتأخير عشوائي متزايد
+    - share > 1: الحدود مقسومة بين عدة عمليات تستخدم نفس المفتاح (وضع WORKERS)
+    """
+
+    def __init__(self, limits: dict = GROQ_LIMITS, share: int = 1):
+        self.limits = limits
+        self.share  = share
+        self._models: dict[str, ModelLimiter] = {}
+        self._seq = 0
+
+    def _model(self, model: str) -> ModelLimiter:
+        lim = self._models.get(model)
+        if lim is None:
+            rpm, tpm = self.limits.get(model, (GROQ_RPM, GROQ_TPM))
+            lim = self._models[model] = ModelLimiter(rpm / self.share, tpm / self.share)
+        return lim
+
+    async def acquire(self, model: str, tokens: int, priority: int = PRIORITY_INTERACTIVE):
+        lim = self._model(model)
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(lim.waiters, (priority, self._seq, tokens, fut, time.monotonic()))
+        self._pump(lim)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            lim.waiters = [w for w in lim.waiters if w[3] is not fut]
+            heapq.heapify(lim.waiters)
+            raise
+
+    def refund(self, model: str, tokens: int):
+        """يعيد الفرق بين التوكنات المحجوزة والمستخدمة فعلاً"""
+        if tokens > 0:
+            lim = self._model(model)
+            lim.tokens.tokens = min(lim.tokens.capacity, lim.tokens.tokens + tokens)
+            self._pump(lim)
+
+    def penalize(self, model: str, delay: float):
+        lim = self._model(model)
+        lim.blocked_until = max(lim.blocked_until, time.monotonic() + delay)
+        lim.throttled += 1
+
+    def expected_wait(self, model: str, tokens: int = 0) -> float:
+        """تقدير انتظار طلب يصل الآن: الحجب بعد 429 + ما يستهلكه الطابور الحالي من الدلوين"""
+        lim = self._models.get(model)
+        if lim is None:
+            return 0.0
+        now = time.monotonic()
+        lim.requests.refill(now)
+        lim.tokens.refill(now)
+        queued = [w for w in lim.waiters if not w[3].done()]
+        def need(bucket: TokenBucket, n: float) -> float:
+            return max(0.0, (n - bucket.tokens) / bucket.rate) if bucket.capacity else 0.0
+        return max(lim.blocked_until - now, need(lim.requests, 1 + len(queued)),
+                   need(lim.tokens, tokens + sum(w[2] for w in queued)))
+
+    def _pump(self, lim: ModelLimiter):
+        if lim.timer is not None:
+            lim.timer.cancel()
+            lim.timer = None
+        now = time.monotonic()
+        lim.requests.refill(now)
+        lim.tokens.refill(now)
+        while lim.waiters:
+            priority, _, tokens, fut, enqueued = lim.waiters[0]
+            if fut.done():
+                heapq.heappop(lim.waiters)
+                continue
+            wait = max(lim.blocked_until - now, lim.requests.wait_time(1), lim.tokens.wait_time(tokens))
+            if wait > 0:
+                lim.timer = asyncio.get_running_loop().call_later(wait, self._pump, lim)
+                return
+            heapq.heappop(lim.waiters)
+            lim.requests.take(1)
+            lim.tokens.take(tokens)
+            waited = now - enqueued
+            lim.avg_wait = lim.avg_wait * 0.9 + waited * 0.1
+            lim.max_wait = max(lim.max_wait, waited)
+            fut.set_result(None)
+
+    def stats(self) -> dict:
+        """لكل نموذج: عمق الطابور، متوسط وأقصى انتظار، عدد مرات 429"""
+        return {name: {"queued": sum(not w[3].done() for w in lim.waiters),
+                       "avg_wait": lim.avg_wait, "max_wait": lim.max_wait,
+                       "throttled": lim.throttled}
+                for name, lim in self._models.items()}
+
+def _retry_delay(err: Exception, attempt: int) -> float:
+    """retry-after من الخادم إن وُجد، وإلا تأخير أُسّي مع عشوائية"""
+    headers = getattr(getattr(err, "response", None), "headers", None) or {}
+    try:
+        base = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        base = min(30.0, 1.0 * 2 ** attempt)
+    return base * random.uniform(0.8, 1.4)
+
+# --- عميل النماذج (async بدون threads) ---
+class ModelHealth:
+    """زمن استجابة نموذج واحد (EWMA بعد انتظار الحدود) + الأخطاء"""
+    __slots__ = ("latency", "updated", "calls", "errors", "failed_at")
+
+    def __init__(self):
+        self.latency, self.updated = 0.0, 0.0
+        self.calls = self.errors = 0
+        self.failed_at = float("-inf")
+
+    def observe(self, seconds: float):
+        prev = self.current(MODEL_COOLDOWN)
+        self.latency = seconds if not self.calls else prev * 0.8 + seconds * 0.2
+        self.updated = time.monotonic()
+        self.calls  += 1
+
+    def fail(self):
+        self.errors   += 1
+        self.failed_at = time.monotonic()
+
+    def current(self, half_life: float) -> float:
+        """المتوسط يتلاشى مع الوقت، فالنموذج الذي تأخر بسبب البطء يُجرَّب مجدداً"""
+        return self.latency * 0.5 ** ((time.monotonic() - self.updated) / half_life)
+
+class ModelClient:
+    """
+    طبقة فوق AsyncGroq يستخدمها groq_call / groq_stream / transcribe_voice / analyze_image:
+    - httpx.AsyncClient واحد باتصالات keep-alive محدودة العدد
+    - Semaphore يحد عدد الطلبات الجارية بدل حجز thread لكل طلب
+    """
+
+    def __init__(self, api_key: str, base_url: str | None = GROQ_BASE_URL,
+                 max_connections: int = GROQ_MAX_CONNECTIONS,
+                 max_keepalive: int = GROQ_MAX_KEEPALIVE,
+                 keepalive_expiry: float = GROQ_KEEPALIVE_EXPIRY,
+                 concurrency: int = GROQ_CONCURRENCY, timeout: float = GROQ_TIMEOUT):
+        self.api_key  = api_key
+        self.base_url = base_url
+        self.limits   = httpx.Limits(max_connections=max_connections,
+                                     max_keepalive_connections=max_keepalive,
+                                     keepalive_expiry=keepalive_expiry)
+        self.timeout  = httpx.Timeout(timeout, connect=10)
+        self.sem      = asyncio.Semaphore(concurrency)
+        self.limiter  = GroqScheduler()
+        self.health: dict[str, ModelHealth] = {}
+        self._client: AsyncGroq | None = None
+
+    @property
+    def client(self) -> AsyncGroq:
+        # يُنشأ داخل الحلقة الجارية حتى ترتبط الاتصالات بها.
+        # إعادة المحاولة تتم هنا (مع المُجدول) وليس داخل مكتبة groq
+        if self._client is None:
+            self._client = AsyncGroq(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                     http_client=httpx.AsyncClient(limits=self.limits,
+                                                                   timeout=self.timeout))
+        return self._client
+
+    def model_health(self, model: str) -> ModelHealth:
+        h = self.health.get(model)
+        if h is None:
+            h = self.health[model] = ModelHealth()
+        return h
+
+    async def _request(self, model: str, tokens: int, priority: int, call,
+                       retries: int = GROQ_MAX_RETRIES):
+        """
+        يحجز الحد ثم ينفذ call()، ويعيد المحاولة عند 429 / أخطاء الشبكة / 5xx.
+        زمن call() وحده (بدون انتظار الحدود) يُسجل في health[model]
+        """
+        if (calls := turn_llm_calls.get()) is not None:
+            calls[0] += 1
+        health = self.model_health(model)
+        for attempt in range(retries + 1):
+            await self.limiter.acquire(model, tokens, priority)
+            start = time.monotonic()
+            try:
+                result = await call()
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == retries:
+                    health.fail()
+                    raise
+                delay = _retry_delay(e, attempt)
+                if isinstance(e, RateLimitError):
+                    self.limiter.penalize(model, delay)
+                print(f"Groq retry {attempt + 1}/{retries} [{model}] in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+            except Exception:
+                health.fail()
+                raise
+            else:
+                health.observe(time.monotonic() - start)
+                return result
+
+    async def chat(self, model: str, messages: list, max_tokens: int, temperature=NOT_GIVEN,
+                   priority: int = PRIORITY_INTERACTIVE, retries: int = GROQ_MAX_RETRIES) -> str:
+        async def call():
+            async with self.sem:
+                return await self.client.chat.completions.create(
+                    model=model, messages=messages,
+                    max_tokens=max_tokens, temperature=temperature
+                )
+        reserved = _prompt_tokens(messages) + max_tokens
+        r = await self._request(model, reserved, priority, call, retries)
+        if r.usage is not None:
+            self.limiter.refund(model, reserved - r.usage.total_tokens)
+        return r.choices[0].message.content.strip()
+
+    async def stream(self, model: str, messages: list, max_tokens: int, temperature=NOT_GIVEN,
+                     priority: int = PRIORITY_INTERACTIVE, retries: int = GROQ_MAX_RETRIES):
+        # إعادة المحاولة ممكنة فقط قبل وصول أول جزء؛ الزمن المسجل = حتى بداية الرد
+        async def open_stream():
+            await self.sem.acquire()
+            try:
+                return await self.client.chat.completions.create(
+                    model=model, messages=messages,
+                    max_tokens=max_tokens, temperature=temperature, stream=True
+                )
+            except BaseException:
+                self.sem.release()
+                raise
+        stream = await self._request(model, _prompt_tokens(messages) + max_tokens, priority,
+                                     open_stream, retries)
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            # مستهلك توقف مبكراً: نغلق الاستجابة حتى يعود الاتصال للـ pool
+            try:
+                await stream.close()
+            finally:
+                self.sem.release()
+
+    async def transcribe(self, file: tuple, model: str, language: str) -> str:
+        async def call():
+            async with self.sem:
+                return await self.client.audio.transcriptions.create(file=file, model=model,
+                                                                     language=language)
+        t = await self._request(model, 0, PRIORITY_INTERACTIVE, call)
+        return t.text.strip()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+def _prompt_tokens(messages: list) -> int:
+    total = 0
+    for m in messages:
+        content = m["content"]
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+        else:  # صورة + نص
+            total += sum(estimate_tokens(p.get("text", "")) + (1000 if p.get("type") == "image_url" else 0)
+                         for p in content)
+    return total
+
+models = ModelClient(GROQ_API_KEY)
+
+# --- جدول النماذج: أي نموذج لكل موضع استدعاء ---
+class ModelTable:
+    """
+    موضع الاستدعاء (keywords / researcher / programmer / executor / summary / quick / search)
+    → مستوياته في MODEL_ROUTES → نماذج MODEL_TIERS، مرتبة عند كل استدعاء:
+    - النموذج الذي فشل خلال آخر MODEL_COOLDOWN ثانية يذهب للآخر
+    - النموذج البطيء (متوسط زمنه أو انتظاره المتوقع في طابور الحدود فوق MODEL_SLOW_SEC)
+      يتأخر خلف الاحتياط حتى يتلاشى متوسطه
+    - كل نموذج غير الأخير: محاولة إعادة واحدة ومهلة MODEL_TIMEOUT لأول رد (للطلبات التفاعلية)،
+      ثم الانتقال للتالي
+    """
+
+    def __init__(self, tiers: dict = MODEL_TIERS, routes: dict = MODEL_ROUTES,
+                 slow: float = MODEL_SLOW_SEC, cooldown: float = MODEL_COOLDOWN,
+                 timeout: float = MODEL_TIMEOUT):
+        # خطأ في اسم مستوى يظهر مرة واحدة عند التشغيل لا KeyError عند كل استدعاء من الموضع
+        for site, names in routes.items():
+            if unknown := [t for t in names if t not in tiers]:
+                raise ValueError(f"❌ MODEL_ROUTE_{site.upper()}: مستوى غير معروف {', '.join(map(repr, unknown))} "
+                                 f"(المتاح: {', '.join(tiers)})")
+        self.tiers, self.routes = tiers, routes
+        self.slow, self.cooldown, self.timeout = slow, cooldown, timeout
+        self.served: dict[tuple[str, str], int] = {}   # (موضع، نموذج) → عدد
+        self.fallbacks = 0
+
+    def chain(self, site: str) -> list[str]:
+        return list(dict.fromkeys(self.tiers[t] for t in self.routes.get(site, ("large",))))
+
+    def primary(self, site: str) -> str:
+        """النموذج المفضل للموضع (مفتاح الكاش ثابت مهما كان النموذج الذي أجاب)"""
+        return self.chain(site)[0]
+
+    def candidates(self, site: str, tokens: int = 0) -> list[str]:
+        now = time.monotonic()
+        def rank(model: str) -> int:
+            h = models.health.get(model)
+            if h is not None and now - h.failed_at < self.cooldown:
+                return 2
+            if ((h is not None and h.current(self.cooldown) > self.slow)
+                    or models.limiter.expected_wait(model, tokens) > self.slow):
+                return 1
+            return 0
+        return sorted(self.chain(site), key=rank)
+
+    def _attempts(self, site: str, tokens: int, priority: int):
+        """(نموذج، هل هو الأخير، عدد إعادة المحاولة، المهلة) بالترتيب"""
+        chain = self.candidates(site, tokens)
+        for i, model in enumerate(chain):
+            last = i == len(chain) - 1
+            yield (model, last, GROQ_MAX_RETRIES if last else 1,
+                   None if last or priority != PRIORITY_INTERACTIVE else self.timeout)
+
+    def _fallback(self, site: str, model: str, err: BaseException):
+        if isinstance(err, asyncio.TimeoutError):
+            models.model_health(model).fail()
+        self.fallbacks += 1
+        print(f"Model fallback [{site}] {model}: {type(err).__name__} {err}")
+
+    def _served(self, site: str, model: str):
+        self.served[(site, model)] = self.served.get((site, model), 0) + 1
+
+    async def chat(self, site: str, messages: list, max_tokens: int, temperature=NOT_GIVEN,
+                   priority: int = PRIORITY_INTERACTIVE) -> str:
+        tokens = _prompt_tokens(messages) + max_tokens
+        for model, last, retries, timeout in self._attempts(site, tokens, priority):
+            try:
+                result = await asyncio.wait_for(
+                    models.chat(model, messages, max_tokens, temperature, priority, retries), timeout)
+            except Exception as e:
+                if last:
+                    raise
+                self._fallback(site, model, e)
+                continue
+            self._served(site, model)
+            return result
+
+    async def stream(self, site: str, messages: list, max_tokens: int, temperature=NOT_GIVEN,
+                     priority: int = PRIORITY_INTERACTIVE):
+        # الانتقال للاحتياط ممكن فقط قبل أول جزء
+        tokens = _prompt_tokens(messages) + max_tokens
+        for model, last, retries, timeout in self._attempts(site, tokens, priority):
+            parts = models.stream(model, messages, max_tokens, temperature, priority, retries)
+            try:
+                first = await asyncio.wait_for(anext(parts), timeout)
+            except StopAsyncIteration:
+                self._served(site, model)
+                return
+            except Exception as e:
+                await parts.aclose()
+                if last:
+                    raise
+                self._fallback(site, model, e)
+                continue
+            self._served(site, model)
+            try:
+                yield first
+                async for piece in parts:
+                    yield piece
+            finally:
+                await parts.aclose()
+            return
+
+    def stats(self) -> str:
+        lines = []
+        for model in dict.fromkeys([*self.tiers.values(), *models.health]):
+            h = models.health.get(model)
+            sites = ", ".join(f"{site} {n}" for (site, m), n in sorted(self.served.items()) if m == model)
+            lines.append(f"• {model}: " + (f"{h.calls} استدعاء | زمن {h.latency:.1f}s | أخطاء {h.errors}"
+                                           if h else "لم يُستخدم بعد")
+                         + (f" ({sites})" if sites else ""))
+        return "\n".join(lines) + f"\n• انتقال للاحتياط: {self.fallbacks}"
+
+model_table = ModelTable()
+
+# --- كاش ردود النماذج ---
+class LLMCache:
+    """
+    كاش بمفتاح المحتوى: sha256(model, system, prompt, max_tokens, temperature).
+    طبقة LRU في الذاكرة فوق جدول llm_cache، وكل موضع استدعاء يحدد مدة الصلاحية.
+    """
+
+    def __init__(self, max_items: int = LLM_CACHE_ITEMS):
+        self.max_items = max_items
+        self._mem: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits   = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, system: str, prompt: str, max_tokens: int, temp) -> str:
+        raw = json.dumps([model, system, prompt, max_tokens, temp], ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            if item[0] > now:
+                self._mem.move_to_end(key)
+                self.hits["memory"] += 1
+                return item[1]
+            del self._mem[key]
+        def op(conn):
+            return conn.execute("SELECT expires, value FROM llm_cache WHERE key=? AND expires>?",
+                                (key, now)).fetchone()
+        row = await db.read(op)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits["disk"] += 1
+        self._remember(key, row[0], row[1])
+        return row[1]
+
+    def put(self, key: str, value: str, ttl: int):
+        expires = time.time() + ttl
+        self._remember(key, expires, value)
+        # المدخلات المنتهية تُحذف في db.compact()
+        def op(conn):
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key,value,expires) VALUES (?,?,?)",
+                         (key, value, expires))
+        # الكتابة للقرص لا تؤخر الرد
+        background_task(db.write(op))
+
+    def _remember(self, key: str, expires: float, value: str):
+        self._mem[key] = (expires, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def stats(self) -> str:
+        total = sum(self.hits.values()) + self.misses
+        rate  = sum(self.hits.values()) / total * 100 if total else 0
+        return (f"ذاكرة {self.hits['memory']} | قرص {self.hits['disk']} | "
+                f"إخفاق {self.misses} ({rate:.0f}% نجاح)")
+
+llm_cache = LLMCache()
+
+@traced("groq_call")
+async def groq_call(prompt: str, system: str, max_tokens=800, temp=0.5, cache_ttl=0,
+                    priority=PRIORITY_INTERACTIVE, site="quick") -> str:
+    """cache_ttl > 0 يفعّل الكاش لهذا الاستدعاء (انظر LLM_CACHE_TTL)؛ site يحدد النموذج (MODEL_ROUTES)"""
+    use_cache = LLM_CACHE_ENABLED and cache_ttl > 0
+    if use_cache:
+        key = LLMCache.key(model_table.primary(site), system, prompt, max_tokens, temp)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            return cached
+    try:
+        result = await model_table.chat(
+            site,
+            [{"role":"system","content":system},
+             {"role":"user","content":prompt}],
+            max_tokens, temp, priority
+        )
+    except Exception as e:
+        print(f"Groq error: {e}")
+        return ""
+    if use_cache and result:
+        llm_cache.put(key, result, cache_ttl)
     return result
 
-def search_knowledge(chat_id, query):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    words = query.split()[:5]
-    results = []
-    for word in words:
-        c.execute("""SELECT title,content FROM knowledge
-                     WHERE chat_id=? AND (title LIKE ? OR content LIKE ?)
-                     LIMIT 2""",
-                  (chat_id, f"%{word}%", f"%{word}%"))
-        results.extend(c.fetchall())
-    conn.close()
-    seen = set()
-    unique = []
-    for r in results:
-        if r[0] not in seen:
-            seen.add(r[0])
-            unique.append(r)
-    return unique[:3]
-
-def list_knowledge(chat_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id,title FROM knowledge WHERE chat_id=? ORDER BY ts DESC", (chat_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+async def groq_stream(prompt: str, system: str, max_tokens=800, temp=0.5, site="quick"):
+    """نسخة متدفقة من groq_call: تُرجع أجزاء النص فور وصولها"""
+    try:
+        async for piece in model_table.stream(
+            site,
+            [{"role":"system","content":system},
+             {"role":"user","content":prompt}],
+            max_tokens, temp
+        ):
+            yield piece
+    except Exception as e:
+        print(f"Groq stream error: {e}")
 
-# --- دروس ---
-def save_lesson(chat_id, lesson):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT INTO lessons (chat_id,lesson) VALUES (?,?)", (chat_id, lesson))
-    conn.execute("""DELETE FROM lessons WHERE chat_id=? AND id NOT IN
-                    (SELECT id FROM lessons WHERE chat_id=? ORDER BY ts DESC LIMIT 20)""",
-                 (chat_id, chat_id))
-    conn.commit()
-    conn.close()
+class LiveMessage:
+    """
+    رسالة تيليجرام تُحدّث أثناء وصول النص:
+    - تعديلات edit_message_text بحد أدنى STREAM_EDIT_INTERVAL بينها
+    - عند الاقتراب من 4000 حرف تُغلق الرسالة وتبدأ رسالة جديدة
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, header: str = "", placeholder: str = "",
+                 interval: float = STREAM_EDIT_INTERVAL, limit: int = STREAM_MSG_LIMIT):
+        self.bot, self.chat_id = bot, chat_id
+        self.header      = header
+        self.placeholder = placeholder
+        self.interval    = interval
+        self.limit       = limit
+        self.full        = ""     # النص الكامل (يُعاد للمستدعي)
+        self.cur         = ""     # نص الرسالة الحالية
+        self.message_id  = None
+        self.shown       = ""     # آخر نص ظهر فعلاً في الرسالة الحالية
+        self.last_edit   = 0.0
+
+    async def start(self):
+        if self.placeholder:
+            await self._show(self.placeholder)
+
+    async def feed(self, piece: str):
+        self.full += piece
+        self.cur  += piece
+        room = self.limit - len(self.header)
+        while len(self.cur) > room:
+            # نغلق الرسالة عند آخر سطر جديد قبل الحد ونكمل في رسالة جديدة
+            cut = self.cur.rfind("\n", 0, room)
+            cut = cut if cut > room // 2 else room
+            await self._show(self.header + self.cur[:cut], final=True)
+            self.cur, self.message_id, self.shown = self.cur[cut:].lstrip("\n"), None, ""
+        if asyncio.get_running_loop().time() - self.last_edit >= self.interval:
+            await self._show(self.header + self.cur)
+
+    async def replace(self, text: str):
+        """يستبدل محتوى الرسالة بدل الإضافة إليه (حالة متغيرة مثل ناتج عملية قيد التشغيل)"""
+        self.full = self.cur = ""
+        await self.feed(text)
+
+    async def finish(self) -> str:
+        if self.cur:
+            await self._show(self.header + self.cur, final=True)
+        elif not self.full and self.message_id is not None:
+            await self._show("⚠️ لم يصل رد من النموذج.", final=True)
+        return self.full.strip()
+
+    async def _show(self, text: str, final: bool = False):
+        if not text.strip() or text == self.shown:
+            return
+        try:
+            if self.message_id is None:
+                msg = await sender.call(self.chat_id, lambda: self.bot.send_message(
+                    chat_id=self.chat_id, text=text))
+                self.message_id = msg.message_id
+            else:
+                # التعديلات الوسيطة تُتخطى عند ضيق الميزانية؛ التالية ستحمل النص كاملاً
+                if await sender.call(self.chat_id, lambda: self.bot.edit_message_text(
+                        text=text, chat_id=self.chat_id, message_id=self.message_id),
+                        droppable=not final) is None:
+                    return
+            self.shown = text
+        except Exception as e:
+            print(f"Live message error: {e}")
+        self.last_edit = asyncio.get_running_loop().time()
+
+@traced("stream_reply")
+async def stream_reply(bot: Bot, chat_id: int, prompt: str, system: str,
+                       header: str = "", placeholder: str = "", max_tokens=800, temp=0.5,
+                       cache_ttl=0, site="quick") -> str:
+    """يبث رد النموذج لرسالة تُعدّل تدريجياً ويعيد النص الكامل"""
+    live = LiveMessage(bot, chat_id, header, placeholder)
+    await live.start()
+    use_cache = LLM_CACHE_ENABLED and cache_ttl > 0
+    if use_cache:
+        key = LLMCache.key(model_table.primary(site), system, prompt, max_tokens, temp)
+        cached = await llm_cache.get(key)
+        if cached is not None:
+            await live.feed(cached)
+            return await live.finish()
+    t0, first = time.perf_counter(), True
+    async for piece in groq_stream(prompt, system, max_tokens, temp, site):
+        if first:
+            tracer.record("groq_ttft", time.perf_counter() - t0, trace_chat.get())
+            first = False
+        await live.feed(piece)
+    result = await live.finish()
+    if use_cache and result:
+        llm_cache.put(key, result, cache_ttl)
+    return result
+
+# --- البحث (كاش + دمج الطلبات المتطابقة) ---
+class SearchService:
+    """
+    طبقة فوق DDGS:
+    - تطبيع الاستعلام (مسافات، حالة الأحرف، تشكيل) كمفتاح للكاش
+    - كاش بمدة صلاحية SEARCH_CACHE_TTL
+    - الطلبات المتطابقة المتزامنة تنتظر نفس الطلب الجاري بدل تكراره
+    - جلسة DDGS واحدة لكل thread بدل إنشاء عميل جديد في كل مرة
+    """
+
+    def __init__(self, backend=None, ttl: int = SEARCH_CACHE_TTL, max_items: int = SEARCH_CACHE_ITEMS):
+        self.backend   = backend or self._ddgs_text   # backend(query, n) -> list[dict] (متزامن)
+        self.ttl       = ttl
+        self.max_items = max_items
+        self._cache:    OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self._local    = threading.local()
+        self.hits = self.misses = self.coalesced = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.findall(r"\w+", normalize_arabic(query)))
+
+    def _ddgs_text(self, query: str, n: int) -> list:
+        ddgs = getattr(self._local, "ddgs", None)
+        if ddgs is None:
+            ddgs = self._local.ddgs = DDGS()
+        return list(ddgs.text(query, max_results=n))
+
+    async def search(self, query: str, n: int = 5) -> list:
+        key = (self.normalize(query), n)
+        if not key[0]:
+            return []
+        item = self._cache.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            res = await asyncio.to_thread(self.backend, " ".join(query.split()), n)
+        except asyncio.CancelledError:
+            fut.set_result([])  # لا نترك المنتظرين معلقين
+            raise
+        except Exception as e:
+            print(f"Search error: {e}")
+            res = []
+        finally:
+            del self._inflight[key]
+        if res:
+            self._cache[key] = (time.monotonic() + self.ttl, res)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        fut.set_result(res)
+        return res
+
+search_service = SearchService()
+
+@traced("web_search")
+async def web_search(query: str, n=5) -> str:
+    res = await search_service.search(query, n)
+    return "\n\n".join(f"{i+1}. {r.get('title','')}\n{r.get('body','')}"
+                       for i, r in enumerate(res)) if res else ""
+
+@traced("transcribe_voice")
+async def transcribe_voice(audio: bytes | io.BytesIO) -> str:
+    try:
+        return await models.transcribe(("audio.ogg", audio, "audio/ogg"),
+                                       "whisper-large-v3", "ar")
+    except Exception as e:
+        print(f"Whisper error: {e}")
+        return ""
+
+@traced("analyze_image")
+async def analyze_image(img_bytes: bytes | memoryview, question="صف هذه الصورة بالتفصيل بالعربية",
+                        mime: str = "image/jpeg") -> str:
+    try:
+        b64 = base64.b64encode(img_bytes).decode()
+        return await models.chat(
+            "llama-4-scout-17b-16e-instruct",
+            [{"role":"user","content":[
+                {"type":"image_url","image_url":{"url":f"data:{mime};base64,{b64}"}},
+                {"type":"text","text":question}
+            ]}],
+            512
+        )
+    except Exception as e:
+        print(f"Vision error: {e}")
+        return ""
+
+# --- الوسائط: تنزيل محدود الحجم + كاش بمفتاح الملف/المحتوى ---
+class MediaTooLarge(Exception):
+    pass
+
+def pick_photo(sizes: list, max_side: int = IMAGE_MAX_SIDE):
+    """أصغر نسخة من الصورة تغطي max_side (تيليجرام يرسل عدة أحجام مرتبة تصاعدياً)"""
+    for size in sizes:
+        if max(size.width, size.height) >= max_side:
+            return size
+    return sizes[-1]
+
+def prepare_image(buf: io.BytesIO, max_side: int = IMAGE_MAX_SIDE,
+                  quality: int = IMAGE_QUALITY) -> tuple[memoryview, str]:
+    """يصغّر الصورة ويعيد ترميزها JPEG إن كان ذلك أصغر؛ بدون Pillow تُرسل كما هي"""
+    if Image is None:
+        return buf.getbuffer(), "image/jpeg"
+    try:
+        with Image.open(buf) as img:
+            resized = max(img.size) > max_side
+            if not resized and img.format == "JPEG":
+                return buf.getbuffer(), "image/jpeg"
+            img.thumbnail((max_side, max_side))
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        print(f"Image decode error: {e}")
+        return buf.getbuffer(), "image/jpeg"
+    if not resized and out.tell() >= buf.getbuffer().nbytes:
+        return buf.getbuffer(), "image/jpeg"
+    return out.getbuffer(), "image/jpeg"
+
+class MediaPipeline:
+    """
+    معالجة الصوت والصور:
+    - الكاش بمفتاح file_unique_id أولاً (رسالة معاد توجيهها = بدون تنزيل)، ثم sha256 المحتوى
+    - التنزيل stream إلى buffer واحد مع حساب الـ hash أثناءه، ويتوقف عند max_bytes
+    - الصور: أصغر حجم كافٍ من تيليجرام + تصغير/إعادة ترميز في thread قبل الإرسال
+    """
+
+    def __init__(self, max_bytes: int = MEDIA_MAX_BYTES, ttl: int = MEDIA_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl       = ttl
+        self.hits      = {"file": 0, "content": 0}
+        self.misses    = 0
+        self.downloaded = self.saved = 0
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10))
+        return self._client
+
+    @staticmethod
+    def key(kind: str, ident: str, extra: str = "") -> str:
+        raw = json.dumps(["media", kind, ident, extra], ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @traced("download_media")
+    async def download(self, bot: Bot, file_id: str, into=None,
+                       max_bytes: int | None = None) -> tuple[io.BytesIO, str]:
+        """
+        (buffer, sha256) — MediaTooLarge إن تجاوز الملف max_bytes.
+        into = ملف ثنائي بديل عن BytesIO (مثل SpooledTemporaryFile للمستندات الكبيرة)
+        """
+        max_bytes = max_bytes or self.max_bytes
+        tg_file = await bot.get_file(file_id)
+        if (tg_file.file_size or 0) > max_bytes:
+            raise MediaTooLarge(tg_file.file_size)
+        buf, digest = into if into is not None else io.BytesIO(), hashlib.sha256()
+        if tg_file.file_path.startswith(("http://", "https://")):
+            async with self.client.stream("GET", tg_file.file_path) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes():
+                    if buf.tell() + len(chunk) > max_bytes:
+                        raise MediaTooLarge(buf.tell() + len(chunk))
+                    buf.write(chunk)
+                    digest.update(chunk)
+        else:  # خادم Bot API محلي: الملف على القرص
+            await tg_file.download_to_memory(buf)
+            buf.seek(0)
+            for block in iter(lambda: buf.read(1 << 16), b""):
+                digest.update(block)
+        self.downloaded += buf.tell()
+        buf.seek(0)
+        return buf, digest.hexdigest()
+
+    async def process(self, bot: Bot, kind: str, media, run, extra: str = "") -> str:
+        """run(buffer) → نص؛ النتيجة تُحفظ بمفتاحي الملف والمحتوى"""
+        by_file = self.key(kind, media.file_unique_id, extra)
+        if self.ttl and (cached := await llm_cache.get(by_file)) is not None:
+            self.hits["file"] += 1
+            return cached
+        buf, digest = await self.download(bot, media.file_id)
+        by_content = self.key(kind, digest, extra)
+        if self.ttl and (cached := await llm_cache.get(by_content)) is not None:
+            self.hits["content"] += 1
+            llm_cache.put(by_file, cached, self.ttl)
+            return cached
+        self.misses += 1
+        result = await run(buf)
+        if self.ttl and result:
+            llm_cache.put(by_file, result, self.ttl)
+            llm_cache.put(by_content, result, self.ttl)
+        return result
+
+    async def transcribe(self, bot: Bot, voice) -> str:
+        return await self.process(bot, "voice", voice, transcribe_voice)
+
+    async def analyze(self, bot: Bot, photos: list, question: str) -> str:
+        async def run(buf: io.BytesIO) -> str:
+            size = buf.getbuffer().nbytes
+            img, mime = await asyncio.to_thread(prepare_image, buf)
+            self.saved += size - img.nbytes
+            return await analyze_image(img, question, mime)
+        return await self.process(bot, "photo", pick_photo(photos), run, question)
+
+    def stats(self) -> str:
+        return (f"ملف {self.hits['file']} | محتوى {self.hits['content']} | جديد {self.misses} | "
+                f"تنزيل {self.downloaded / 1e6:.1f}MB | توفير التصغير {self.saved / 1e6:.1f}MB")
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+media = MediaPipeline()
+
+# ================================================================
+# 5. بناء السياق الكامل
+# ================================================================
+async def knowledge_context(chat_id: int, query: str) -> list[tuple[str, str]]:
+    """أجزاء ذات صلة من فهرس المتجهات، ومع عدم وجودها نرجع لبحث FTS"""
+    passages = await retrieve_passages(chat_id, [query])
+    if passages:
+        return passages
+    return [(title, content[:400]) for title, content in await search_knowledge(chat_id, query)]
+
+def clip_tokens(text: str, tokens: int) -> str:
+    """يقص النص ليتسع في عدد التوكنات المقدّر (نفس حساب estimate_tokens)"""
+    data = text.encode("utf-8")
+    if len(data) <= tokens * 4:
+        return text
+    return data[:max(tokens * 4 - 3, 0)].decode("utf-8", "ignore") + "…"
+
+def _terms(text: str) -> set[str]:
+    return {t for t in re.findall(r"\w+", normalize_arabic(text)) if len(t) > 1}
+
+class ContextSection:
+    """
+    قسم واحد من السياق: عناصر بترتيب العرض + درجة صلة لكل عنصر.
+    fit(budget) يختار الأعلى درجة حتى تنفد الميزانية ويعيدها بترتيب العرض مع التوكنات المستخدمة.
+    """
+    __slots__ = ("key", "title", "sep", "items", "scores", "keep_last")
+
+    def __init__(self, key: str, title: str, items: list[str], scores: list[float],
+                 sep: str = "\n", keep_last: int = 0):
+        self.key, self.title, self.sep = key, title, sep
+        self.items, self.scores = items, scores
+        self.keep_last = keep_last   # آخر عناصر تُحجز دائماً (مثل آخر رسالتين)
+
+    def fit(self, budget: int) -> tuple[list[str], int]:
+        n = len(self.items)
+        order = sorted(range(n), key=lambda i: (i < n - self.keep_last, -self.scores[i]))
+        picked, used = {}, 0
+        for i in order:
+            room = budget - used
+            if room <= 0:
+                break
+            text = self.items[i]
+            cost = estimate_tokens(text)
+            if cost > room:
+                if room < 32:
+                    continue
+                text, cost = clip_tokens(text, room), room
+            picked[i] = text
+            used += cost
+        return [picked[i] for i in sorted(picked)], used
+
+    def render(self, items: list[str]) -> str:
+        return f"=== {self.title} ===\n{self.sep.join(items)}\n" if items else ""
+
+class TurnContext:
+    """
+    سياق طلب واحد: يُجمع مرة واحدة (كاش + استرجاع المعرفة) ويُقتطع حسب الميزانيات،
+    ثم تستخدمه كل مراحل الطلب: النص الكامل للباحث و compact() للمبرمج.
+    """
+
+    ORDER = ("summaries", "knowledge", "lessons", "recent")   # ترتيب العرض
+
+    def __init__(self, sections: list[ContextSection], budgets: dict = CONTEXT_BUDGETS):
+        self.sections = {sec.key: sec for sec in sections}
+        self.budgets  = budgets
+        self.text     = self._render(self._fit(budgets))
+        self._compact: dict[int, str] = {}
+
+    def _fit(self, budgets: dict) -> dict[str, list[str]]:
+        """يملأ الأقسام حسب أولويتها (ترتيب budgets)؛ ما لا يستخدمه قسم ينتقل للتالي"""
+        spare, out = 0, {}
+        for key, budget in budgets.items():
+            spare += budget
+            sec = self.sections.get(key)
+            if sec is not None:
+                out[key], used = sec.fit(spare)
+                spare -= used
+        return out
+
+    def _render(self, chosen: dict[str, list[str]]) -> str:
+        return "\n".join(part for key in self.ORDER if key in self.sections
+                         and (part := self.sections[key].render(chosen.get(key, []))))
+
+    def compact(self, tokens: int = CONTEXT_COMPACT_TOKENS) -> str:
+        """نفس الاختيار بميزانية أصغر (بنسب الأقسام نفسها) دون إعادة الاسترجاع"""
+        if tokens not in self._compact:
+            total = sum(self.budgets.values()) or 1
+            budgets = {k: b * tokens // total for k, b in self.budgets.items()}
+            self._compact[tokens] = self._render(self._fit(budgets))
+        return self._compact[tokens]
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.text)
+
+    def __str__(self) -> str:
+        return self.text
+
+@traced("build_context")
+async def assemble_context(chat_id: int, query: str = "",
+                           budgets: dict = CONTEXT_BUDGETS) -> TurnContext:
+    # الأقسام الثابتة من الكاش، والمعرفة (تعتمد على السؤال) بالتوازي معها
+    entry, docs = await asyncio.gather(
+        context_cache.get(chat_id),
+        knowledge_context(chat_id, query) if query else asyncio.sleep(0, []),
+    )
+    terms = _terms(query)
 
-def get_lessons(chat_id, limit=5):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT lesson FROM lessons WHERE chat_id=? ORDER BY ts DESC LIMIT ?",
-              (chat_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return "\n".join(r[0] for r in rows)
+    def relevance(items: list[str], recency: float = 0.5) -> list[float]:
+        # تطابق الكلمات مع السؤال + وزن للأحدث (العناصر مرتبة من الأقدم للأحدث)
+        n = len(items)
+        return [(len(terms & _terms(t)) / (1 + len(terms)) if terms else 0.0) + recency * (i + 1) / n
+                for i, t in enumerate(items)]
 
-def clear_all(chat_id):
-    conn = sqlite3.connect(DB_PATH)
-    for tbl in ("messages","summaries","knowledge","lessons"):
-        conn.execute(f"DELETE FROM {tbl} WHERE chat_id=?", (chat_id,))
-    conn.commit()
-    conn.close()
+    lessons = list(reversed(entry.lessons))   # الأقدم أولاً مثل بقية الأقسام
+    sections = [
+        ContextSection("knowledge", "من قاعدة المعرفة", [f"[{t}]: {c}" for t, c in docs],
+                       [-i for i in range(len(docs))]),   # مرتبة مسبقاً حسب الصلة
+        ContextSection("recent", "المحادثة الأخيرة", list(entry.recent),
+                       relevance(entry.recent, 1.0), keep_last=2),
+        ContextSection("summaries", "ملخص المحادثات السابقة", list(entry.summaries),
+                       relevance(entry.summaries), sep="\n---\n"),
+        ContextSection("lessons", "دروس مستفادة", lessons, relevance(lessons)),
+    ]
+    return TurnContext([sec for sec in sections if sec.items], budgets)
+
+async def build_context(chat_id: int, query: str = "") -> str:
+    return (await assemble_context(chat_id, query)).text
 
 # ================================================================
-# 4. أدوات مساعدة
+# 6. التلخيص في الخلفية (watermark لكل محادثة + دمج هرمي)
 # ================================================================
+class SummaryQueue:
+    """
+    طابور مهام التلخيص:
+    - notify() بعد كل رسالة: يضيف المحادثة إن تجاوزت الرسائل غير الملخصة SUMMARY_EVERY
+    - المحادثة لا تُضاف مرتين؛ طلب أثناء التنفيذ يعيد جدولتها بعد الانتهاء
+    - عدد محدود من العمّال، واستدعاءات النموذج بأولوية خلفية
+    """
 
+    def __init__(self, every: int = SUMMARY_EVERY, rollup: int = SUMMARY_ROLLUP,
+                 levels: int = SUMMARY_LEVELS, workers: int = SUMMARY_WORKERS):
+        self.every, self.rollup, self.levels = every, rollup, levels
+        self.max_workers = workers
+        self.queue: deque[int] = deque()
+        self.active: set[int] = set()    # في الطابور أو قيد التنفيذ
+        self.again:  set[int] = set()    # وصلها طلب أثناء التنفيذ
+        self.workers: set[asyncio.Task] = set()
+        self.summarized = self.merged = self.failed = 0
 
-async def safe_send(bot: Bot, chat_id: int, text: str):
-    if not text:
-        return
-    try:
-        for i in range(0, len(text), 4000):
-            await bot.send_message(chat_id=chat_id, text=text[i:i+4000])
-            await asyncio.sleep(0.3)
-    except Exception as e:
-        print(f"Send error: {e}")
-
-async def groq_call(prompt: str, system: str, max_tokens=800, temp=0.5) -> str:
-    try:
-        r = await asyncio.to_thread(
-            lambda: client.chat.completions.create(
-                model="llama-3.3-70b-versatile",
-                messages=[{"role":"system","content":system},
-                          {"role":"user","content":prompt}],
-                max_tokens=max_tokens, temperature=temp
-            )
-        )
-        return r.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Groq error: {e}")
-        return ""
+    def notify(self, chat_id: int, pending: int):
+        if pending < self.every:
+            return
+        if chat_id in self.active:
+            self.again.add(chat_id)
+            return
+        self.active.add(chat_id)
+        self.queue.append(chat_id)
+        while self.queue and len(self.workers) < self.max_workers:
+            # سياق فارغ: العامل لا يرث trace_chat / turn_llm_calls من الرسالة التي أطلقته
+            task = Context().run(asyncio.create_task, self._worker())
+            self.workers.add(task)
+            task.add_done_callback(self.workers.discard)
 
-async def web_search(query: str, n=5) -> str:
-    try:
-        res = await asyncio.to_thread(lambda: list(DDGS().text(query, max_results=n)))
-        return "\n\n".join(f"{i+1}. {r.get('title','')}\n{r.get('body','')}"
-                           for i, r in enumerate(res)) if res else ""
-    except Exception as e:
-        print(f"Search error: {e}")
-        return ""
+    async def _worker(self):
+        while self.queue:
+            chat_id = self.queue.popleft()
+            self.again.discard(chat_id)
+            trace_chat.set(chat_id)
+            try:
+                progressed = await self._run(chat_id)
+            except Exception as e:
+                print(f"Summary error [{chat_id}]: {e}")
+                progressed = False
+                self.failed += 1
+            finally:
+                self.active.discard(chat_id)
+            if progressed and chat_id in self.again:
+                self.notify(chat_id, self.every)
 
-async def transcribe_voice(audio_bytes: bytes) -> str:
-    try:
-        t = await asyncio.to_thread(
-            lambda: client.audio.transcriptions.create(
-                file=("audio.ogg", audio_bytes, "audio/ogg"),
-                model="whisper-large-v3", language="ar"
+    async def _run(self, chat_id: int) -> bool:
+        progressed = False
+        while len(rows := await get_unsummarized(chat_id, self.every)) >= self.every:
+            convo = "\n".join(f"{role}: {content}" for _, role, content in rows)
+            summary = await groq_call(
+                f"لخّص هذه المحادثة في 3-5 جمل مع الحفاظ على المعلومات المهمة:\n{convo}",
+                "أنت مساعد يلخص المحادثات بدقة.",
+                300, cache_ttl=LLM_CACHE_TTL["summary"], priority=PRIORITY_BACKGROUND, site="summary"
             )
-        )
-        return t.text.strip()
-    except Exception as e:
-        print(f"Whisper error: {e}")
-        return ""
+            if not summary:
+                break
+            await save_summary(chat_id, summary, 0, rows[-1][0])
+            self.summarized += 1
+            progressed = True
+        if progressed:
+            await self._rollup(chat_id)
+        return progressed
 
-async def analyze_image(img_bytes: bytes, question="صف هذه الصورة بالتفصيل بالعربية") -> str:
-    try:
-        b64 = base64.b64encode(img_bytes).decode()
-        r = await asyncio.to_thread(
-            lambda: client.chat.completions.create(
-                model="llama-4-scout-17b-16e-instruct",
-                messages=[{"role":"user","content":[
-                    {"type":"image_url","image_url":{"url":f"data:image/jpeg;base64,{b64}"}},
-                    {"type":"text","text":question}
-                ]}],
-                max_tokens=512
+    async def _rollup(self, chat_id: int):
+        """كل rollup ملخصات متتالية من نفس المستوى → ملخص واحد في المستوى التالي"""
+        merged = False
+        while True:
+            frontier = await get_summary_frontier(chat_id)
+            group = None
+            for level in range(self.levels):
+                same = [row for row in frontier if (row[1] or 0) == level]
+                if len(same) >= self.rollup:
+                    group = same[:self.rollup]
+                    break
+            if group is None:
+                break
+            summary = await groq_call(
+                "ادمج هذه الملخصات المتتالية لنفس المحادثة في ملخص واحد موجز "
+                "يحافظ على الحقائق والقرارات المهمة:\n\n" + "\n---\n".join(row[3] for row in group),
+                "أنت مساعد يلخص المحادثات بدقة.",
+                400, cache_ttl=LLM_CACHE_TTL["summary"], priority=PRIORITY_BACKGROUND, site="summary"
             )
-        )
-        return r.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"Vision error: {e}")
-        return ""
+            if not summary:
+                break
+            # المستوى الأعلى يُدمج في نفسه، فعدد الملخصات يبقى محدوداً
+            await save_summary(chat_id, summary, min(level + 1, self.levels - 1),
+                               max(row[2] or 0 for row in group), [row[0] for row in group])
+            self.merged += 1
+            merged = True
+        if merged:
+            context_cache.set_summaries(chat_id, [row[3] for row in await get_summary_frontier(chat_id)])
 
-# ================================================================
-# 5. بناء السياق الكامل
-# ================================================================
-def build_context(chat_id: int, query: str = "") -> str:
-    ctx = ""
-    summaries = get_summaries(chat_id)
-    if summaries:
-        ctx += f"=== ملخص المحادثات السابقة ===\n{summaries}\n\n"
-    if query:
-        docs = search_knowledge(chat_id, query)
-        if docs:
-            ctx += "=== من قاعدة المعرفة ===\n"
-            for title, content in docs:
-                ctx += f"[{title}]: {content[:400]}\n"
-            ctx += "\n"
-    lessons = get_lessons(chat_id)
-    if lessons:
-        ctx += f"=== دروس مستفادة ===\n{lessons}\n\n"
-    recent = get_recent_msgs(chat_id, 10)
-    if recent:
-        ctx += f"=== المحادثة الأخيرة ===\n{recent}\n"
-    return ctx
+    def stats(self) -> str:
+        return (f"طابور {len(self.queue)} | ملخصات {self.summarized} | دمج {self.merged} | "
+                f"أخطاء {self.failed}")
 
-# ================================================================
-# 6. تلخيص تلقائي كل 20 رسالة
-# ================================================================
-async def maybe_summarize(chat_id: int, msg_count: int):
-    if msg_count > 0 and msg_count % 20 == 0:
-        recent = get_recent_msgs(chat_id, 20)
-        summary = await groq_call(
-            f"لخّص هذه المحادثة في 3-5 جمل مع الحفاظ على المعلومات المهمة:\n{recent}",
-            "أنت مساعد يلخص المحادثات بدقة.",
-            300
-        )
-        if summary:
-            save_summary(chat_id, summary)
+summarizer = SummaryQueue()
 
 # ================================================================
 # 7. تنفيذ الكود الفعلي (المنفذ)
 # ================================================================
-async def execute_code(code: str) -> str:
-    """ينفذ كود Python في بيئة آمنة ويعيد النتيجة"""
+# --- عمليات تنفيذ جاهزة مسبقاً (sandbox) ---
+# كل عامل مفسّر Python بدأ مسبقاً في مجلد مؤقت خاص وبيئة بلا أسرار، ينتظر الكود على stdin
+# ثم يطبّق حدود الموارد وينفّذه. العامل يُستخدم مرة واحدة ثم يُستبدل بعامل جديد في الخلفية.
+_SANDBOX_BOOT = """
+import os, resource, sys
+code = sys.stdin.buffer.read().decode("utf-8", "replace")
+for name, value in zip(("CPU", "AS", "NOFILE", "FSIZE"), map(int, sys.argv[1:5])):
+    if value:
+        res = getattr(resource, "RLIMIT_" + name)
+        resource.setrlimit(res, (value, value))
+sys.argv = ["<sandbox>"]
+sys.stdin = open(os.devnull)
+try:
+    exec(compile(code, "<sandbox>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+except SystemExit:
+    raise
+except BaseException as e:
+    import traceback
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+# --- قراءة ناتج العمليات تدريجياً (حد أقصى + نافذة بداية/نهاية) ---
+class OutputWindow:
+    """يحتفظ بأول head وآخر tail بايت من تدفق الناتج ويعدّ الإجمالي"""
+    __slots__ = ("head", "tail", "total", "head_max", "tail_max")
+
+    def __init__(self, head: int = EXEC_HEAD_BYTES, tail: int = EXEC_TAIL_BYTES):
+        self.head, self.tail = bytearray(), bytearray()
+        self.total    = 0
+        self.head_max = head
+        self.tail_max = tail
+
+    def feed(self, chunk: bytes):
+        self.total += len(chunk)
+        room = self.head_max - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            del self.tail[:-self.tail_max]
+
+    def text(self) -> str:
+        skipped = self.total - len(self.head) - len(self.tail)
+        if skipped <= 0:
+            return (self.head + self.tail).decode("utf-8", "replace")
+        return (f"{self.head.decode('utf-8', 'replace')}\n"
+                f"… [تم تخطي {skipped:,} بايت] …\n"
+                f"{self.tail.decode('utf-8', 'replace')}")
+
+class ExecResult:
+    __slots__ = ("stdout", "stderr", "returncode", "timed_out", "truncated", "started")
+
+    def __init__(self):
+        self.stdout, self.stderr = OutputWindow(), OutputWindow()
+        self.returncode = None
+        self.timed_out  = False
+        self.truncated  = False   # أُوقف لتجاوز EXEC_OUTPUT_LIMIT
+        self.started    = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def total(self) -> int:
+        return self.stdout.total + self.stderr.total
+
+def _kill_group(proc: asyncio.subprocess.Process):
+    """يقتل العملية وكل ما أطلقته (كل عملية تنفيذ في session خاصة)"""
     try:
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py',
-                                         delete=False, encoding='utf-8') as f:
-            f.write(code)
-            tmp_path = f.name
-
-        result = await asyncio.to_thread(
-            lambda: subprocess.run(
-                [sys.executable, tmp_path],
-                capture_output=True,
-                text=True,
-                timeout=30,  # 30 ثانية كحد أقصى
-                encoding='utf-8'
-            )
-        )
-        os.unlink(tmp_path)
+        os.killpg(proc.pid, 9)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+async def stream_process(proc: asyncio.subprocess.Process, timeout: float,
+                         on_output=None, limit: int = EXEC_OUTPUT_LIMIT,
+                         interval: float = STREAM_EDIT_INTERVAL) -> ExecResult:
+    """
+    يقرأ stdout/stderr أولاً بأول دون تخزين كل الناتج:
+    - تجاوز limit بايت أو المهلة → قتل مجموعة العمليات فوراً
+    - on_output(result) يُستدعى كل interval ثانية إن وصل ناتج جديد (عرض حي)
+    """
+    res = ExecResult()
+
+    async def drain(stream, window: OutputWindow):
+        while chunk := await stream.read(65536):
+            window.feed(chunk)
+            if res.total > limit and not res.truncated:
+                res.truncated = True
+                _kill_group(proc)
+
+    finished = asyncio.Event()
+
+    async def ticker():
+        # لا يُلغى أثناء الإرسال: رسالة نصف مرسلة تضيع معرّفها
+        seen = 0
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(finished.wait(), interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if res.total != seen:
+                seen = res.total
+                try:
+                    await on_output(res)
+                except Exception as e:
+                    print(f"Exec progress error: {e}")
+
+    async def run():
+        # proc.wait() ينتظر إغلاق الأنابيب أيضاً، وعملية خلفية (cmd &) قد تُبقيها مفتوحة
+        # بعد خروج العملية الرئيسية؛ نمهلها ثانية ثم تُقتل المجموعة
+        while not readers.done():
+            await asyncio.wait([readers], timeout=0.2)
+            if proc.returncode is not None:
+                await asyncio.wait([readers], timeout=1.0)
+                return
 
-        output = ""
-        if result.stdout:
-            output += f"✅ الناتج:\n{result.stdout}"
-        if result.stderr:
-            output += f"\n⚠️ أخطاء:\n{result.stderr}"
-        return output.strip() or "✅ تم التنفيذ بنجاح (لا يوجد ناتج)"
+    readers = asyncio.gather(drain(proc.stdout, res.stdout), drain(proc.stderr, res.stderr))
+    tick = asyncio.create_task(ticker()) if on_output else None
+    try:
+        await asyncio.wait_for(run(), timeout)
+    except asyncio.TimeoutError:
+        res.timed_out = True
+    finally:
+        finished.set()
+        _kill_group(proc)
+        await proc.wait()
+        await readers
+        if tick:
+            await tick
+    res.returncode = None if res.timed_out else proc.returncode
+    return res
+
+def format_exec_result(res: ExecResult, timeout: float, empty: str) -> str:
+    output = ""
+    if res.stdout.total:
+        output += f"✅ الناتج:\n{res.stdout.text()}"
+    if res.stderr.total:
+        output += f"\n⚠️ أخطاء:\n{res.stderr.text()}"
+    if res.timed_out:
+        output += f"\n❌ انتهت مهلة التنفيذ ({timeout:.0f} ثانية)"
+    elif res.truncated:
+        output += f"\n✂️ أُوقف التنفيذ: تجاوز الناتج {EXEC_OUTPUT_LIMIT // 1024}KB"
+    elif res.returncode and res.returncode < 0:
+        output += f"\n⛔ أُوقف بواسطة الإشارة {-res.returncode} (تجاوز حدود الموارد؟)"
+    return output.strip() or empty
+
+class SandboxPool:
+    """
+    مجموعة عمليات Python جاهزة لتنفيذ كود المستخدم.
+    - تكلفة تشغيل المفسّر تُدفع مسبقاً خارج مسار الطلب
+    - حدود: CPU، الذاكرة (address space)، الملفات المفتوحة، حجم الملفات، حجم الناتج، ومهلة زمنية
+    - كل عامل في session خاصة: عند التجاوز تُقتل مجموعة العمليات كاملة
+    """
+
+    def __init__(self, size: int = SANDBOX_POOL_SIZE, max_jobs: int = SANDBOX_MAX_JOBS,
+                 cpu_sec: int = SANDBOX_CPU_SEC, mem_mb: int = SANDBOX_MEM_MB,
+                 max_files: int = SANDBOX_MAX_FILES, file_mb: int = SANDBOX_FILE_MB):
+        self.size       = size
+        self.limits     = [str(cpu_sec), str(mem_mb << 20), str(max_files), str(file_mb << 20)]
+        self.idle: deque[tuple[asyncio.subprocess.Process, str]] = deque()
+        self.spawning   = 0
+        self.warm = self.cold = self.killed = 0
+        self._jobs      = asyncio.Semaphore(max_jobs)
+
+    async def start(self):
+        await self._refill()
+
+    async def _spawn(self) -> tuple[asyncio.subprocess.Process, str]:
+        workdir = tempfile.mkdtemp(prefix="sandbox-")
+        env = {"PATH": os.environ.get("PATH", "/usr/bin:/bin"), "HOME": workdir,
+               "TMPDIR": workdir, "LANG": "C.UTF-8", "PYTHONIOENCODING": "utf-8"}
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-I", "-c", _SANDBOX_BOOT, *self.limits,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=workdir, env=env, start_new_session=True)
+        return proc, workdir
 
-    except subprocess.TimeoutExpired:
-        return "❌ انتهت مهلة التنفيذ (30 ثانية)"
+    async def _refill(self):
+        while len(self.idle) + self.spawning < self.size:
+            self.spawning += 1
+            try:
+                self.idle.append(await self._spawn())
+            except Exception as e:
+                print(f"Sandbox spawn error: {e}")
+                return
+            finally:
+                self.spawning -= 1
+
+    async def _acquire(self) -> tuple[asyncio.subprocess.Process, str]:
+        while self.idle:
+            proc, workdir = self.idle.popleft()
+            if proc.returncode is None:
+                self.warm += 1
+                return proc, workdir
+            await self._discard(proc, workdir)
+        self.cold += 1
+        return await self._spawn()
+
+    @staticmethod
+    async def _discard(proc: asyncio.subprocess.Process, workdir: str):
+        _kill_group(proc)
+        await proc.wait()
+        await asyncio.to_thread(shutil.rmtree, workdir, True)
+
+    async def run(self, code: str, timeout: float = SANDBOX_TIMEOUT, on_output=None) -> ExecResult:
+        async with self._jobs:
+            proc, workdir = await self._acquire()
+            background_task(self._refill())
+            try:
+                try:
+                    proc.stdin.write(code.encode("utf-8"))
+                    await proc.stdin.drain()
+                    proc.stdin.close()
+                except ConnectionError:
+                    pass
+                res = await stream_process(proc, timeout, on_output)
+            finally:
+                await self._discard(proc, workdir)
+            if res.timed_out or res.truncated:
+                self.killed += 1
+            return res
+
+    async def close(self):
+        while self.idle:
+            await self._discard(*self.idle.popleft())
+
+    def stats(self) -> str:
+        return (f"جاهز {len(self.idle)} | دافئ {self.warm} | بارد {self.cold} | "
+                f"أُوقف {self.killed}")
+
+sandbox = SandboxPool()
+
+@traced("execute_code")
+async def execute_code(code: str, on_output=None) -> str:
+    """ينفذ كود Python في عامل sandbox جاهز ويعيد النتيجة"""
+    try:
+        res = await sandbox.run(code, on_output=on_output)
     except Exception as e:
         return f"❌ خطأ في التنفيذ: {e}"
+    return format_exec_result(res, SANDBOX_TIMEOUT, "✅ تم التنفيذ بنجاح (لا يوجد ناتج)")
 
-async def execute_shell(command: str) -> str:
+@traced("execute_shell")
+async def execute_shell(command: str, on_output=None) -> str:
     """ينفذ أمر shell"""
     try:
-        result = await asyncio.to_thread(
-            lambda: subprocess.run(
-                command, shell=True,
-                capture_output=True,
-                text=True,
-                timeout=20,
-                encoding='utf-8'
-            )
-        )
-        output = ""
-        if result.stdout:
-            output += f"✅ الناتج:\n{result.stdout}"
-        if result.stderr:
-            output += f"\n⚠️ أخطاء:\n{result.stderr}"
-        return output.strip() or "✅ تم التنفيذ"
-    except subprocess.TimeoutExpired:
-        return "❌ انتهت مهلة التنفيذ"
+        proc = await asyncio.create_subprocess_shell(
+            command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, start_new_session=True)
+        res = await stream_process(proc, EXEC_SHELL_TIMEOUT, on_output)
     except Exception as e:
         return f"❌ خطأ: {e}"
+    return format_exec_result(res, EXEC_SHELL_TIMEOUT, "✅ تم التنفيذ")
 
 def extract_code_block(text: str) -> str:
     """يستخرج الكود من ```python ... ```"""
@@ -356,33 +2926,132 @@ def extract_shell_command(text: str) -> str:
     matches = re.findall(pattern, text, re.DOTALL)
     return matches[0].strip() if matches else ""
 
+# ================================================================
+# 7.1 مُجدول مراحل الـ pipeline (DAG)
+# ================================================================
+class Stage:
+    """مرحلة واحدة: fn(results) async، وتبدأ فور انتهاء كل مراحل deps"""
+
+    def __init__(self, name: str, fn, deps: tuple = ()):
+        self.name = name
+        self.fn   = fn
+        self.deps = tuple(deps)
+
+class PipelineReport:
+    """توقيت كل مرحلة (بداية/نهاية نسبةً لبداية الـ pipeline) + المسار الحرج"""
+
+    def __init__(self, label: str, stages: list[Stage], timings: dict, wall: float):
+        self.label   = label
+        self.timings = timings
+        self.wall    = wall
+        deps = {st.name: st.deps for st in stages}
+        # المسار الحرج: من المرحلة التي انتهت أخيراً رجوعاً عبر أبطأ اعتمادية
+        path, cur = [], max(timings, key=lambda n: timings[n][1]) if timings else None
+        while cur is not None:
+            path.append(cur)
+            done = [d for d in deps[cur] if d in timings]
+            cur  = max(done, key=lambda d: timings[d][1]) if done else None
+        self.critical_path = path[::-1]
+
+    def __str__(self) -> str:
+        busy = sum(end - start for start, end in self.timings.values())
+        path = " → ".join(f"{n}({self.timings[n][1] - self.timings[n][0]:.2f}s)"
+                          for n in self.critical_path)
+        return (f"[{self.label}] wall={self.wall:.2f}s stages={busy:.2f}s "
+                f"overlap={busy / self.wall if self.wall else 0:.1f}x critical: {path}")
+
+async def run_pipeline(label: str, stages: list[Stage]) -> tuple[dict, PipelineReport]:
+    """ينفذ مراحل الـ DAG بأقصى توازٍ تسمح به الاعتماديات"""
+    by_name = {st.name: st for st in stages}
+    order, seen = [], set()
+    def visit(name, trail=()):
+        if name in trail:
+            raise ValueError(f"pipeline cycle: {' → '.join(trail + (name,))}")
+        if name not in seen:
+            for dep in by_name[name].deps:
+                visit(dep, trail + (name,))
+            seen.add(name)
+            order.append(by_name[name])
+    for st in stages:
+        visit(st.name)
+
+    loop    = asyncio.get_running_loop()
+    t0      = loop.time()
+    results = {}
+    timings = {}
+    tasks: dict[str, asyncio.Task] = {}
+
+    async def run(st: Stage):
+        if st.deps:
+            await asyncio.gather(*(tasks[d] for d in st.deps))
+        start = loop.time() - t0
+        with tracer.span(f"stage.{st.name}"):
+            results[st.name] = await st.fn(results)
+        timings[st.name] = (start, loop.time() - t0)
+
+    for st in order:
+        tasks[st.name] = asyncio.create_task(run(st))
+    outcome = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    report  = PipelineReport(label, order, timings, loop.time() - t0)
+    print(report)
+    pipeline_reports.append(report)
+    errors = [e for e in outcome if isinstance(e, BaseException)]
+    if errors:
+        raise errors[0]
+    return results, report
+
+# آخر تقارير التوقيت (للمراقبة)
+pipeline_reports: deque[PipelineReport] = deque(maxlen=50)
+
 # ================================================================
 # 8. الوكيل الرئيسي - تعاون الثلاثة
 # ================================================================
-async def run_three_agents(bot: Bot, chat_id: int, user_input: str, ctx: str):
+@traced("three_agents")
+async def run_three_agents(bot: Bot, chat_id: int, user_input: str, ctx: TurnContext | None = None):
     """
     الباحث → يلخص ويبحث
     المبرمج → يكتب الكود
     المنفذ → ينفذ ويبلغ بالنتيجة
+
+    المراحل المستقلة تعمل معاً: رسالة الحالة، بناء السياق، استخراج الكلمات،
+    والبحث الأول بنص الطلب كما هو.
     """
 
+    # كل رسائل الحالة في رسالة واحدة تُعدّل
+    progress = ProgressMessage(bot, chat_id)
+
     # ──────────────────────────────────────────
     # الخطوة 1: الباحث يلخص ويبحث
     # ──────────────────────────────────────────
-    await safe_send(bot, chat_id, "🔍 الباحث يحلل ويبحث...")
+    async def status(r):
+        await progress.step("🔍 الباحث يحلل ويبحث...")
+
+    async def context(r):
+        # يُجمع مرة واحدة للطلب؛ الباحث يأخذ النسخة الكاملة والمبرمج المختصرة
+        return ctx if ctx is not None else await assemble_context(chat_id, user_input)
 
     # تلخيص السؤال واستخراج كلمات البحث
-    search_keywords = await groq_call(
-        f"استخرج كلمات بحث مناسبة (3-5 كلمات) من هذا الطلب: {user_input}",
-        "أخرج كلمات البحث فقط بدون شرح.",
-        50
-    )
+    async def keywords(r):
+        return await groq_call(
+            f"استخرج كلمات بحث مناسبة (3-5 كلمات) من هذا الطلب: {user_input}",
+            "أخرج كلمات البحث فقط بدون شرح.",
+            50, cache_ttl=LLM_CACHE_TTL["keywords"], site="keywords"
+        )
+
+    async def raw_search(r):
+        return await web_search(user_input, 4)
 
-    search_results = await web_search(search_keywords or user_input, 4)
+    async def keyword_search(r):
+        kw = r["keywords"]
+        if not kw or SearchService.normalize(kw) == SearchService.normalize(user_input):
+            return ""
+        return await web_search(kw, 4)
 
-    researcher_summary = await groq_call(
-        f"""السياق السابق:
-{ctx}
+    async def researcher(r):
+        search_results = "\n\n".join(x for x in (r["keyword_search"], r["raw_search"]) if x)
+        return await stream_reply(bot, chat_id,
+            f"""السياق السابق:
+{r["context"]}
 
 طلب المستخدم: {user_input}
 
@@ -393,25 +3062,21 @@ async def run_three_agents(bot: Bot, chat_id: int, user_input: str, ctx: str):
 1. ملخص واضح للمطلوب
 2. المعلومات المفيدة من البحث
 3. ما يحتاجه المبرمج لإنجاز المهمة""",
-        f"أنت الباحث، {AGENTS['الباحث']['personality']}.",
-        400
-    )
-
-    if researcher_summary:
-        await safe_send(bot, chat_id,
-            f"{AGENTS['الباحث']['emoji']} الباحث:\n{researcher_summary}")
+            f"أنت الباحث، {AGENTS['الباحث']['personality']}.",
+            header=f"{AGENTS['الباحث']['emoji']} الباحث:\n",
+            max_tokens=400, site="researcher"
+        )
 
     # ──────────────────────────────────────────
     # الخطوة 2: المبرمج يكتب الكود
     # ──────────────────────────────────────────
-    await safe_send(bot, chat_id, "💻 المبرمج يكتب الكود...")
-
-    programmer_code = await groq_call(
-        f"""ملخص الباحث:
-{researcher_summary}
+    async def programmer(r):
+        _, code = await asyncio.gather(progress.step("💻 المبرمج يكتب الكود..."), stream_reply(bot, chat_id,
+            f"""ملخص الباحث:
+{r["researcher"]}
 
 السياق:
-{ctx}
+{r["context"].compact()}
 
 الطلب الأصلي: {user_input}
 
@@ -420,32 +3085,37 @@ async def run_three_agents(bot: Bot, chat_id: int, user_input: str, ctx: str):
 - أضف معالجة للاستثناءات
 - اجعل الكود واضحاً مع تعليقات
 - ضع الكود داخل ```python ... ```""",
-        f"أنت المبرمج، {AGENTS['المبرمج']['personality']}. اكتب كوداً بدون أخطاء.",
-        1000, 0.3
-    )
-
-    if programmer_code:
-        await safe_send(bot, chat_id,
-            f"{AGENTS['المبرمج']['emoji']} المبرمج:\n{programmer_code}")
+            f"أنت المبرمج، {AGENTS['المبرمج']['personality']}. اكتب كوداً بدون أخطاء.",
+            header=f"{AGENTS['المبرمج']['emoji']} المبرمج:\n",
+            max_tokens=1000, temp=0.3, site="programmer"
+        ))
+        return code
 
     # ──────────────────────────────────────────
     # الخطوة 3: المنفذ ينفذ ويبلغ
     # ──────────────────────────────────────────
-    await safe_send(bot, chat_id, "⚡ المنفذ يشغّل الكود...")
+    executor = f"{AGENTS['المنفذ']['emoji']} المنفذ"
+    live = LiveMessage(bot, chat_id)
 
-    # استخراج الكود وتنفيذه
-    code_to_run = extract_code_block(programmer_code or "")
-    shell_cmd   = extract_shell_command(programmer_code or "")
+    async def exec_status(r):
+        await progress.step("⚡ المنفذ يشغّل الكود...")
 
-    execution_result = ""
+    # الناتج يظهر أثناء التشغيل في رسالة تُعدّل، ثم تُستبدل بالنتيجة النهائية
+    async def relay(res: ExecResult):
+        await live.replace(f"{executor} (يعمل... {res.elapsed:.0f}s):\n"
+                           f"{res.stdout.text() or res.stderr.text()}")
 
-    if code_to_run:
-        execution_result = await execute_code(code_to_run)
-    elif shell_cmd:
-        execution_result = await execute_shell(shell_cmd)
-    else:
+    async def execute(r):
+        programmer_code = r["programmer"]
+        # استخراج الكود وتنفيذه
+        code_to_run = extract_code_block(programmer_code or "")
+        shell_cmd   = extract_shell_command(programmer_code or "")
+        if code_to_run:
+            return await execute_code(code_to_run, relay)
+        if shell_cmd:
+            return await execute_shell(shell_cmd, relay)
         # لو مافي كود قابل للتنفيذ، المنفذ يشرح الخطوات
-        execution_result = await groq_call(
+        return await groq_call(
             f"""الكود المقترح من المبرمج:
 {programmer_code}
 
@@ -456,123 +3126,409 @@ async def run_three_agents(bot: Bot, chat_id: int, user_input: str, ctx: str):
 2. ما الأوامر التي يجب تشغيلها
 3. ما النتيجة المتوقعة""",
             f"أنت المنفذ، {AGENTS['المنفذ']['personality']}.",
-            400
+            400, site="executor"
         )
 
-    await safe_send(bot, chat_id,
-        f"{AGENTS['المنفذ']['emoji']} المنفذ:\n{execution_result}")
+    async def report(r):
+        async def final():
+            await live.replace(f"{executor}:\n{r['execute']}")
+            await live.finish()
+        await asyncio.gather(progress.done(), final())
 
-    return execution_result
+    results, _ = await run_pipeline(f"three_agents chat={chat_id}", [
+        Stage("status",         status),
+        Stage("context",        context),
+        Stage("keywords",       keywords),
+        Stage("raw_search",     raw_search),
+        Stage("keyword_search", keyword_search, ("keywords",)),
+        Stage("researcher",     researcher,     ("status", "context", "raw_search", "keyword_search")),
+        Stage("programmer",     programmer,     ("researcher",)),
+        Stage("exec_status",    exec_status,    ("programmer",)),
+        Stage("execute",        execute,        ("programmer",)),
+        Stage("report",         report,         ("execute", "exec_status")),
+    ])
+    return results["execute"]
 
 # ================================================================
-# 9. الوكيل الرئيسي الذكي
+# 8.1 الموجّه المحلي (أي مسار يحتاجه الطلب قبل أي استدعاء للنموذج)
 # ================================================================
-async def master_agent(bot: Bot, chat_id: int, user_input: str):
-    count = save_msg(chat_id, "المستخدم", user_input)
-    asyncio.create_task(maybe_summarize(chat_id, count))
+# المسارات من الأرخص للأغلى: رد مباشر، بحث + رد، فريق كامل (4 استدعاءات + تنفيذ)
+TIERS = ("quick", "search", "team")
+TIER_LABELS = {"quick": "سريع", "search": "بحث", "team": "فريق"}
+
+def _rx(*words: str, whole: bool = False) -> re.Pattern:
+    """regex لكلمات/عبارات مطبّعة بنفس normalize_arabic؛ whole = الرسالة كلها هي العبارة"""
+    alt = "|".join(re.escape(normalize_arabic(w)) for w in words)
+    if whole:
+        return re.compile(rf"^\W*(?:{alt})\W*$")
+    return re.compile(rf"(?:^|\W)(?:{alt})(?=$|\W)")
 
-    ctx = build_context(chat_id, user_input)
+# قواعد عالية الدقة فقط؛ ما لا تحسمه يذهب للنموذج
+_ROUTE_RULES = [
+    ("team", "code", re.compile(r"```|\bdef \w+\(|\bimport \w+|\bclass \w+[:(]|traceback|"
+                                r"\w+error:|\$ \w+|console\.log|select .+ from ")),
+    ("team", "write_code", _rx("اكتب كود", "اكتب سكريبت", "اكتب برنامج", "اكتب داله", "برمج لي",
+                               "write a script", "write code", "write a function")),
+    ("team", "run", _rx("شغل الكود", "شغل السكريبت", "نفذ الكود", "نفذ السكريبت",
+                        "run this", "run the code", "execute")),
+    ("search", "fresh", _rx("ابحث", "دور على", "اخبار", "احدث", "سعر", "اسعار", "طقس",
+                            "اليوم", "هذا الاسبوع", "الحالي", "حاليا", "news", "latest", "price", "weather", "today")),
+    ("search", "url", re.compile(r"https?://")),
+    ("quick", "smalltalk", _rx("مرحبا", "اهلا", "السلام عليكم", "شكرا", "شكرا لك", "شكرا جزيلا", "تمام",
+                               "صباح الخير", "مساء الخير", "كيف حالك", "hi", "hello", "thanks",
+                               "thank you", "ok", whole=True)),
+]
 
-    # هل يحتاج تعاون الثلاثة؟
-    needs_team = any(w in user_input for w in [
+# بيانات تدريب أولية صغيرة؛ ROUTER_TRAIN_FILE (JSONL: {"text","tier"}) يضيف عليها
+_ROUTE_SEED = {
+    "quick": [
+        "ما الفرق بين list و tuple؟", "اشرح لي الـ GIL باختصار", "ما هي عاصمة فرنسا؟",
+        "ما معنى كلمة خوارزمية", "كيف اتعلم البرمجة من الصفر", "اشرح مفهوم التعاود recursion",
+        "ما هو الذكاء الاصطناعي", "لخص لي ما قلناه", "ترجم هذه الجملة للانجليزية",
+        "ما الفرق بين TCP و UDP", "عرّف قاعدة البيانات العلائقية", "اعطني نصيحة للمذاكرة",
+        "what is a closure in javascript", "explain big o notation", "ماذا تعني REST API",
+        "هل بايثون لغة مفسرة", "من انت", "ما رأيك في هذه الفكرة",
+        "ما هي مزايا البرمجة الوظيفية وعيوبها", "كيف يعمل التشفير بالمفتاح العام",
+        "لماذا تعتبر لغة C سريعة مقارنة بغيرها", "ما هو الفرق بين العملية والخيط في نظام التشغيل",
+        "اشرح لي كيف تعمل الشبكات العصبية ببساطة", "متى أستخدم قاعدة بيانات NoSQL بدل SQL",
+        "كيف أنظم وقتي بين العمل والدراسة", "why is the sky blue",
+    ],
+    "search": [
+        "ما هي آخر أخبار الذكاء الاصطناعي", "كم سعر الذهب اليوم", "ما هو أحدث إصدار من بايثون",
+        "ابحث عن مكتبة لتحليل ملفات pdf", "من فاز بالمباراة أمس", "ما حالة الطقس في الرياض",
+        "ما هي أفضل مكتبة رسوم بيانية حالياً", "متى صدر iPhone الجديد", "اعطني مصادر عن التعلم الآلي",
+        "latest version of django", "ما هي التحديثات الجديدة في ويندوز", "كم عدد سكان مصر الآن",
+        "ابحث لي عن دورات مجانية في البرمجة", "ما هي الشركات التي تستخدم rust",
+        "من هو المدير التنفيذي الحالي لشركة تسلا", "ما نتيجة الانتخابات الأخيرة",
+        "هل توجد وظائف مطورين في دبي هذا الشهر", "ما هو سعر صرف الدولار", "متى موعد مؤتمر apple القادم",
+        "what happened in the stock market this week",
+    ],
+    "team": [
+        "اكتب سكريبت python يحسب مجموع الأعداد من 1 إلى 100", "اكتب كود يقرأ ملف csv ويحسب المتوسط",
+        "حل مشكلة error في برنامج بايثون", "أتمتة نسخ الملفات من مجلد لآخر", "حوّل ملف json إلى csv",
+        "استخرج الإيميلات من هذا النص بكود", "صمم دالة ترتب قائمة أرقام", "اكتب برنامج يرسل طلب api",
+        "عندي خطأ في الكود ولا أعرف السبب", "شغّل هذا الكود وأخبرني بالنتيجة",
+        "create a python script that renames files", "fix this bug in my function",
+        "أنشئ جدول قاعدة بيانات sqlite وأضف بيانات", "اكتب regex يتحقق من رقم الهاتف",
+        "برمج بوت بسيط يرد على الرسائل", "احسب لي المتوسط والانحراف المعياري لهذه الأرقام بالكود",
+        "أريد دالة بايثون تتحقق من كلمة المرور", "حوّل النص إلى أحرف كبيرة باستخدام بايثون",
+        "سكريبت يحذف الملفات القديمة من المجلد", "ارسم رسماً بيانياً لهذه البيانات باستخدام matplotlib",
+        "اعمل لي برنامج آلة حاسبة", "لماذا يظهر لي هذا الخطأ IndexError في الكود",
+        "implement binary search in python", "اكتب استعلام SQL يجمع المبيعات حسب الشهر",
+    ],
+}
+
+def _route_features(text: str) -> list[str]:
+    toks = re.findall(r"\w+", normalize_arabic(text))
+    feats = toks + [f"{a}_{b}" for a, b in zip(toks, toks[1:])]
+    feats.append(f"len:{min(len(toks) // 6, 4)}")
+    if "?" in text or "؟" in text:
+        feats.append("q:1")
+    return feats
+
+class NaiveBayesRouter:
+    """Multinomial naive Bayes صغير (كلمات + أزواج كلمات) يُدرّب عند التشغيل على CPU"""
+
+    def __init__(self, labels=TIERS, alpha: float = 1.0):
+        self.labels = labels
+        self.alpha  = alpha
+        self.docs   = dict.fromkeys(labels, 0)
+        self.total  = dict.fromkeys(labels, 0)
+        self.counts = {label: {} for label in labels}
+        self.vocab: set[str] = set()
+
+    def learn(self, text: str, label: str):
+        self.docs[label] += 1
+        counts = self.counts[label]
+        for f in _route_features(text):
+            counts[f] = counts.get(f, 0) + 1
+            self.total[label] += 1
+            self.vocab.add(f)
+
+    def fit(self, samples):
+        for text, label in samples:
+            self.learn(text, label)
+        return self
+
+    def predict(self, text: str) -> tuple[str, float]:
+        """(المسار الأرجح، احتماله)"""
+        feats = _route_features(text)
+        n, v  = sum(self.docs.values()), len(self.vocab) + 1
+        logp  = {}
+        for label in self.labels:
+            counts, denom = self.counts[label], self.total[label] + self.alpha * v
+            logp[label] = np.log((self.docs[label] + 1) / (n + len(self.labels))) + sum(
+                np.log((counts.get(f, 0) + self.alpha) / denom) for f in feats)
+        top  = max(logp, key=logp.get)
+        norm = sum(np.exp(lp - logp[top]) for lp in logp.values())
+        return top, float(1 / norm)
+
+def _route_samples(path: str | None = ROUTER_TRAIN_FILE):
+    for tier, texts in _ROUTE_SEED.items():
+        for text in texts:
+            yield text, tier
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row.get("tier") in TIERS and row.get("text"):
+                    yield row["text"], row["tier"]
+
+def legacy_needs_team(text: str) -> bool:
+    """القاعدة السابقة (كلمات مفتاحية أو أطول من 40 حرفاً) — تُستخدم كأساس لحساب التوفير"""
+    return any(w in text for w in [
         "كود", "برمجة", "سكريبت", "script", "python", "اكتب", "برنامج",
         "أتمتة", "تنفيذ", "شغّل", "حل", "خطأ", "error", "bug",
         "api", "قاعدة بيانات", "ملف", "استخرج", "حوّل"
-    ]) or len(user_input) > 40
+    ]) or len(text) > 40
 
-    if needs_team:
-        await run_three_agents(bot, chat_id, user_input, ctx)
-    else:
-        # رد سريع من الباحث
-        response = await groq_call(
-            f"السياق:\n{ctx}\n\nالسؤال: {user_input}",
-            f"أنت الباحث، {AGENTS['الباحث']['personality']}. أجب بشكل مباشر ومفيد.",
-            500
-        )
-        if response:
-            await safe_send(bot, chat_id,
-                f"{AGENTS['الباحث']['emoji']} الباحث:\n{response}")
+class Route:
+    __slots__ = ("tier", "source", "confidence")
+
+    def __init__(self, tier: str, source: str, confidence: float = 1.0):
+        self.tier, self.source, self.confidence = tier, source, confidence
+
+class Router:
+    """
+    يختار المسار بسلسلة مصنِّفات قابلة للاستبدال (register): قواعد ← naive Bayes ← متابعة ← بحث.
+    - كاش للقرار لكل (محادثة، نص مطبّع) لمدة ROUTER_CACHE_TTL
+    - ثقة النموذج الأقل من ROUTER_MIN_CONFIDENCE: رسالة قصيرة بعد طلب للفريق في نفس المحادثة
+      تتبعه (مثل "عدّله" / "أعد المحاولة")، وغير ذلك "search" (أرخص من الفريق وأدق من الرد المباشر)
+    - الإحصائيات: عدد ومدة واستدعاءات النموذج لكل مسار، والتوفير مقارنة بالقاعدة السابقة
+    """
 
-    save_msg(chat_id, "الفريق", f"تمت معالجة: {user_input[:60]}")
-    save_lesson(chat_id, f"نفّذنا: {user_input[:60]}")
+    def __init__(self, mode: str = ROUTER_MODE, min_confidence: float = ROUTER_MIN_CONFIDENCE,
+                 cache_ttl: float = ROUTER_CACHE_TTL, max_items: int = ROUTER_CACHE_ITEMS,
+                 followup: float = ROUTER_FOLLOWUP_SEC):
+        self.mode, self.min_confidence = mode, min_confidence
+        self.cache_ttl, self.max_items, self.followup = cache_ttl, max_items, followup
+        self.model = NaiveBayesRouter().fit(_route_samples())
+        self.classifiers = [self._rules, self._classify, self._follow_up, self._fallback]
+        self._cache: OrderedDict[tuple[int, str], tuple[float, Route]] = OrderedDict()
+        self._last: OrderedDict[int, tuple[float, str]] = OrderedDict()
+        self.counts  = dict.fromkeys(TIERS, 0)
+        self.sources: dict[str, int] = {}
+        self.calls   = dict.fromkeys(TIERS, 0)
+        self.seconds = dict.fromkeys(TIERS, 0.0)
+        self.legacy_team = dict.fromkeys(TIERS, 0)   # قررت القاعدة السابقة "فريق" لهذه الرسائل
+
+    def register(self, fn, first: bool = True):
+        """fn(chat_id, text) → Route | None"""
+        if first:
+            self.classifiers.insert(0, fn)
+        else:
+            self.classifiers.append(fn)
+
+    # --- المصنِّفات ---
+    def _rules(self, chat_id: int, text: str) -> Route | None:
+        norm = normalize_arabic(text)
+        for tier, name, rx in _ROUTE_RULES:
+            if rx.search(norm):
+                return Route(tier, f"rule:{name}")
+        return None
+
+    def _follow_up(self, chat_id: int, text: str) -> Route | None:
+        last = self._last.get(chat_id)
+        if (last and last[1] == "team" and time.monotonic() - last[0] < self.followup
+                and len(text.split()) <= 4):
+            return Route("team", "follow_up")
+        return None
+
+    def _classify(self, chat_id: int, text: str) -> Route | None:
+        tier, p = self.model.predict(text)
+        return Route(tier, "model", p) if p >= self.min_confidence else None
+
+    def _fallback(self, chat_id: int, text: str) -> Route:
+        return Route("search", "unsure")
+
+    def route(self, chat_id: int, text: str) -> Route:
+        if self.mode == "team":
+            decision = Route("team", "mode")
+        elif self.mode == "legacy":
+            decision = Route("team" if legacy_needs_team(text) else "quick", "legacy")
+        else:
+            key = (chat_id, " ".join(normalize_arabic(text).split()))
+            now = time.monotonic()
+            hit = self._cache.get(key)
+            if hit and hit[0] > now:
+                self._cache.move_to_end(key)
+                decision = Route(hit[1].tier, "cache", hit[1].confidence)
+            else:
+                decision = next(d for fn in self.classifiers if (d := fn(chat_id, text)) is not None)
+                self._cache[key] = (now + self.cache_ttl, decision)
+                while len(self._cache) > self.max_items:
+                    self._cache.popitem(last=False)
+        self._last[chat_id] = (time.monotonic(), decision.tier)
+        self._last.move_to_end(chat_id)
+        while len(self._last) > self.max_items:
+            self._last.popitem(last=False)
+        source = decision.source.split(":")[0]
+        self.sources[source] = self.sources.get(source, 0) + 1
+        return decision
+
+    def record(self, tier: str, text: str, calls: int, seconds: float):
+        self.counts[tier]  += 1
+        self.calls[tier]   += calls
+        self.seconds[tier] += seconds
+        self.legacy_team[tier] += legacy_needs_team(text)
+
+    def savings(self) -> tuple[float, float]:
+        """
+        (استدعاءات، ثوانٍ) وفّرها التوجيه مقارنة بالقاعدة السابقة: رسائل كانت ستذهب للفريق
+        وأخذت مساراً أرخص، بمتوسطات المسارات المقاسة فعلاً (وتقدير 4 استدعاءات قبل أول طلب للفريق)
+        """
+        n_team = self.counts["team"]
+        team_calls = self.calls["team"] / n_team if n_team else 4.0
+        team_secs  = self.seconds["team"] / n_team if n_team else 0.0
+        calls = secs = 0.0
+        for tier in ("quick", "search"):
+            n = self.counts[tier]
+            if n:
+                calls += self.legacy_team[tier] * (team_calls - self.calls[tier] / n)
+                secs  += self.legacy_team[tier] * max(0.0, team_secs - self.seconds[tier] / n)
+        return calls, secs
+
+    def stats(self) -> str:
+        tiers = " | ".join(
+            f"{TIER_LABELS[t]} {self.counts[t]}"
+            + (f" ({self.calls[t] / self.counts[t]:.1f} استدعاء، {self.seconds[t] / self.counts[t]:.1f}s)"
+               if self.counts[t] else "")
+            for t in TIERS)
+        sources = " | ".join(f"{k} {v}" for k, v in sorted(self.sources.items()))
+        calls, secs = self.savings()
+        return (f"{tiers}\nالمصدر: {sources or '-'}\n"
+                f"وفّر ~{calls:.0f} استدعاء و ~{secs:.0f}s مقارنة بالقاعدة السابقة")
+
+router = Router()
 
 # ================================================================
-# 10. الحلقة الرئيسية
+# 9. الوكيل الرئيسي الذكي
 # ================================================================
-# حل مشكلة المتغيرات العامة - كل chat_id له state خاص
-user_states: dict[int, dict] = {}
+@traced("master_agent")
+async def master_agent(bot: Bot, chat_id: int, user_input: str):
+    pending = await save_msg(chat_id, "المستخدم", user_input)
+    summarizer.notify(chat_id, pending)
 
-async def main():
-    init_db()
-    bot = Bot(token=TELEGRAM_TOKEN)
+    # أي مسار يحتاجه الطلب؟ (محلياً بدون استدعاء للنموذج)
+    route = router.route(chat_id, user_input)
+    calls = [0]
+    turn_llm_calls.set(calls)
+    start = time.perf_counter()
 
-    last_update_id = None
-    try:
-        updates = await bot.get_updates(offset=-1, timeout=5)
-        if updates:
-            last_update_id = updates[-1].update_id + 1
-    except Exception:
-        pass
+    with tracer.span(f"tier.{route.tier}"):
+        if route.tier == "team":
+            # السياق يُبنى كمرحلة داخل الـ pipeline بالتوازي مع البحث
+            await run_three_agents(bot, chat_id, user_input)
+        elif route.tier == "search":
+            # بحث واحد + رد الباحث، بدون كلمات مفتاحية ولا مبرمج ولا تنفيذ
+            ctx, results = await asyncio.gather(build_context(chat_id, user_input),
+                                                web_search(user_input, 4))
+            await stream_reply(bot, chat_id,
+                f"السياق:\n{ctx}\n\nنتائج البحث:\n{results[:1500] if results else 'لا يوجد نتائج'}"
+                f"\n\nالسؤال: {user_input}",
+                f"أنت الباحث، {AGENTS['الباحث']['personality']}. أجب بشكل مباشر اعتماداً على نتائج البحث.",
+                header=f"{AGENTS['الباحث']['emoji']} الباحث:\n",
+                max_tokens=600, cache_ttl=LLM_CACHE_TTL["quick"], site="search"
+            )
+        else:
+            # رد سريع من الباحث
+            ctx = await build_context(chat_id, user_input)
+            await stream_reply(bot, chat_id,
+                f"السياق:\n{ctx}\n\nالسؤال: {user_input}",
+                f"أنت الباحث، {AGENTS['الباحث']['personality']}. أجب بشكل مباشر ومفيد.",
+                header=f"{AGENTS['الباحث']['emoji']} الباحث:\n",
+                max_tokens=500, cache_ttl=LLM_CACHE_TTL["quick"], site="quick"
+            )
+    router.record(route.tier, user_input, calls[0], time.perf_counter() - start)
 
-    print("🚀 النظام جاهز: الباحث + المبرمج + المنفذ")
+    # تُرسلان معاً فتقعان في نفس دفعة الكتابة
+    await asyncio.gather(
+        save_msg(chat_id, "الفريق", f"تمت معالجة: {user_input[:60]}"),
+        save_lesson(chat_id, f"نفّذنا: {user_input[:60]}"),
+    )
 
-    while True:
+# ================================================================
+# 10. الحلقة الرئيسية
+# ================================================================
+async def handle_update(bot: Bot, update):
+    """يعالج رسالة واحدة (صوت / صورة / مستند / أمر / نص)"""
+    chat_id = update.message.chat_id
+    text    = update.message.text or ""
+    trace_chat.set(chat_id)
+
+    # --- صوت ---
+    if update.message.voice:
+        progress = ProgressMessage(bot, chat_id)
+        await progress.set("🎙️ جاري فهم الرسالة الصوتية...")
         try:
-            updates = await bot.get_updates(offset=last_update_id, timeout=20)
-            for update in updates:
-                if not update.message:
-                    continue
-                last_update_id = update.update_id + 1
-                chat_id = update.message.chat_id
-                text    = update.message.text or ""
-
-                # --- صوت ---
-                if update.message.voice:
-                    await safe_send(bot, chat_id, "🎙️ جاري فهم الرسالة الصوتية...")
-                    file        = await bot.get_file(update.message.voice.file_id)
-                    audio       = await file.download_as_bytearray()
-                    transcribed = await transcribe_voice(bytes(audio))
-                    if transcribed:
-                        await safe_send(bot, chat_id, f"🎙️ فهمت: {transcribed}")
-                        await master_agent(bot, chat_id, transcribed)
-                    else:
-                        await safe_send(bot, chat_id, "❌ لم أفهم الصوت، حاول مرة أخرى.")
-                    continue
+            transcribed = await media.transcribe(bot, update.message.voice)
+        except MediaTooLarge:
+            await progress.set(f"⚠️ الملف أكبر من {MEDIA_MAX_BYTES // 2**20}MB.")
+            return
+        if transcribed:
+            await progress.set(f"🎙️ فهمت: {transcribed}")
+            await master_agent(bot, chat_id, transcribed)
+        else:
+            await progress.set("❌ لم أفهم الصوت، حاول مرة أخرى.")
+        return
 
-                # --- صور ---
-                if update.message.photo:
-                    await safe_send(bot, chat_id, "🖼️ جاري تحليل الصورة...")
-                    file     = await bot.get_file(update.message.photo[-1].file_id)
-                    img      = await file.download_as_bytearray()
-                    q        = update.message.caption or "صف هذه الصورة بالتفصيل"
-                    analysis = await analyze_image(bytes(img), q)
-                    if analysis:
-                        await safe_send(bot, chat_id, f"🖼️ تحليل الصورة:\n\n{analysis}")
-                        save_msg(chat_id, "تحليل صورة", analysis)
-                    continue
+    # --- صور ---
+    if update.message.photo:
+        progress = ProgressMessage(bot, chat_id)
+        await progress.set("🖼️ جاري تحليل الصورة...")
+        q = update.message.caption or "صف هذه الصورة بالتفصيل"
+        try:
+            analysis = await media.analyze(bot, update.message.photo, q)
+        except MediaTooLarge:
+            await progress.set(f"⚠️ الملف أكبر من {MEDIA_MAX_BYTES // 2**20}MB.")
+            return
+        if analysis:
+            await progress.set(f"🖼️ تحليل الصورة:\n\n{analysis}")
+            await save_msg(chat_id, "تحليل صورة", analysis)
+        else:
+            await progress.set("❌ لم أستطع تحليل الصورة، حاول مرة أخرى.")
+        return
 
-                # --- مستند → RAG ---
-                if update.message.document:
-                    doc = update.message.document
-                    if doc.mime_type == "text/plain":
-                        await safe_send(bot, chat_id, "📄 جاري حفظ المستند...")
-                        file    = await bot.get_file(doc.file_id)
-                        content = (await file.download_as_bytearray()).decode("utf-8", errors="ignore")
-                        title   = doc.file_name or "مستند"
-                        added   = save_knowledge(chat_id, title, content)
-                        msg = (f"✅ تم حفظ '{title}' في قاعدة المعرفة!"
-                               if added else "ℹ️ هذا المستند موجود بالفعل.")
-                        await safe_send(bot, chat_id, msg)
-                    else:
-                        await safe_send(bot, chat_id, "⚠️ أدعم الملفات النصية (.txt) فقط.")
-                    continue
+    # --- مستند → RAG ---
+    if update.message.document:
+        doc = update.message.document
+        fmt = document_format(doc.file_name, doc.mime_type)
+        if fmt is None:
+            await safe_send(bot, chat_id, "⚠️ أدعم الملفات النصية فقط: txt و md و csv و json وملفات الكود.")
+            return
+        progress = ProgressMessage(bot, chat_id)
+        await progress.set("📄 جاري حفظ المستند...")
+        title = doc.file_name or "مستند"
+        # الملف يُكتب للقرص بعد DOC_SPOOL_BYTES ويُقرأ منه تدريجياً
+        with tempfile.SpooledTemporaryFile(DOC_SPOOL_BYTES) as f:
+            try:
+                await media.download(bot, doc.file_id, into=f, max_bytes=DOC_MAX_BYTES)
+            except MediaTooLarge:
+                await progress.set(f"⚠️ الملف أكبر من {DOC_MAX_BYTES // 2**20}MB.")
+                return
+            new, total, removed = await ingest_document(chat_id, title, f, fmt)
+        if not total:
+            msg = "⚠️ المستند فارغ."
+        elif not new and not removed:
+            msg = "ℹ️ هذا المستند موجود بالفعل."
+        elif new == total and not removed:
+            msg = f"✅ تم حفظ '{title}' في قاعدة المعرفة! ({total} جزء)"
+        else:
+            msg = f"✅ تم تحديث '{title}': {new} جزء جديد من {total}، والباقي محفوظ مسبقاً."
+            if removed:
+                msg += f" حُذف {removed} جزء لم يعد في الملف."
+        await progress.set(msg)
+        return
 
-                if not text:
-                    continue
+    if not text:
+        return
 
-                # --- الأوامر ---
-                if text == "/start":
-                    await safe_send(bot, chat_id, f"""مرحباً! أنا نظام الوكلاء الثلاثة 🤖
+    # --- الأوامر ---
+    if text == "/start":
+        await safe_send(bot, chat_id, f"""مرحباً! أنا نظام الوكلاء الثلاثة 🤖
 
 🔍 الباحث - يلخص ويبحث في الإنترنت
 💻 المبرمج - يكتب كوداً نظيفاً بدون أخطاء
@@ -586,55 +3542,575 @@ async def main():
 
 أرسل أي طلب برمجي وسيتعاون الفريق لإنجازه!""")
 
-                elif text == "/knowledge":
-                    docs = list_knowledge(chat_id)
-                    if docs:
-                        msg = "📚 قاعدة المعرفة:\n\n" + "\n".join(
-                            f"{i+1}. {d[1]}" for i, d in enumerate(docs))
-                        await safe_send(bot, chat_id, msg)
-                    else:
-                        await safe_send(bot, chat_id, "📚 فارغة. أرسل ملف .txt لإضافته!")
-
-                elif text == "/memory":
-                    ctx = build_context(chat_id)
-                    await safe_send(bot, chat_id,
-                        f"🧠 الذاكرة:\n\n{ctx[:2500]}" if ctx else "🧠 الذاكرة فارغة.")
-
-                elif text == "/clear":
-                    clear_all(chat_id)
-                    await safe_send(bot, chat_id, "🗑️ تم مسح كل شيء.")
-
-                elif text == "/status":
-                    conn = sqlite3.connect(DB_PATH)
-                    c    = conn.cursor()
-                    c.execute("SELECT COUNT(*) FROM messages  WHERE chat_id=?", (chat_id,))
-                    msgs = c.fetchone()[0]
-                    c.execute("SELECT COUNT(*) FROM summaries WHERE chat_id=?", (chat_id,))
-                    sums = c.fetchone()[0]
-                    c.execute("SELECT COUNT(*) FROM knowledge WHERE chat_id=?", (chat_id,))
-                    docs = c.fetchone()[0]
-                    conn.close()
-                    await safe_send(bot, chat_id, f"""📊 حالة النظام:
+    elif text == "/knowledge":
+        docs = await list_knowledge(chat_id)
+        if docs:
+            msg = "📚 قاعدة المعرفة:\n\n" + "\n".join(
+                f"{i+1}. {d[1]}" for i, d in enumerate(docs))
+            await safe_send(bot, chat_id, msg)
+        else:
+            await safe_send(bot, chat_id, "📚 فارغة. أرسل ملفاً نصياً (txt / md / csv / json / كود) لإضافته!")
+
+    elif text == "/memory":
+        ctx = await build_context(chat_id)
+        await safe_send(bot, chat_id,
+            f"🧠 الذاكرة:\n\n{ctx[:2500]}" if ctx else "🧠 الذاكرة فارغة.")
+
+    elif text == "/clear":
+        await clear_all(chat_id)
+        await safe_send(bot, chat_id, "🗑️ تم مسح كل شيء.")
+
+    elif text == "/status":
+        msgs, sums, docs = await get_stats(chat_id)
+        limits = "\n".join(
+            f"• {name}: طابور {st['queued']} | انتظار {st['avg_wait']:.1f}s "
+            f"(أقصى {st['max_wait']:.1f}s) | 429×{st['throttled']}"
+            for name, st in models.limiter.stats().items()) or "• لا طلبات بعد"
+        await safe_send(bot, chat_id, f"""📊 حالة النظام:
 
 الوكلاء: الباحث 🔍 | المبرمج 💻 | المنفذ ⚡
 الرسائل المحفوظة: {msgs}
 الملخصات: {sums}
 مستندات RAG: {docs}
+كاش النماذج: {llm_cache.stats()}
+كاش الوسائط: {media.stats()}
+عمّال التنفيذ: {sandbox.stats()}
+التلخيص: {summarizer.stats()}
+التوجيه: {router.stats()}
+
+حدود Groq:
+{limits}
+
+زمن المراحل:
+{tracer.summary(chat_id)}
 
 النماذج:
-• LLaMA 3.3 70B  - التفكير والكود
-• Whisper Large  - الصوت
-• LLaMA 4 Scout  - الصور""")
+{model_table.stats()}""")
 
-                else:
-                    await master_agent(bot, chat_id, text)
+    else:
+        await master_agent(bot, chat_id, text)
+
+class ChatDispatcher:
+    """
+    يوزع التحديثات على طوابير لكل محادثة:
+    - رسائل نفس المحادثة تُعالج بالترتيب
+    - المحادثات المختلفة تعمل بالتوازي (بحد أقصى MAX_CONCURRENT_CHATS)
+    - الحلقة الرئيسية لا تنتظر أي pipeline، فقط تجلب وتوزع
+    - on_done(update_id) بعد انتهاء كل تحديث أو رفضه (حفظ last_update_id، وتأكيد الاستلام في وضع WORKERS)
+    """
+
+    def __init__(self, bot: Bot, max_concurrent: int = MAX_CONCURRENT_CHATS,
+                 queue_size: int = CHAT_QUEUE_SIZE, max_pending: int = DISPATCH_MAX_PENDING,
+                 on_done=None):
+        self.bot         = bot
+        self.queue_size  = queue_size
+        self.max_pending = max_pending
+        self.on_done     = on_done
+        self.sem         = asyncio.Semaphore(max_concurrent)
+        self.queues:  dict[int, asyncio.Queue] = {}
+        self.workers: dict[int, asyncio.Task]  = {}
+        self.pending     = 0
+        # مُفعّل طالما يوجد مكان؛ مصدر التحديثات ينتظره قبل الجلب التالي (backpressure)
+        self.room        = asyncio.Event()
+        self.room.set()
+
+    def dispatch(self, update) -> bool:
+        chat_id = update.message.chat_id
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue(self.queue_size)
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            print(f"Dispatcher: queue full for chat {chat_id}, dropping update {update.update_id}")
+            background_task(safe_send(self.bot, chat_id,
+                "⏳ لديك طلبات كثيرة قيد المعالجة، انتظر قليلاً ثم أعد الإرسال."))
+            if self.on_done:
+                self.on_done(update.update_id)
+            return False
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self.room.clear()
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return True
+
+    async def _worker(self, chat_id: int):
+        queue = self.queues[chat_id]
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                async with self.sem:
+                    try:
+                        await handle_update(self.bot, update)
+                    except Exception as e:
+                        print(f"Handler error [{chat_id}]: {e}")
+                # التحديث يبقى معلقاً حتى تنتهي معالجته، لا عند سحبه من الطابور فقط:
+                # المنتظرون على sem لا يُحسبون مكاناً فارغاً
+                self.pending -= 1
+                if self.pending < self.max_pending:
+                    self.room.set()
+                if self.on_done:
+                    self.on_done(update.update_id)
+        finally:
+            # لا يوجد await هنا، فلا يمكن أن يصل تحديث جديد بين الفحص والحذف
+            self.workers.pop(chat_id, None)
+            self.queues.pop(chat_id, None)
+
+# حل مشكلة المتغيرات العامة - كل chat_id له state خاص
+user_states: dict[int, dict] = {}
+
+class WebhookServer:
+    """
+    مستقبل webhook بسيط فوق asyncio (HTTP/1.1 + keep-alive):
+    - يتحقق من ترويسة X-Telegram-Bot-Api-Secret-Token
+    - يضع التحديث في طابور محدود؛ عند امتلائه يرد 503 فيعيد تيليجرام الإرسال لاحقاً
+    - GET / للفحص الصحي
+    """
+    MAX_BODY     = 1 << 20
+    IDLE_TIMEOUT = 120
+    PUT_TIMEOUT  = 2.0
 
-        except TelegramError as e:
-            print(f"Telegram error: {e}")
-            await asyncio.sleep(5)
+    def __init__(self, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 queue_size: int = WEBHOOK_QUEUE):
+        self.path, self.secret = path, secret.encode()
+        self.host, self.port   = host, port
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.accepted = self.rejected = self.busy = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._conn, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _conn(self, reader, writer):
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (h := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413)
+                    break
+                body = await reader.readexactly(length)
+                await self._respond(writer, await self._handle(method, target, headers, body))
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method: str, target: str, headers: dict, body: bytes) -> int:
+        path = target.split("?", 1)[0]
+        if method == "GET" and path == "/":
+            return 200
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return 401
+        try:
+            data = json.loads(body)
+            int(data["update_id"])
+        except (ValueError, KeyError, TypeError):
+            return 400
+        try:
+            await asyncio.wait_for(self.queue.put(data), self.PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.busy += 1
+            return 503
+        self.accepted += 1
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status: int):
+        writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                     "Content-Length: 0\r\n\r\n".encode())
+        await writer.drain()
+
+class UpdateOffsets:
+    """
+    last_update_id الآمن للحفظ: أعلى id انتهت معالجته هو وكل ما قبله مما استُلم.
+    - start(id) عند التوزيع، finish(id) من on_done للموزع بعد انتهاء المعالجة
+    - ما انتهى فوق أقل تحديث جارٍ ينتظر في done حتى يتجاوزه الحد
+    - save() يحفظ الحد كلما تغير (التغييرات أثناء الكتابة تُجمع في الكتابة التالية)
+    """
+
+    def __init__(self, last: int):
+        self.last = self.saved = last
+        self.pending: set[int] = set()
+        self.done:    set[int] = set()
+        self._dirty   = asyncio.Event()   # الحد تغير (للحفظ)
+
+    def known(self, update_id: int) -> bool:
+        return update_id <= self.last or update_id in self.pending or update_id in self.done
+
+    def start(self, update_id: int):
+        self.pending.add(update_id)
+
+    def finish(self, update_id: int):
+        if update_id not in self.pending:
+            return
+        self.pending.discard(update_id)
+        self.done.add(update_id)
+        floor = min(self.pending, default=None)
+        below = [i for i in self.done if floor is None or i < floor]
+        if below:
+            self.last = max(self.last, *below)
+            self.done.difference_update(below)
+            self._dirty.set()
+
+    async def save(self):
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            if self.last == self.saved:
+                continue
+            last = self.last
+            try:
+                await set_state("last_update_id", last)
+                self.saved = last
+            except Exception as e:
+                print(f"Offset save error: {e}")
+                await asyncio.sleep(1)
+                self._dirty.set()
+
+async def run_polling(bot: Bot, dispatcher: ChatDispatcher):
+    await bot.delete_webhook()
+    # نكمل من آخر تحديث انتهت معالجته (محفوظ في القاعدة)، وإلا نتجاهل ما تراكم قبل التشغيل
+    last = await get_state("last_update_id")
+    last = int(last) if last else None
+    if last is None:
+        try:
+            updates = await bot.get_updates(offset=-1, timeout=5)
+            if updates:
+                last = updates[-1].update_id
+        except Exception:
+            pass
+
+    # تيليجرام يحذف كل تحديث أقل من offset، فالطلب التالي يؤكد استلام كل ما جُلب (لا ينتظر تحديثاً
+    # بطيئاً). كل تحديث يُحفظ قبلها في update_queue ويُحذف منها بعد انتهائه، فما بقي فيها يُعاد
+    # بعد إعادة التشغيل؛ last_update_id المحفوظ يبقى حد ما انتهى فعلاً
+    offsets = UpdateOffsets(-1 if last is None else last)
+    saver = asyncio.create_task(offsets.save())
+
+    def replay(conn):
+        conn.execute("DELETE FROM update_queue WHERE update_id <= ?", (offsets.last,))
+        return conn.execute("SELECT update_id, data FROM update_queue ORDER BY update_id").fetchall()
+
+    def enqueue(conn, rows):
+        conn.executemany("INSERT OR IGNORE INTO update_queue (update_id, data) VALUES (?,?)", rows)
+
+    def dequeue(conn, update_id):
+        conn.execute("DELETE FROM update_queue WHERE update_id=?", (update_id,))
+
+    def done(update_id):
+        offsets.finish(update_id)
+        background_task(db.write(dequeue, update_id))
+    dispatcher.on_done = done
+
+    def start(update):
+        offsets.start(update.update_id)
+        if update.message:
+            dispatcher.dispatch(update)
+        else:
+            done(update.update_id)
+
+    offset = offsets.last + 1 if offsets.last >= 0 else None
+    try:
+        for update_id, data in await db.write(replay):
+            start(Update.de_json(json.loads(data), bot))
+            offset = max(offset or 0, update_id + 1)
+        while True:
+            try:
+                await dispatcher.room.wait()
+                updates = await bot.get_updates(offset=offset, timeout=20)
+                fresh = [u for u in updates if not offsets.known(u.update_id)]
+                if fresh:
+                    await db.write(enqueue, [(u.update_id, json.dumps(u.to_dict(), ensure_ascii=False))
+                                             for u in fresh])
+                for update in fresh:
+                    start(update)
+                if updates:
+                    offset = updates[-1].update_id + 1
+
+            except TelegramError as e:
+                print(f"Telegram error: {e}")
+                await asyncio.sleep(5)
+            except Exception as e:
+                print(f"Main loop error: {e}")
+                await asyncio.sleep(5)
+    finally:
+        saver.cancel()
+
+async def run_webhook(bot: Bot, dispatcher: ChatDispatcher, server: WebhookServer | None = None,
+                      register: bool = True):
+    server = server or await WebhookServer().start()
+    if register:
+        if not WEBHOOK_URL:
+            raise EnvironmentError("❌ UPDATE_MODE=webhook يحتاج WEBHOOK_URL (الرابط العام للبوت)")
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              allowed_updates=["message"])
+    print(f"🌐 webhook على المنفذ {server.port}{server.path}")
+
+    # تيليجرام قد يعيد إرسال تحديث (مهلة/خطأ شبكة/بعد إعادة التشغيل): ما انتهى قبل التشغيل
+    # (≤ الحد المحفوظ) يُتخطى. الاتصالات المتوازية لا تضمن الترتيب، فداخل التشغيل الواحد
+    # يُكشف التكرار بمجموعة ما استُلم وليس بالحد
+    offsets = UpdateOffsets(int(await get_state("last_update_id", -1)))
+    dispatcher.on_done = offsets.finish
+    saver = asyncio.create_task(offsets.save())
+    floor, seen, recent = offsets.last, set(), deque()
+    try:
+        while True:
+            data = await server.queue.get()
+            await dispatcher.room.wait()
+            try:
+                update = Update.de_json(data, bot)
+            except Exception as e:
+                print(f"Webhook: bad update: {e}")
+                continue
+            if update.update_id <= floor or update.update_id in seen:
+                continue
+            seen.add(update.update_id)
+            recent.append(update.update_id)
+            if len(recent) > 4096:
+                seen.discard(recent.popleft())
+            offsets.start(update.update_id)
+            if update.message:
+                dispatcher.dispatch(update)
+            else:
+                offsets.finish(update.update_id)
+    finally:
+        saver.cancel()
+        await server.stop()
+
+# --- تعدد العمليات: عملية استقبال + عمّال مقسمون حسب chat_id ---
+class HashRing:
+    """hash متسق: لكل عامل WORKER_VNODES نقطة على الحلقة، فتغيير عدد العمّال ينقل ~1/N من المحادثات فقط"""
+
+    def __init__(self, nodes: int, vnodes: int = WORKER_VNODES):
+        points = sorted((self._hash(f"{node}:{v}"), node) for node in range(nodes) for v in range(vnodes))
+        self.keys  = [key for key, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node(self, chat_id: int) -> int:
+        i = bisect_left(self.keys, self._hash(str(chat_id)))
+        return self.nodes[i % len(self.nodes)]
+
+class ShardWorker:
+    """عملية عامل واحدة كما تراها عملية الاستقبال"""
+
+    def __init__(self, index: int):
+        self.index    = index
+        self.proc: asyncio.subprocess.Process | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.inflight: OrderedDict[int, list] = OrderedDict()   # update_id → [json, مرات الإرسال]
+        self.handled  = 0
+        self.restarts = 0
+
+class ShardedDispatcher:
+    """
+    بديل ChatDispatcher في عملية الاستقبال (نفس الواجهة: dispatch / room / pending / on_done):
+    - كل تحديث يذهب لعامل المحادثة (HashRing)، فترتيب رسائل المحادثة وذاكرتها في عملية واحدة
+    - سطر JSON لكل تحديث عبر socketpair، والعامل يرد {"done": update_id} بعد انتهائه
+    - ما لم يؤكَّد يبقى في inflight: يُعاد للعامل بعد إعادة تشغيله، ويُترك بعد max_deliveries
+    - العمّال نسخ من نفس الأمر (argv) مع WORKER_INDEX / WORKER_FD في البيئة
+    """
+
+    def __init__(self, workers: int = WORKERS, argv: list | None = None,
+                 max_pending: int = DISPATCH_MAX_PENDING, max_deliveries: int = WORKER_MAX_DELIVERIES):
+        self.ring    = HashRing(workers)
+        self.workers = [ShardWorker(i) for i in range(workers)]
+        self.argv    = argv or [sys.executable, os.path.abspath(sys.argv[0]), *sys.argv[1:]]
+        self.max_pending, self.max_deliveries = max_pending, max_deliveries
+        self.pending = 0
+        self.room    = asyncio.Event()
+        self.room.set()
+        self.closing = False
+        self.on_done = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(w)) for w in self.workers]
+        return self
+
+    async def close(self):
+        self.closing = True
+        for w in self.workers:
+            if w.proc is not None and w.proc.returncode is None:
+                w.proc.terminate()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def dispatch(self, update) -> bool:
+        w = self.workers[self.ring.node(update.message.chat_id)]
+        w.inflight[update.update_id] = [json.dumps(update.to_dict(), ensure_ascii=False).encode(), 0]
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self.room.clear()
+        if w.writer is not None:
+            self._send(w, update.update_id)
+        return True
+
+    def _send(self, w: ShardWorker, update_id: int):
+        item = w.inflight[update_id]
+        item[1] += 1
+        w.writer.write(item[0] + b"\n")
+
+    def _done(self, w: ShardWorker, update_id: int):
+        if w.inflight.pop(update_id, None) is not None:
+            self.pending -= 1
+            if self.pending < self.max_pending:
+                self.room.set()
+            if self.on_done:
+                self.on_done(update_id)
+
+    async def _spawn(self, w: ShardWorker) -> asyncio.StreamReader:
+        parent, child = socket.socketpair()
+        try:
+            env = {**os.environ, "WORKER_INDEX": str(w.index), "WORKERS": str(len(self.workers)),
+                   "WORKER_FD": str(child.fileno())}
+            try:
+                w.proc = await asyncio.create_subprocess_exec(*self.argv, env=env, pass_fds=(child.fileno(),))
+            finally:
+                child.close()
+            reader, w.writer = await asyncio.open_connection(sock=parent)
+        except BaseException:
+            parent.close()
+            if w.proc is not None and w.proc.returncode is None:
+                w.proc.kill()
+                await w.proc.wait()
+            raise
+        return reader
+
+    async def _supervise(self, w: ShardWorker):
+        delay = 1.0
+        while not self.closing:
+            started = time.monotonic()
+            try:
+                reader = await self._spawn(w)
+            except Exception as e:
+                # مثل EMFILE / ENOMEM: تحديثات العامل تبقى في inflight حتى تنجح محاولة لاحقة
+                print(f"Worker {w.index} spawn error: {e}")
+                code = "spawn"
+            else:
+                for update_id, (_, sent) in list(w.inflight.items()):
+                    if sent >= self.max_deliveries:
+                        print(f"⚠️ العامل {w.index}: تحديث {update_id} أُسقط بعد {sent} محاولات")
+                        self._done(w, update_id)
+                    else:
+                        self._send(w, update_id)
+                try:
+                    while line := await reader.readline():
+                        self._done(w, json.loads(line)["done"])
+                        w.handled += 1
+                except (ConnectionError, ValueError, KeyError) as e:
+                    print(f"Worker {w.index} link error: {e}")
+                finally:
+                    w.writer.close()
+                    w.writer = None
+                    code = await w.proc.wait()
+            if self.closing:
+                break
+            w.restarts += 1
+            delay = 1.0 if time.monotonic() - started > WORKER_RESTART_MAX else min(delay * 2, WORKER_RESTART_MAX)
+            print(f"⚠️ العامل {w.index} توقف (code {code})، إعادة التشغيل بعد {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+    def stats(self) -> str:
+        return " | ".join(f"{w.index}: {w.handled} تم، {len(w.inflight)} جارٍ، إعادة تشغيل {w.restarts}"
+                          for w in self.workers)
+
+def make_bot() -> Bot:
+    return Bot(token=TELEGRAM_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot",
+               base_file_url=f"{TELEGRAM_API_URL}/file/bot")
+
+async def start_services(dispatcher: ChatDispatcher, owns=None, purge: bool = True):
+    """مهام المعالجة (عملية واحدة أو كل عامل): فهرسة قديمة، ضغط دوري، صندوق التنفيذ، مقاييس"""
+    background_task(backfill_vectors(owns))
+    background_task(compaction_loop(owns=owns, purge=purge))
+    await sandbox.start()
+    tracer.gauge("agent_dispatch_pending", lambda: dispatcher.pending)
+    tracer.gauge("agent_sandbox_idle", lambda: len(sandbox.idle))
+    tracer.gauge("agent_summary_queue", lambda: len(summarizer.queue))
+    tracer.gauge("agent_groq_queued", lambda: sum(
+        st["queued"] for st in models.limiter.stats().values()))
+
+async def run_worker(index: int, workers: int, fd: int):
+    """عامل في وضع WORKERS: يقرأ تحديثات محادثاته من عملية الاستقبال ويؤكد كل تحديث انتهى"""
+    global sender
+    init_db()
+    bot = make_bot()
+    # الميزانيات العامة لنفس البوت ونفس مفتاح Groq مقسومة بين العمّال
+    sender = TelegramSender(global_rate=TG_GLOBAL_RATE / workers)
+    models.limiter = GroqScheduler(share=workers)
+
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd), limit=1 << 22)
+    def done(update_id: int):
+        writer.write(b'{"done": %d}\n' % update_id)
+    dispatcher = ChatDispatcher(bot, on_done=done)
+    ring = HashRing(workers)
+    await start_services(dispatcher, owns=lambda chat_id: ring.node(chat_id) == index, purge=index == 0)
+    if METRICS_PORT:
+        await serve_metrics(port=METRICS_PORT + 1 + index)
+    print(f"🚀 العامل {index + 1}/{workers} جاهز")
+
+    while line := await reader.readline():
+        await dispatcher.room.wait()
+        try:
+            dispatcher.dispatch(Update.de_json(json.loads(line), bot))
         except Exception as e:
-            print(f"Main loop error: {e}")
-            await asyncio.sleep(5)
+            print(f"Worker {index}: bad update: {e}")
+    print(f"العامل {index}: انقطع الاتصال بعملية الاستقبال")
+
+async def main():
+    if not TELEGRAM_TOKEN or not GROQ_API_KEY:
+        raise EnvironmentError("❌ أضف TELEGRAM_TOKEN و GROQ_API_KEY في Railway Variables")
+    if "WORKER_FD" in os.environ:
+        return await run_worker(int(os.environ["WORKER_INDEX"]), WORKERS, int(os.environ["WORKER_FD"]))
+    init_db()
+    bot = make_bot()
+
+    if WORKERS > 1:
+        # الاستقبال فقط هنا؛ المعالجة والمهام الدورية في العمّال
+        dispatcher = await ShardedDispatcher().start()
+        tracer.gauge("agent_dispatch_pending", lambda: dispatcher.pending)
+        print(f"🚀 النظام جاهز: استقبال + {WORKERS} عمّال")
+    else:
+        dispatcher = ChatDispatcher(bot)
+        await start_services(dispatcher)
+        print("🚀 النظام جاهز: الباحث + المبرمج + المنفذ")
+
+    if METRICS_PORT:
+        await serve_metrics()
+    try:
+        if UPDATE_MODE == "webhook":
+            await run_webhook(bot, dispatcher)
+        else:
+            await run_polling(bot, dispatcher)
+    finally:
+        if isinstance(dispatcher, ShardedDispatcher):
+            await dispatcher.close()
 
 if __name__ == "__main__":
     asyncio.run(main())